@@ -7,34 +7,50 @@ src_directory = base_directory / 'src'
 sys.path.insert(0, str(src_directory))
 
 import config
-from doit.tools import run_once, create_folder
+import pulled_data
+import pipeline
+from doit.tools import run_once, create_folder, config_changed
 
 DATA_DIR = Path(config.DATA_DIR)
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 
+# Stages are skipped when the MD5 of every file_dep is unchanged (doit's default check); every stage writes
+# only its own targets (through temporary files), so `doit -n <cores>` can run independent stages side by side
+
+PIPELINE = src_directory / 'pipeline.py'
+# The code the cleaned-panel cache keys its panels and cubes on (clean_cache.CODE_FILES / CUBE_CODE_FILES),
+# listed here so dodo does not import clean_cache and the heavy modules behind it
+CLEAN_CODE = ('clean_data', 'holdings_schema', 'manager_dim', 'pulled_data')
+CUBE_CODE = ('df_constructor', 'rolling_universe', 'holdings_matrix')
+
+
+def _src(*names):
+    return [src_directory / f"{name}.py" for name in names]
+
 def task_pull_13f():
-    """Pull 13f data from WRDS if it doesn't already exist.
+    """Pull 13f data from WRDS for quarters past the manifest watermark.
     Outputs:
-        parquets: 13f in DATA_DIR
+        parquets: 13f dataset partitioned by quarter in DATA_DIR
     """
     def check_files():
-        return (DATA_DIR / "pulled" / "13f.parquet").exists()
+        return pulled_data.is_current(DATA_DIR, "13f", config.PULL_END_DATE)
 
     return {
         'actions': ['python src/pull_13f.py'],
-        'targets': [DATA_DIR / "pulled" / "13f.parquet"],
+        'targets': [DATA_DIR / "pulled" / "13f"],
         'uptodate': [check_files],
         'clean': True,
         'task_dep': ['create_folders'],
     }
 
 def task_pull_mf():
-    """Pull mutual fund data from WRDS if it doesn't already exist.
+    """Pull mutual fund data from WRDS for quarters past the manifest watermark.
     Outputs:
         parquets: Mutual_Fund in DATA_DIR
     """
     def check_files():
-        return (DATA_DIR / "pulled" / "Mutual_Fund.parquet").exists()
+        return ((DATA_DIR / "pulled" / "Mutual_Fund.parquet").exists()
+                and pulled_data.is_current(DATA_DIR, "Mutual_Fund", config.PULL_END_DATE))
 
     return {
         'actions': ['python src/pull_mf.py'],
@@ -56,16 +72,96 @@ def task_create_folders():
         'clean': True,
     }
 
+def task_clean():
+    """Clean the 13F panel of each report range (served from the cleaned-panel cache when it can be).
+    Outputs:
+        json: key of each cleaned panel in DATA_DIR/derived/report, changed only when the panel changes
+    """
+    # Files a pull in this same run will write are covered by the pull tasks' targets and the manifest
+    inputs = [f for f in pulled_data.input_files(DATA_DIR) if f.exists() or f.name == "Mutual_Fund.parquet"]
+    manifest = [pulled_data.manifest_path(DATA_DIR)] if pulled_data.manifest_path(DATA_DIR).exists() else []
+    previous = []
+    for name in pipeline.RANGES:
+        yield {
+            'name': name,
+            'actions': [f'python src/pipeline.py clean {name}'],
+            'file_dep': inputs + manifest + _src(*CLEAN_CODE) + [PIPELINE],
+            'targets': [pipeline.artifact(f"clean_{name}.json")],
+            # One range after the other: cleaning registers new managers in the shared manager key table
+            'task_dep': ['pull_13f', 'pull_mf'] + previous,
+            'clean': True,
+        }
+        previous = [f'clean:{name}']
+
+def task_cube():
+    """Build the manager-quarter cube of each report range.
+    Outputs:
+        parquets: managers and market tables in DATA_DIR/derived/report/cube_<range>
+    """
+    for name in pipeline.RANGES:
+        directory = pipeline.artifact(f"cube_{name}")
+        yield {
+            'name': name,
+            'actions': [f'python src/pipeline.py cube {name}'],
+            'file_dep': [pipeline.artifact(f"clean_{name}.json")] + _src(*CUBE_CODE) + [PIPELINE],
+            'targets': [directory / "managers.parquet", directory / "market.parquet"],
+            'clean': True,
+        }
+
+def task_d1():
+    """Roll each cube up into the Table D1 of its periods.
+    Outputs:
+        parquet: D1 tables of each range in DATA_DIR/derived/report
+    """
+    for name in pipeline.RANGES:
+        directory = pipeline.artifact(f"cube_{name}")
+        yield {
+            'name': name,
+            'actions': [f'python src/pipeline.py d1 {name}'],
+            'file_dep': [directory / "managers.parquet", directory / "market.parquet"]
+                        + _src('df_constructor', 'grouped_quantile') + [PIPELINE],
+            'targets': [pipeline.artifact(f"d1_{name}.parquet")],
+            'clean': True,
+        }
+
+def task_stats():
+    """Compute the statistics plotted in the report.
+    Outputs:
+        parquets: one stats table per figure in DATA_DIR/derived/report
+    """
+    return {
+        'actions': ['python src/pipeline.py stats'],
+        'file_dep': [pipeline.artifact("clean_old.json")] + _src('construct_stats', 'holdings_schema') + [PIPELINE],
+        'targets': [pipeline.artifact(f"stats_{figure}.parquet") for figure in pipeline.FIGURES],
+        'clean': True,
+    }
+
+def task_plot():
+    """Draw each figure of the report.
+    Outputs:
+        pngs: figures in OUTPUT_DIR
+    """
+    # One task for all figures: render_figures redraws only those whose stats changed, in a process pool
+    return {
+        'actions': ['python src/pipeline.py plot'],
+        'file_dep': [pipeline.artifact(f"stats_{figure}.parquet") for figure in pipeline.FIGURES]
+                    + _src('construct_stats') + [PIPELINE],
+        'targets': [OUTPUT_DIR / f"{figure}.png" for figure in pipeline.FIGURES],
+        'uptodate': [config_changed({'backend': config.FIGURE_BACKEND})],
+        'clean': True,
+    }
+
 def task_construct_full_report():
-    """Construct the full LaTeX report after ensuring WRDS data is available.
+    """Assemble the full LaTeX report from the D1 tables and figures.
     Outputs:
         LaTex Report in Output DIR
     """
     return {
-        'actions': ['python src/construct_full_report.py'],
-        'file_dep': [DATA_DIR / "pulled" / "13f.parquet", DATA_DIR / "pulled" / "Mutual_Fund.parquet"],
-        'targets': [Path(config.OUTPUT_DIR) / "full_report.tex"],
-        'task_dep': ['pull_13f', 'pull_mf'],  # This task depends on `task_pull_13f and task_pull_mf`
+        'actions': ['python src/pipeline.py latex'],
+        'file_dep': [pipeline.artifact(f"d1_{name}.parquet") for name in pipeline.RANGES]
+                    + [OUTPUT_DIR / f"{figure}.png" for figure in pipeline.FIGURES]
+                    + _src('dfs_to_latex') + [base_directory / "README.md", PIPELINE],
+        'targets': [OUTPUT_DIR / "full_report.tex", OUTPUT_DIR / "paper.bib"],
         'clean': True,
     }
 
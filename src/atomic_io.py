@@ -0,0 +1,37 @@
+"""
+Atomic writes of pipeline files, so a reader (or a parallel doit worker) never sees a partly written one
+
+- The file (or directory) is written under a temporary name next to its destination, unique to the process
+    and thread, then renamed into place with os.replace
+- If writing fails the temporary is removed and the destination is left as it was
+
+Functions:
+- atomic_write(path, writer): Writes path through writer(temporary path), then renames it into place
+"""
+
+
+import os
+import shutil
+import threading
+from pathlib import Path
+
+
+def atomic_write(path, writer):
+    """
+    writer: callable writing the file (or directory) at the temporary path it is given
+    Returns:
+        Path: path
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        writer(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    return path
@@ -0,0 +1,195 @@
+"""
+Scale benchmarks of the report pipeline on synthetic data (python src/benchmark.py [scale ...])
+
+- Every scale writes a synthetic panel (synthetic_data) with SIZES' managers and securities multiplied by the
+    scale (the number of quarters stays the same, so the holdings rows grow with the scale too)
+- The stages are timed one at a time, each in a fresh process so its peak RSS is its own: clean_data,
+    build_DFs, construct_stats and the report (figures and LaTeX tables). Every stage reads the previous
+    stage's output from disk before its timer starts
+- A stage whose dependencies are not installed (plotnine for construct_stats and the report) is recorded as
+    skipped
+- Results go to output/benchmarks/<timestamp>-<commit>.json with the commit, the sizes, and the seconds and
+    peak RSS of every stage, so runs on different commits can be compared with compare_results
+
+Functions:
+- run_benchmarks(scales, sizes, stages, out_dir): Runs the stages at each scale, returns and writes the results
+- compare_results(baseline, current, threshold): Stages of current slower (or larger) than baseline by threshold
+"""
+
+
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+import config
+import synthetic_data
+from instrumentation import rss_peak_mb
+
+OUTPUT_DIR = Path(config.OUTPUT_DIR)
+BENCHMARK_DIR = OUTPUT_DIR / "benchmarks"
+
+SCALES = (1, 10, 100)
+# Panel of scale 1: about 120k holdings rows
+SIZES = {'n_managers': 200, 'n_securities': 2000, 'n_quarters': 24}
+STAGES = ('clean_data', 'build_DFs', 'construct_stats', 'report')
+# Length of the Table D1 periods the synthetic range is cut into
+PERIOD_YEARS = 2
+
+
+def synthetic_periods(n_quarters, start=synthetic_data.START_DATE, years=PERIOD_YEARS):
+    """
+    Returns: the period covered by a synthetic panel and its consecutive `years`-long Table D1 periods
+    """
+    first = pd.Period(start, freq='Q')
+    last = first + n_quarters - 1
+    starts = pd.period_range(first, last, freq='Q')[::4 * years]
+    periods = [(str(s.start_time.date()), str(min(s + 4 * years - 1, last).end_time.date())) for s in starts]
+    return (periods[0][0], periods[-1][1]), periods
+
+
+def _run_stage(stage, data_dir, work_dir, n_quarters):
+    """
+    Runs one stage on the outputs of the stages before it (in work_dir) and writes its own
+    Returns:
+        dict: seconds and peak_rss_mb (None where it cannot be read), or skipped with the missing module
+    """
+    data_dir, work_dir = Path(data_dir), Path(work_dir)
+    period, periods = synthetic_periods(n_quarters)
+    try:
+        if stage == 'clean_data':
+            from clean_data import clean_data
+            start = time.perf_counter()
+            df = clean_data(period, data_dir)
+            seconds = time.perf_counter() - start
+            df.to_parquet(work_dir / "cleaned.parquet", index=False)
+        elif stage == 'build_DFs':
+            from df_constructor import build_DFs
+            from pipeline import save_d1
+            df = pd.read_parquet(work_dir / "cleaned.parquet")
+            start = time.perf_counter()
+            dfs = build_DFs(df, periods)
+            seconds = time.perf_counter() - start
+            save_d1(dfs, work_dir / "d1.parquet")
+        elif stage == 'construct_stats':
+            from construct_stats import construct_stats
+            from pipeline import FIGURES
+            df = pd.read_parquet(work_dir / "cleaned.parquet")
+            start = time.perf_counter()
+            stats = construct_stats(df)
+            seconds = time.perf_counter() - start
+            for figure, stats_df in zip(FIGURES, stats):
+                stats_df.to_parquet(work_dir / f"stats_{figure}.parquet")
+        elif stage == 'report':
+            from construct_stats import render_figures
+            from dfs_to_latex import generate_latex_string
+            from pipeline import FIGURES, load_d1
+            dfs = load_d1(work_dir / "d1.parquet")
+            stats = {figure: pd.read_parquet(work_dir / f"stats_{figure}.parquet") for figure in FIGURES}
+            start = time.perf_counter()
+            render_figures([(stats[figure], value_name, title, f"{figure}.png", condense)
+                            for figure, (value_name, title, condense) in FIGURES.items()],
+                           workers=1, out_dir=work_dir)
+            (work_dir / "tables.tex").write_text(generate_latex_string(dfs))
+            seconds = time.perf_counter() - start
+        else:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+    except ModuleNotFoundError as error:
+        return {'skipped': str(error)}
+    return {'seconds': seconds, 'peak_rss_mb': rss_peak_mb()}
+
+
+def _commit():
+    """
+    Returns: current git commit (with a -dirty suffix for uncommitted changes), None outside a git checkout
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=config.BASE_DIR).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True, cwd=config.BASE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_benchmarks(scales=SCALES, sizes=None, stages=STAGES, out_dir=BENCHMARK_DIR, seed=0):
+    """
+    sizes: synthetic_data sizes of scale 1 (n_managers and n_securities are multiplied by the scale)
+    Returns:
+        dict: the results, also written to out_dir/<timestamp>-<commit>.json
+    """
+    sizes = dict(SIZES, **(sizes or {}))
+    commit = _commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': sizes,
+        'runs': [],
+    }
+    context = multiprocessing.get_context('spawn')
+    for scale in scales:
+        scaled = dict(sizes, n_managers=sizes['n_managers'] * scale, n_securities=sizes['n_securities'] * scale)
+        with tempfile.TemporaryDirectory(prefix=f"benchmark-{scale}x-") as tmp:
+            data_dir, work_dir = Path(tmp) / "data", Path(tmp) / "work"
+            work_dir.mkdir(parents=True)
+            start = time.perf_counter()
+            rows = synthetic_data.write_synthetic_data(data_dir, seed=seed, **scaled)
+            run = {'scale': scale, 'rows': rows, 'generate_seconds': time.perf_counter() - start, 'stages': {}}
+            for stage in stages:
+                if any('skipped' in result for result in run['stages'].values()):
+                    run['stages'][stage] = {'skipped': "an earlier stage was skipped"}
+                    continue
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    run['stages'][stage] = executor.submit(_run_stage, stage, data_dir, work_dir,
+                                                           sizes['n_quarters']).result()
+            results['runs'].append(run)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stamp = results['timestamp'].replace(':', '').replace('-', '')
+    path = out_dir / f"{stamp}-{(commit or 'unknown')[:12]}.json"
+    path.write_text(json.dumps(results, indent=2))
+    return results
+
+
+def compare_results(baseline, current, threshold=1.2):
+    """
+    baseline, current: results of run_benchmarks (or paths of their JSON files)
+    Returns:
+        DataFrame: scale, stage, metric, both values and their ratio for every stage metric of current that is
+        more than `threshold` times its baseline value
+    """
+    runs = {}
+    for name, results in (('baseline', baseline), ('current', current)):
+        if not isinstance(results, dict):
+            results = json.loads(Path(results).read_text())
+        runs[name] = {(run['scale'], stage, metric): value for run in results['runs']
+                      for stage, result in run['stages'].items()
+                      for metric, value in result.items() if metric != 'skipped' and value is not None}
+    rows = [key + (runs['baseline'][key], value, value / runs['baseline'][key])
+            for key, value in runs['current'].items() if runs['baseline'].get(key)]
+    table = pd.DataFrame(rows, columns=['scale', 'stage', 'metric', 'baseline', 'current', 'ratio'])
+    return table[table['ratio'] > threshold].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    scales = [int(arg) for arg in sys.argv[1:]] or SCALES
+    for run in run_benchmarks(scales)['runs']:
+        print(f"{run['scale']}x ({run['rows']:,} rows)")
+        for stage, result in run['stages'].items():
+            if 'skipped' in result:
+                print(f"  {stage}: skipped ({result['skipped']})")
+            else:
+                peak = 'n/a' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f} MB"
+                print(f"  {stage}: {result['seconds']:.2f}s, peak RSS {peak}")
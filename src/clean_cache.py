@@ -0,0 +1,272 @@
+"""
+Content-addressed cache of cleaned panels
+
+- Entries are keyed on the period, the SHA-256 of the inputs (13F files, Mutual_Fund.parquet,
+    PF_names.csv) and of the cleaning code, so any change to either gives a new key
+- File digests are remembered by (size, mtime) so unchanged inputs are not re-hashed
+- Entries are Parquet files under data/derived/clean/, evicted least-recently-used once their
+    total size passes CLEAN_CACHE_MAX_BYTES; with CLEAN_CACHE_MEMORY_BYTES set, recent entries are also
+    kept in memory up to that many bytes (the frames returned are then shared, so they are read-only)
+- The manager dimension tables of each entry are kept under data/derived/manager_dim/<key>/, so
+    re-cleaning an evicted panel skips the typecode history read; they are evicted in their own turn
+
+- Manager-quarter cubes built from a cached panel are kept under data/derived/cube/<key>/, keyed on the
+    panel's key, the cube's date range and universe windows, and the code building them; they count towards
+    the same CLEAN_CACHE_MAX_BYTES and are evicted in the same least-recently-used order as the panels
+- Sparse holdings matrices of a cached panel are kept under data/derived/matrices/<key>/ the same way,
+    evicted like the cubes
+
+Functions:
+- cached_clean_data(period, data_dir): clean_data, served from the cache when possible
+- cached_cube(period, data_dir, cube_range, windows): Manager-quarter and market tables, built at most once
+- cached_holdings_matrices(period, data_dir): Per-quarter CSR holdings matrices, built at most once
+"""
+
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+import config
+import clean_data
+from atomic_io import atomic_write
+import df_constructor
+import holdings_matrix
+import rolling_universe
+import holdings_schema
+import manager_dim
+import pulled_data
+
+DATA_DIR = Path(config.DATA_DIR)
+CLEAN_CACHE_MAX_BYTES = config.CLEAN_CACHE_MAX_BYTES
+
+CODE_FILES = [Path(module.__file__) for module in (clean_data, holdings_schema, manager_dim, pulled_data)]
+CUBE_CODE_FILES = [Path(module.__file__) for module in (df_constructor, rolling_universe, holdings_matrix)]
+MATRIX_CODE_FILES = [Path(holdings_matrix.__file__)]
+# Directories under data/derived/ whose <key>/ entries are evicted along with the cleaned panels
+DERIVED_ENTRIES = ("manager_dim", "cube", "matrices")
+CLEAN_CACHE_MEMORY_BYTES = config.CLEAN_CACHE_MEMORY_BYTES
+
+# key -> (cleaned panel, its deep memory usage), least recently used first
+_memory = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_dir(data_dir):
+    """
+    Returns: directory holding the cached cleaned panels
+    """
+    return Path(data_dir) / "derived" / "clean"
+
+
+def cube_dir(data_dir, key):
+    """
+    Returns: directory holding a manager-quarter cube (managers.parquet and market.parquet)
+    """
+    return Path(data_dir) / "derived" / "cube" / key
+
+
+def matrices_dir(data_dir, key):
+    """
+    Returns: directory holding the sparse holdings matrices of a cached panel
+    """
+    return Path(data_dir) / "derived" / "matrices" / key
+
+
+def manager_dim_dir(data_dir, key):
+    """
+    Returns: directory holding the manager dimension tables built for a cache key
+    """
+    return Path(data_dir) / "derived" / "manager_dim" / key
+
+
+def _digest_index_path(data_dir):
+    return Path(data_dir) / "derived" / "digests.json"
+
+
+def file_digest(path, index=None):
+    """
+    SHA-256 of a file, looked up in index by (size, mtime) before hashing the contents
+    """
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    entry = index.get(str(path)) if index is not None else None
+    if entry is not None and entry['stamp'] == stamp:
+        return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if index is not None:
+        index[str(path)] = {'stamp': stamp, 'sha256': digest}
+    return digest
+
+
+def cache_key(period, data_dir):
+    """
+    Returns: hex key of a cleaned panel, from the period, input digests and cleaning code digest
+    """
+    index_path = _digest_index_path(data_dir)
+    index = {}
+    if index_path.exists():
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+    before = dict(index)
+
+    data_dir = Path(data_dir)
+    inputs = [(str(f.relative_to(data_dir)), file_digest(f, index)) for f in pulled_data.input_files(data_dir)]
+    code = [(f.name, file_digest(f)) for f in CODE_FILES]
+
+    if index != before:
+        atomic_write(index_path, lambda tmp_path: tmp_path.write_text(json.dumps(index)))
+
+    payload = json.dumps({'period': list(period), 'inputs': inputs, 'code': code}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _entries(data_dir):
+    """
+    Returns: (path, bytes, last use) of every cache entry, cleaned panels and DERIVED_ENTRIES directories
+    """
+    entries = [(f, f.stat().st_size, f.stat().st_mtime_ns) for f in cache_dir(data_dir).glob("*.parquet")]
+    for name in DERIVED_ENTRIES:
+        for directory in (Path(data_dir) / "derived" / name).glob("[!.]*"):
+            size = sum(f.stat().st_size for f in directory.rglob("*") if f.is_file())
+            entries.append((directory, size, directory.stat().st_mtime_ns))
+    return entries
+
+
+def evict(data_dir, max_bytes=CLEAN_CACHE_MAX_BYTES):
+    """
+    Deletes the least recently used entries (panels and the tables derived from them) until they fit in max_bytes
+    Returns:
+        list: paths removed
+    """
+    entries = sorted(_entries(data_dir), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        total -= size
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        removed.append(path)
+    return removed
+
+
+def _remember(key, df, memory_bytes):
+    """
+    Keeps df in the in-process cache, dropping the least recently used panels past memory_bytes
+    """
+    size = int(df.memory_usage(deep=True).sum())
+    with _lock:
+        _memory.pop(key, None)
+        if size > memory_bytes:
+            return
+        _memory[key] = (df, size)
+        total = sum(entry_size for _, entry_size in _memory.values())
+        while total > memory_bytes:
+            total -= _memory.popitem(last=False)[1][1]
+
+
+def cached_clean_data(period=(clean_data.STARTDATE, clean_data.ENDDATE), data_dir=DATA_DIR, max_bytes=CLEAN_CACHE_MAX_BYTES,
+                      memory_bytes=CLEAN_CACHE_MEMORY_BYTES, copy=False):
+    """
+    Same result as clean_data.clean_data(period, data_dir), computed at most once per inputs/code version
+    memory_bytes: size of the in-process cache of panels (0 disables it)
+    The panel may be shared with other callers through the in-process cache, so treat it as read-only;
+    copy=True returns a copy that can be modified
+    """
+    key = cache_key(period, data_dir)
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            _memory.move_to_end(key)
+    if entry is not None:
+        return entry[0].copy() if copy else entry[0]
+
+    path = cache_dir(data_dir) / f"{key}.parquet"
+    if path.exists():
+        os.utime(path)
+        df = pd.read_parquet(path)
+    else:
+        dim_dir = manager_dim_dir(data_dir, key)
+        if dim_dir.exists():
+            os.utime(dim_dir)
+        df = clean_data.clean_data(period, data_dir, manager_dim_dir=dim_dir)
+        atomic_write(path, lambda tmp_path: df.to_parquet(tmp_path, index=False, **holdings_schema.PARQUET_OPTIONS))
+        evict(data_dir, max_bytes)
+
+    if memory_bytes > 0:
+        _remember(key, df, memory_bytes)
+    return df.copy() if copy else df
+
+
+def cached_cube(period=(clean_data.STARTDATE, clean_data.ENDDATE), data_dir=DATA_DIR, cube_range=None, windows=None,
+                max_bytes=CLEAN_CACHE_MAX_BYTES):
+    """
+    Manager-quarter cube (df_constructor.manager_quarter_cube) of the panel cleaned over period, restricted to
+    cube_range (default: the whole period), built once per inputs/code version and kept under data/derived/cube/
+    Returns:
+        tuple: (managers, market), ready for df_constructor.rollup_periods
+    """
+    cube_range = tuple(cube_range or period)
+    payload = json.dumps({
+        'clean': cache_key(period, data_dir),
+        'range': list(cube_range),
+        'windows': windows,
+        'code': [(f.name, file_digest(f)) for f in CUBE_CODE_FILES],
+    }, sort_keys=True)
+    directory = cube_dir(data_dir, hashlib.sha256(payload.encode()).hexdigest())
+    if (directory / "market.parquet").exists():
+        os.utime(directory)
+        return df_constructor.load_cube(directory)
+
+    managers, market = df_constructor.manager_quarter_cube(cached_clean_data(period, data_dir), *cube_range, windows)
+    try:
+        atomic_write(directory, lambda tmp_dir: df_constructor.save_cube(managers, market, tmp_dir))
+    except OSError:
+        # Fine if another process wrote the same cube first
+        if not (directory / "market.parquet").exists():
+            raise
+    evict(data_dir, max_bytes)
+    return managers, market
+
+
+def cached_holdings_matrices(period=(clean_data.STARTDATE, clean_data.ENDDATE), data_dir=DATA_DIR,
+                             max_bytes=CLEAN_CACHE_MAX_BYTES):
+    """
+    Sparse holdings matrices (holdings_matrix.holdings_matrices) of the panel cleaned over period, built once
+    per inputs/code version and kept under data/derived/matrices/
+    Returns:
+        tuple: (managers, cusips, quarters)
+    """
+    payload = json.dumps({
+        'clean': cache_key(period, data_dir),
+        'code': [(f.name, file_digest(f)) for f in MATRIX_CODE_FILES],
+    }, sort_keys=True)
+    directory = matrices_dir(data_dir, hashlib.sha256(payload.encode()).hexdigest())
+    if (directory / "cusips.parquet").exists():
+        os.utime(directory)
+        return holdings_matrix.load_holdings_matrices(directory)
+
+    matrices = holdings_matrix.holdings_matrices(cached_clean_data(period, data_dir))
+    try:
+        atomic_write(directory, lambda tmp_dir: holdings_matrix.save_holdings_matrices(*matrices, tmp_dir))
+    except OSError:
+        # Fine if another process wrote the same matrices first
+        if not (directory / "cusips.parquet").exists():
+            raise
+    evict(data_dir, max_bytes)
+    return matrices
@@ -1,67 +1,269 @@
 """
 Cleans data based on parameters given in the paper.
 
-- Loads main 13F data from parquet, and removes missing price (prc) or shares outstanding (shrout1).
-- Filters entries not matching chosen stock codes (stkcd) or exchange codes (exchcd)
+- Loads main 13F data from parquet (partitioned by quarter, or the single 13f.parquet), and removes missing price (prc) or shares outstanding (shrout1).
+- Filters entries not matching chosen stock codes (stkcd) or exchange codes (exchcd); skipped when the
+    pull was pre-filtered in SQL (pulled_data.PREFILTERED_SCHEMA_VERSION)
+- Filters and the period are pushed down into the Parquet read; the pre-1998 typecode history comes
+    from a separate narrow read of (fdate, mgrno, mgrname, typecode)
 - Marks mutual/pension funds cross-referenced against Mutual_Fund and pension funds lists
 - Adjusts typecode for entries before 1998 with the most recent typecode per manager; reclassifies typecode
     based on flag/original typecode
+- The reclassification is worked out per manager and manager-quarter (manager_dim) and gathered onto
+    the holdings by integer key, rather than merged onto every row
 - Restricts start/end date
+- Keeps the compact dtypes of holdings_schema (int32 mgrno, int8 typecode, categorical mgrname/cusip)
+- Adds mgr_key, the stable int32 key of each (mgrno, mgrname) pair from the lookup table in data/derived
 
 Takes period (tuple, start/end date) and the data directory (Path, with data) and returns a dataframe.
+backend="polars" runs the same steps as one lazy polars query, with identical output.
+out_dir=... runs out of core under a memory budget: a narrow first pass builds the manager-level state,
+then the holdings are cleaned batch by batch and streamed to a quarter-partitioned dataset (read_cleaned).
 """
 
 
 import pandas as pd
 import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 import config
+from pathlib import Path
+from pulled_data import read_13f, iter_13f_batches, dataset_13f, schema_version, fdate_filter, holdings_filter, and_filters, quarter_label
+from pulled_data import PREFILTERED_SCHEMA_VERSION, SCHEMA_13F_CLEANED
+from holdings_schema import coerce_holdings, coerce_mutual_fund, canonical_categories, CLEANED_DTYPES, PARQUET_OPTIONS
+from manager_dim import build_manager_dim, manager_typecodes, manager_keys, register_managers, save_manager_dim, load_manager_dim
+from instrumentation import profiled, stage
 DATA_DIR = config.DATA_DIR
 
 STARTDATE = config.STARTDATE_OLD
 ENDDATE = config.ENDDATE_OLD
 
-def clean_data(period = (STARTDATE, ENDDATE), data_dir = DATA_DIR):
+CLEAN_MEMORY_BUDGET = config.CLEAN_MEMORY_BUDGET
+CLEANED_DIR = Path(DATA_DIR) / "derived" / "13f_clean"
+
+TYPECODE_CUTOFF = '1998-12-01'
+HOLDINGS_COLUMNS = ['fdate', 'mgrno', 'mgrname', 'typecode', 'cusip', 'shares', 'prc', 'shrout1']
+CLEANED_COLUMNS = ['fdate', 'mgrno', 'mgrname', 'mgr_key', 'typecode', 'cusip', 'shares', 'prc', 'shrout1']
+MANAGER_COLUMNS = ['fdate', 'mgrno', 'mgrname', 'typecode']
+# Peak bytes per holdings row while a batch is cleaned: the Arrow batch, the pandas frame and the
+# masks/copies of filtering and writing (measured roughly, on the compact dtypes)
+CLEAN_BYTES_PER_ROW = 200
+
+@profiled()
+def clean_data(period = (STARTDATE, ENDDATE), data_dir = DATA_DIR, backend = "pandas", manager_dim_dir = None,
+               out_dir = None, memory_budget = CLEAN_MEMORY_BUDGET):
     """
     Takes period (tuple, start/end date) and the data directory (Path, with data)
     returns a dataframe of cleaned data
+    backend is "pandas" or "polars"
+    manager_dim_dir: where the manager dimension tables of this period/data are kept (pandas backend),
+        loaded if present, else built and written there
+    out_dir: if given, runs out of core instead: the holdings are cleaned in batches that fit memory_budget
+        (bytes) and streamed to a dataset partitioned by quarter under out_dir (read back with read_cleaned);
+        returns the list of files written
+    Rows are ordered by a stable sort on fdate, so the "last" typecode of a manager-quarter filing several is
+    the last one in pull order. The original unstable sort left that tie-break arbitrary, so such
+    manager-quarters can be reclassified differently than before this ordering was fixed
     """
     start, end = period
-    df = pd.read_parquet(data_dir / "pulled/13f.parquet")
-    df = df[df['fdate'] <= end]
-    df = df.dropna(subset=['prc','shrout1'])
-    df = df[(df['stkcd']=='0') | (df['stkcd'].isnull())]
-    df = df[(df['exchcd'].isin(['A','B','V']))  | (df['exchcd'].isnull())]
-    df = df.drop(columns=['stkcd', 'exchcd'])
-
-    df = df.sort_values('fdate')
-    last_type_before_dec98 = df[df['fdate'] < '1998-12-01'].groupby(['mgrno', 'mgrname'])['typecode'].last().rename('typecode_correct')
-    df = df[df['fdate'] >= start].merge(last_type_before_dec98, on=['mgrno', 'mgrname'], how='left')
-    df.loc[df['fdate'] >= '1998-12-01', 'typecode'] = df['typecode_correct'].fillna(df['typecode'])
-
-    most_recent_type_code = df.groupby(['mgrno', 'mgrname'])['typecode'].last().rename('typecode_recent')
-    df = df.merge(most_recent_type_code, on=['mgrno', 'mgrname'])
-    df['typecode'] = df['typecode_recent']
-
-    df['new_typecode'] = np.nan
-    df.loc[df['typecode'] == 1, 'new_typecode'] = 1
-    df.loc[df['typecode'] == 2, 'new_typecode'] = 2
-
-    df_mf = pd.read_parquet(data_dir / "pulled/Mutual_Fund.parquet")
-    df_mf = df_mf[df_mf['fdate'] <= end].drop_duplicates()
-    df['fdate_temp'] = df['fdate'].where(df['fdate'] >= pd.to_datetime('03/31/1994'), pd.to_datetime('03/31/1994'))
-    df = df.merge(df_mf, left_on=['mgrno', 'fdate_temp'], right_on=['mgrcocd', 'fdate'], how='left', indicator=True)
-    df['mf'] = df['_merge'] == 'both'
-    df = df.drop(columns=['_merge', 'fdate_temp', 'mgrcocd', 'fdate_y']).rename(columns={'fdate_x': 'fdate'})
-
-    df.loc[df['mf'], 'new_typecode'] = 4
-    df.loc[df['typecode'].isin([3,4]), 'new_typecode'] = 3
+    data_dir = Path(data_dir)
+    if out_dir is not None:
+        return _clean_data_out_of_core(period, data_dir, Path(out_dir), memory_budget)
+    if backend == "polars":
+        return _clean_data_polars(period, data_dir)
+    if backend != "pandas":
+        raise ValueError(f"Unknown backend '{backend}', expected 'pandas' or 'polars'")
+    row_filter = None
+    if schema_version(data_dir) != PREFILTERED_SCHEMA_VERSION:
+        row_filter = holdings_filter()
+
+    with stage("clean_data.read") as record:
+        df = read_13f(data_dir, columns=HOLDINGS_COLUMNS, filter=and_filters([fdate_filter(start=start, end=end), row_filter]))
+        df = df.sort_values('fdate', kind='stable')
+        record['rows_out'] = len(df)
+
+    with stage("clean_data.manager_dim", rows_in=len(df)) as record:
+        managers, quarters = _manager_dim(df, end, data_dir, row_filter, manager_dim_dir)
+        record['rows_out'] = len(quarters)
+
+    # Managers without a name have no key (typecode -1) and are dropped
+    with stage("clean_data.reclassify", rows_in=len(df)) as record:
+        row_key = manager_keys(df, managers)
+        typecode = manager_typecodes(df, managers, quarters, row_key)
+        keep = typecode >= 0
+        df = df[keep].assign(mgr_key=row_key[keep], typecode=typecode[keep])
 
+        df = coerce_holdings(df[CLEANED_COLUMNS], dtypes=CLEANED_DTYPES)
+        df = canonical_categories(df).reset_index(drop=True)
+        record['rows_out'] = len(df)
+    return df
+
+
+def _manager_dim(df, end, data_dir, row_filter, manager_dim_dir):
+    """
+    Manager dimension tables of clean_data, loaded from manager_dim_dir if present, else built (and saved there)
+    """
+    if manager_dim_dir is not None and (Path(manager_dim_dir) / "quarters.parquet").exists():
+        return load_manager_dim(manager_dim_dir)
+    # Only the narrow manager/typecode history is needed before the period starts
+    history = read_13f(data_dir, columns=['fdate', 'mgrno', 'mgrname', 'typecode'],
+                       filter=and_filters([fdate_filter(end=end, before=TYPECODE_CUTOFF), row_filter]))
+    history = history.sort_values('fdate', kind='stable')
+    df_mf = pd.read_parquet(data_dir / "pulled/Mutual_Fund.parquet", filters=[('fdate', '<=', pd.Timestamp(end))])
+    df_mf = coerce_mutual_fund(df_mf.drop_duplicates())
     df_pf = pd.read_csv(data_dir / "manual/PF_names.csv")
-    df['pf'] = df['mgrname'].isin(df_pf['PF_name'])
+    managers, quarters = build_manager_dim(history, df, df_mf, df_pf['PF_name'], register_managers(df, data_dir))
+    if manager_dim_dir is not None:
+        save_manager_dim(managers, quarters, manager_dim_dir)
+    return managers, quarters
+
+
+def _manager_quarter_typecodes(df):
+    """
+    Last non-null typecode of each (manager, fdate), NA if there is none; a manager-quarter stands in
+    for all its rows when building the manager dimension, since the typecode adjustment is the same
+    for every row of a manager-quarter and only the last non-null typecode survives
+    """
+    return (df.groupby(['mgrno', 'mgrname', 'fdate'], observed=True, sort=False)['typecode'].last()
+            .reset_index()[MANAGER_COLUMNS])
+
+
+def _clean_data_out_of_core(period, data_dir, out_dir, memory_budget):
+    """
+    clean_data in two streamed passes over the 13F holdings:
+    1. narrow (fdate, mgrno, mgrname, typecode) batches are reduced to manager-quarters, from which the
+        manager dimension (pre-1998 typecode, most recent typecode, mutual/pension fund flags) is built
+    2. full batches get their typecode from the dimension and are written to out_dir/fdate=<quarter>/
+    Only one batch and the manager-level state are held in memory at a time
+    """
+    start, end = period
+    batch_size = max(int(memory_budget) // CLEAN_BYTES_PER_ROW, 1)
+    row_filter = None
+    if schema_version(data_dir) != PREFILTERED_SCHEMA_VERSION:
+        row_filter = holdings_filter()
+
+    with stage("clean_data.manager_pass") as record:
+        reduced = [_manager_quarter_typecodes(batch) for batch in
+                   iter_13f_batches(data_dir, columns=MANAGER_COLUMNS, batch_size=batch_size,
+                                    filter=and_filters([fdate_filter(end=end), row_filter]))]
+        reduced = pd.concat(reduced, ignore_index=True) if reduced else pd.DataFrame(columns=MANAGER_COLUMNS)
+        # Batches can split a manager-quarter (and the single-file layout is not in fdate order)
+        reduced = reduced.astype({'mgrno': 'int32', 'mgrname': 'category', 'typecode': 'Int8'})
+        reduced = _manager_quarter_typecodes(reduced.sort_values('fdate', kind='stable'))
+        history = reduced[reduced['fdate'] < TYPECODE_CUTOFF]
+        holdings = reduced[reduced['fdate'] >= pd.Timestamp(start)]
+
+        df_mf = pd.read_parquet(data_dir / "pulled/Mutual_Fund.parquet", filters=[('fdate', '<=', pd.Timestamp(end))])
+        df_mf = coerce_mutual_fund(df_mf.drop_duplicates())
+        df_pf = pd.read_csv(data_dir / "manual/PF_names.csv")
+        managers, quarters = build_manager_dim(history, holdings, df_mf, df_pf['PF_name'], register_managers(holdings, data_dir))
+        record['rows_out'] = len(quarters)
+        del reduced, history, holdings
+
+    for stale in out_dir.glob("fdate=*/part-*.parquet"):
+        stale.unlink()
+    paths = []
+    batches = iter_13f_batches(data_dir, columns=HOLDINGS_COLUMNS, batch_size=batch_size,
+                               filter=and_filters([fdate_filter(start=start, end=end), row_filter]))
+    with stage("clean_data.holdings_pass") as record:
+        record['rows_in'] = record['rows_out'] = 0
+        for number, df in enumerate(batches):
+            record['rows_in'] += len(df)
+            row_key = manager_keys(df, managers)
+            typecode = manager_typecodes(df, managers, quarters, row_key)
+            keep = typecode >= 0
+            df = coerce_holdings(df[keep].assign(mgr_key=row_key[keep], typecode=typecode[keep])[CLEANED_COLUMNS], dtypes=CLEANED_DTYPES)
+            record['rows_out'] += len(df)
+            labels = df['fdate'].dt.to_period('Q')
+            for qtr, part in df.groupby(labels, sort=True):
+                path = out_dir / f"fdate={quarter_label(qtr.start_time)}" / f"part-{number:05d}.parquet"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(part, schema=SCHEMA_13F_CLEANED, preserve_index=False), path,
+                               **PARQUET_OPTIONS)
+                paths.append(path)
+    return paths
+
+
+def read_cleaned(out_dir = CLEANED_DIR, columns = None, filter = None):
+    """
+    Reads a panel written by clean_data(out_dir=...), optionally only some columns / rows (pyarrow filter)
+    returns the same dataframe clean_data would have returned
+    """
+    files = sorted(Path(out_dir).glob("fdate=*/part-*.parquet"))
+    table = ds.dataset([str(f) for f in files], schema=SCHEMA_13F_CLEANED, format='parquet').to_table(columns=columns, filter=filter)
+    df = coerce_holdings(table.to_pandas(), dtypes=CLEANED_DTYPES).sort_values('fdate', kind='stable')
+    return canonical_categories(df, [c for c in ('mgrname', 'cusip') if c in df.columns]).reset_index(drop=True)
+
+
+def _last_typecode(name):
+    """
+    Last non-null typecode of each group, in frame order (the frame is sorted by fdate first)
+    """
+    return pl.col('typecode').drop_nulls().last().alias(name)
+
+
+def _clean_data_polars(period, data_dir):
+    """
+    clean_data as a single lazy polars query, so the filters, typecode look-ups, mutual fund
+    join and pension fund flag are planned and run together across cores
+    """
+    start, end = [pd.Timestamp(d) for d in period]
+    cutoff = pd.Timestamp(TYPECODE_CUTOFF)
+    keys = ['mgrno', 'mgrname']
+
+    with pl.StringCache():
+        # Scanned through pyarrow: polars' own reader treats the fdate=YYYY-QQ directories as a
+        # second fdate column. Filters and projections are still pushed into the scan.
+        lf = pl.scan_pyarrow_dataset(dataset_13f(data_dir))
+        lf = lf.filter(pl.col('fdate') <= end)
+        if schema_version(data_dir) != PREFILTERED_SCHEMA_VERSION:
+            lf = lf.filter(
+                pl.col('prc').is_not_null() & pl.col('shrout1').is_not_null()
+                & ((pl.col('stkcd') == '0') | pl.col('stkcd').is_null())
+                & (pl.col('exchcd').is_in(['A', 'B', 'V']) | pl.col('exchcd').is_null()))
+        lf = (lf.select(HOLDINGS_COLUMNS)
+              .with_columns(pl.col('mgrno').cast(pl.Int32), pl.col('typecode').cast(pl.Int8),
+                            pl.col('mgrname').cast(pl.Utf8), pl.col('cusip').cast(pl.Utf8))
+              .sort('fdate', maintain_order=True))
+
+        # pandas groupby leaves out null keys, so managers without a name get no typecode and are dropped
+        last_type_before_dec98 = (lf.filter((pl.col('fdate') < cutoff) & pl.col('mgrname').is_not_null())
+                                  .group_by(keys).agg(_last_typecode('typecode_correct')))
+        df = lf.filter(pl.col('fdate') >= start).join(last_type_before_dec98, on=keys, how='left')
+        df = df.with_columns(
+            pl.when(pl.col('fdate') >= cutoff)
+            .then(pl.coalesce('typecode_correct', 'typecode'))
+            .otherwise(pl.col('typecode')).alias('typecode'))
+
+        most_recent_type_code = df.filter(pl.col('mgrname').is_not_null()).group_by(keys).agg(_last_typecode('typecode_recent'))
+        df = (df.join(most_recent_type_code, on=keys, how='left')
+              .filter(pl.col('mgrname').is_not_null())
+              .with_columns(pl.col('typecode_recent').alias('typecode')))
+
+        df_mf = (pl.scan_parquet(str(data_dir / "pulled" / "Mutual_Fund.parquet"))
+                 .filter(pl.col('fdate') <= end)
+                 .select(pl.col('mgrcocd').cast(pl.Int32).alias('mgrno'), pl.col('fdate').cast(pl.Datetime('ns')).alias('fdate_temp'))
+                 .unique()
+                 .with_columns(pl.lit(True).alias('mf')))
+        df = (df.with_columns(pl.max_horizontal('fdate', pl.lit(pd.Timestamp('03/31/1994'))).cast(pl.Datetime('ns')).alias('fdate_temp'))
+              .join(df_mf, on=['mgrno', 'fdate_temp'], how='left')
+              .with_columns(pl.col('mf').fill_null(False)))
+
+        pf_names = pd.read_csv(data_dir / "manual/PF_names.csv")['PF_name'].tolist()
+        df = df.with_columns(pl.col('mgrname').is_in(pf_names).any().over(keys).alias('pf_any'))
+
+        typecode = pl.col('typecode')
+        new_typecode = pl.when(typecode == 1).then(1).when(typecode == 2).then(2).otherwise(None)
+        new_typecode = pl.when(pl.col('mf')).then(4).otherwise(new_typecode)
+        new_typecode = pl.when(typecode.is_in([3, 4])).then(3).otherwise(new_typecode)
+        new_typecode = pl.when(pl.col('pf_any') & typecode.is_in([3, 4, 5])).then(5).otherwise(new_typecode)
+        df = df.with_columns(new_typecode.fill_null(6).cast(pl.Int8).alias('typecode'))
+
+        df = df.select(HOLDINGS_COLUMNS).collect().to_pandas()
 
-    df.loc[df.groupby(['mgrno', 'mgrname'])['pf'].transform('any') & df['typecode'].isin([3,4,5]), 'new_typecode'] = 5
-    df['new_typecode'] = df['new_typecode'].fillna(6)
-    df['typecode'] = df['new_typecode']
-    
-    return df[['fdate', 'mgrno', 'mgrname', 'typecode', 'cusip', 'shares', 'prc', 'shrout1']]
+    df = coerce_holdings(df, dtypes=CLEANED_DTYPES)
+    df.insert(3, 'mgr_key', manager_keys(df, register_managers(df, data_dir)))
+    return canonical_categories(df)
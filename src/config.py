@@ -34,6 +34,32 @@ ENDDATE_NEW = '2024-12-31'
 
 UNITTEST_PERIOD = ('2000-01-01', '2002-12-31')
 
+# Range pulled from WRDS; bump PULL_END_DATE to refresh with the newest quarters.
+# Refreshes re-pull the last PULL_LOOKBACK_QUARTERS quarters to pick up late 13F amendments.
+PULL_START_DATE = config('PULL_START_DATE', default='1980-03-31')
+PULL_END_DATE = config('PULL_END_DATE', default='2024-12-31')
+PULL_LOOKBACK_QUARTERS = config('PULL_LOOKBACK_QUARTERS', default=2, cast=int)
+# Parallel WRDS connections used by the pulls (WRDS caps concurrent sessions per user)
+PULL_WORKERS = config('PULL_WORKERS', default=4, cast=int)
+# Apply the clean_data stkcd/exchcd filters in the SQL pull (smaller transfer and files)
+PULL_PREFILTERED = config('PULL_PREFILTERED', default=False, cast=bool)
+# Hold shares/prc as float32 in memory (a column that would lose precision, ie. shares above 2**24, stays float64)
+HOLDINGS_FLOAT32 = config('HOLDINGS_FLOAT32', default=False, cast=bool)
+# Size cap of the cleaned-panel cache in DATA_DIR/derived/clean (least recently used entries go first)
+CLEAN_CACHE_MAX_BYTES = config('CLEAN_CACHE_MAX_BYTES', default=4 * 1024**3, cast=int)
+# Bytes of cleaned panels also kept in memory for reuse within a process (0 keeps none)
+CLEAN_CACHE_MEMORY_BYTES = config('CLEAN_CACHE_MEMORY_BYTES', default=0, cast=int)
+# Rough memory cap (bytes) of out-of-core cleaning, which streams record batches sized to fit it
+CLEAN_MEMORY_BUDGET = config('CLEAN_MEMORY_BUDGET', default=1024**3, cast=int)
+# Processes building the manager-quarter cube (managers are hashed into this many shards; 1 runs serially)
+BUILD_WORKERS = config('BUILD_WORKERS', default=1, cast=int)
+# Processes rendering the report figures, and their backend ('plotnine', or 'matplotlib' for quick drafts)
+FIGURE_WORKERS = config('FIGURE_WORKERS', default=3, cast=int)
+FIGURE_BACKEND = config('FIGURE_BACKEND', default='plotnine')
+# Write a timing/memory profile of every run to OUTPUT_DIR/profiles, and the stage (if any) to run under cProfile
+PROFILE_RUNS = config('PROFILE_RUNS', default=True, cast=bool)
+PROFILE_STAGE = config('PROFILE_STAGE', default='')
+
 if __name__ == "__main__":
     
     (DATA_DIR / 'pulled').mkdir(parents=True, exist_ok=True)
@@ -5,20 +5,33 @@ and plots the data.
 
 Functions:
 - Pivot data into tables based on specific columns.
-- Create dataframes for the count of institutions, AUM by type, and unique manager name/number pairs.
-- Plot statistics over time!
+- Create dataframes for the count of institutions, AUM by type, and unique manager name/number pairs,
+  all pivoted from one manager-quarter aggregation (the input frame is not modified).
+- Plot statistics over time! (plotnine, or a faster matplotlib drawing of the same layout)
+- Render several plots at once, in a process pool, skipping those already up to date in output/
 """
 
 import config
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import plotnine as p9
 import clean_data
+import holdings_matrix
+from atomic_io import atomic_write
+from holdings_schema import manager_columns
+from instrumentation import profiled
 from mizani.formatters import custom_format
 from IPython.display import display
 
 output_dir = Path(config.OUTPUT_DIR)
 
+FIGURE_DPI = 300
+FAST_DPI = 100
+FIGURE_MANIFEST = "figures.json"
+
 STARTDATE = config.STARTDATE_OLD
 ENDDATE = config.ENDDATE_NEW
 
@@ -34,60 +47,75 @@ def pivot_table(table, col_val):
     )
 
 
-def create_avg_aum_df(cleaned_df):
+@profiled()
+def manager_quarter_aum(cleaned_df):
+    """
+    One aggregation of the holdings by manager-quarter ('fdate', the manager's 'mgr_key' or 'mgrno'/'mgrname',
+    and its 'typecode'), from which all three stats tables are pivoted: total ('AUM') and average ('avg_AUM')
+    position value prc * shares. Only that one column is computed, cleaned_df is left unchanged
+    """
+    keys = ['fdate'] + manager_columns(cleaned_df) + ['typecode']
+    position_value = cleaned_df['prc'] * cleaned_df['shares']
+    grouped = position_value.groupby([cleaned_df[key] for key in keys], observed=True)
+    return pd.DataFrame({'AUM': grouped.sum(), 'avg_AUM': grouped.mean()}).reset_index()
+
+
+def create_avg_aum_df(cleaned_df, manager_quarters=None):
     """
     Generates a DataFrame summarizing the total AUM by 'typecode' and 'fdate', aggregating
     AUM values for unique 'mgrno' and 'mgrname' combinations (since they are the same manager)
+    manager_quarters: manager_quarter_aum(cleaned_df), if already computed
     """
-    summed_aum_with_typecode = cleaned_df.groupby(['fdate', 'mgrno', 'mgrname']).agg({
-        'AUM': 'mean',
-        'typecode': 'first'  
-    }).reset_index()
+    if manager_quarters is None:
+        manager_quarters = manager_quarter_aum(cleaned_df)
+    aum_by_code_and_date = manager_quarters.groupby(['fdate', 'typecode'])['avg_AUM'].sum().reset_index()
 
-    summed_aum_with_typecode = summed_aum_with_typecode.sort_values(by=['fdate', 'mgrno', 'mgrname']).reset_index(drop=True)
-    aum_by_code_and_date = summed_aum_with_typecode.groupby(['fdate', 'typecode'])['AUM'].sum().reset_index()
-
-    return pivot_table(aum_by_code_and_date, 'AUM')
+    return pivot_table(aum_by_code_and_date, 'avg_AUM')
 
 
-def create_aum_df(cleaned_df):
+def create_aum_df(cleaned_df, manager_quarters=None):
     """
     Generates a DataFrame summarizing the total AUM by 'typecode' and 'fdate', aggregating
     AUM values for unique 'mgrno' and 'mgrname' combinations (since they are the same manager)
+    manager_quarters: manager_quarter_aum(cleaned_df), if already computed
     """
-    summed_aum_with_typecode = cleaned_df.groupby(['fdate', 'mgrno', 'mgrname']).agg({
-        'AUM': 'sum',
-        'typecode': 'first'  
-    }).reset_index()
-
-    summed_aum_with_typecode = summed_aum_with_typecode.sort_values(by=['fdate', 'mgrno', 'mgrname']).reset_index(drop=True)
-    aum_by_code_and_date = summed_aum_with_typecode.groupby(['fdate', 'typecode'])['AUM'].sum().reset_index()
+    if manager_quarters is None:
+        manager_quarters = manager_quarter_aum(cleaned_df)
+    aum_by_code_and_date = manager_quarters.groupby(['fdate', 'typecode'])['AUM'].sum().reset_index()
 
     return pivot_table(aum_by_code_and_date, 'AUM')
 
 
-def create_mgrs_df(cleaned_df):
+def create_mgrs_df(cleaned_df, manager_quarters=None):
     """
     DataFrame counting unique 'mgrno' and 'mgrname' pairs by 'typecode' and 'fdate'
-    for distribution over time
+    for distribution over time (manager_quarters has one row per distinct manager, so the count is its size)
+    manager_quarters: manager_quarter_aum(cleaned_df), if already computed
     """
-    unique_mgr_counts_by_type = (cleaned_df.groupby(['fdate', 'typecode'])
-                                 .apply(lambda x: x.drop_duplicates(['mgrno', 'mgrname']).shape[0]).reset_index(name='UniqueMgrCounts'))
+    if manager_quarters is None:
+        manager_quarters = manager_quarter_aum(cleaned_df)
+    unique_mgr_counts_by_type = manager_quarters.groupby(['fdate', 'typecode']).size().reset_index(name='UniqueMgrCounts')
     return pivot_table(unique_mgr_counts_by_type, 'UniqueMgrCounts')
 
 
-def construct_stats(cleaned_df):
+@profiled()
+def construct_stats(cleaned_df, backend="pandas"):
     '''
     Creates three data frames that contain useful plotting information. The three dataframes are the
     average AUM held at each quarter, the total AUM by institution type per quarter, and
     the number of unique manager name/number pairs per quarter.
+    backend="sparse" computes them from the per-quarter holdings matrices (holdings_matrix) instead.
     '''
 
-    cleaned_df['AUM'] = cleaned_df['prc'] * cleaned_df['shares']
+    if backend == "sparse":
+        managers, _, quarters = holdings_matrix.holdings_matrices(cleaned_df)
+        type_counts_df, aum_df, mgrs_df = (df.reset_index() for df in holdings_matrix.stats_by_type(managers, quarters))
+    else:
+        manager_quarters = manager_quarter_aum(cleaned_df)
 
-    type_counts_df = create_avg_aum_df(cleaned_df).reset_index()
-    aum_df = create_aum_df(cleaned_df).reset_index()
-    mgrs_df = create_mgrs_df(cleaned_df).reset_index()
+        type_counts_df = create_avg_aum_df(cleaned_df, manager_quarters).reset_index()
+        aum_df = create_aum_df(cleaned_df, manager_quarters).reset_index()
+        mgrs_df = create_mgrs_df(cleaned_df, manager_quarters).reset_index()
 
     cols = ['fdate' ,'Bank', 'Insurance', 'Mutual Funds', 'Investment Advisors', 'Other']
 
@@ -100,9 +128,11 @@ def construct_stats(cleaned_df):
     return stats
 
 
-def plot_stats_data(stats_df, value_name, title, file_name, condense=False):
+@profiled()
+def plot_stats_data(stats_df, value_name, title, file_name, condense=False, backend="plotnine", out_dir=None):
     """
     Plots institution counts over time
+    backend "matplotlib" draws the same facets directly with matplotlib at FAST_DPI, for quick iteration
     """
     df = stats_df.copy()
     df.reset_index(inplace=True)
@@ -111,6 +141,13 @@ def plot_stats_data(stats_df, value_name, title, file_name, condense=False):
     format = '{:,.0f}'
     if condense:
         format = '${:.0e}'
+
+    plot_path = Path(out_dir or output_dir) / file_name
+    if backend == "matplotlib":
+        _plot_stats_matplotlib(long_df, value_name, title, plot_path, format)
+        return plot_path
+    if backend != "plotnine":
+        raise ValueError(f"Unknown backend '{backend}', expected 'plotnine' or 'matplotlib'")
     
     plot = (
         p9.ggplot(long_df, p9.aes(x='fdate', y=value_name, color='Type')) +
@@ -125,6 +162,77 @@ def plot_stats_data(stats_df, value_name, title, file_name, condense=False):
         )
     )
     
-    plot_path = output_dir / file_name
-    plot.save(filename=plot_path, dpi=300)
+    plot.save(filename=plot_path, dpi=FIGURE_DPI)
     return plot_path
+
+
+def _plot_stats_matplotlib(long_df, value_name, title, plot_path, format):
+    """
+    plot_stats_data's facet layout (one free-y panel per type, 3 per row) drawn straight with matplotlib,
+    on a standalone Figure (saved through the Agg canvas) so pyplot's backend and figures are left alone
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import FuncFormatter
+
+    types = list(long_df['Type'].unique())
+    fig = Figure(figsize=(14, 7))
+    axes = fig.subplots(-(-len(types) // 3), 3, squeeze=False)
+    for number, (ax, type_name) in enumerate(zip(axes.flat, types)):
+        data = long_df[long_df['Type'] == type_name]
+        ax.plot(data['fdate'], data[value_name], color=f"C{number}")
+        ax.set_title(type_name)
+        ax.yaxis.set_major_formatter(FuncFormatter(lambda value, _: format.format(value)))
+        ax.tick_params(axis='x', labelrotation=45)
+    for ax in axes.flat[len(types):]:
+        ax.set_visible(False)
+    fig.suptitle(title)
+    fig.supxlabel('Date')
+    fig.supylabel(value_name)
+    fig.tight_layout()
+    fig.savefig(plot_path, dpi=FAST_DPI)
+
+
+def figure_key(stats_df, spec):
+    """
+    Returns: hex digest of a stats frame's values, index and columns, the plot spec and this module's code
+    """
+    sha = hashlib.sha256()
+    sha.update(pd.util.hash_pandas_object(stats_df, index=True).to_numpy().tobytes())
+    sha.update(json.dumps([[str(c) for c in stats_df.columns], spec], sort_keys=True).encode())
+    sha.update(Path(__file__).read_bytes())
+    return sha.hexdigest()
+
+
+@profiled()
+def render_figures(figures, workers=config.FIGURE_WORKERS, backend=config.FIGURE_BACKEND, out_dir=None):
+    """
+    figures: plot_stats_data arguments (stats_df, value_name, title, file_name[, condense]) of each figure
+    Renders only the figures whose stats or spec changed since they were written to out_dir (their keys are
+    kept in out_dir/figures.json), concurrently in a process pool of up to `workers`
+    Returns:
+        dict: file name -> path of every figure
+    """
+    out_dir = Path(out_dir or output_dir)
+    manifest_path = out_dir / FIGURE_MANIFEST
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    paths, stale = {}, {}
+    for stats_df, value_name, title, file_name, *condense in figures:
+        condense = bool(condense and condense[0])
+        key = figure_key(stats_df, {'value_name': value_name, 'title': title, 'condense': condense, 'backend': backend})
+        paths[file_name] = out_dir / file_name
+        if manifest.get(file_name) != key or not paths[file_name].exists():
+            stale[file_name] = ((stats_df, value_name, title, file_name, condense, backend, out_dir), key)
+
+    if workers > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(stale))) as executor:
+            for future in [executor.submit(plot_stats_data, *args) for args, _ in stale.values()]:
+                future.result()
+    else:
+        for args, _ in stale.values():
+            plot_stats_data(*args)
+
+    if stale:
+        manifest.update({file_name: key for file_name, (_, key) in stale.items()})
+        atomic_write(manifest_path, lambda tmp_path: tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True)))
+    return paths
@@ -3,45 +3,78 @@ Functions to reconstruct metrics from the original table
 
 Functions:
 - roll_stocks(group): Rolls up quarterly stock data to calculate the unique count of 'cusip' identifiers 
-  within a rolling window of up to 12 quarters for each group.
-- market_val(df): Calculates the total market value by multiplying the price ('prc') and shares outstanding 
-  ('shrout1') for each unique 'cusip'
-- percentile(n): Computes the nth percentile
-- build_DFs(df, periods): Returns metrics: AUM, stock counts, and market value
+  within a rolling window of up to 12 quarters for each group. build_DFs uses the vectorized
+  rolling_universe, which gives the same counts for all managers at once.
+- security_quarters(df): One row per (Qtr, cusip) with its market capitalization, price ('prc') times shares
+  outstanding ('shrout1'), deduplicated once over the whole panel
+- market_val(securities): Calculates the total market value per quarter from the security-quarter table
+- percentile(n): Computes the nth percentile (build_DFs uses grouped_quantile for all groups at once)
+- manager_quarter_cube(df, start, end, windows, backend, workers, approximate): Manager-quarter fact table (AUM,
+  stocks, type, universe) and quarter-level market table, from groupbys (optionally over manager shards in a process
+  pool, optionally with approximate universes) or from sparse holdings matrices, persisted with save_cube / load_cube
+- rollup_periods(managers, market, periods, windows): D1 table of each period from those two tables
+- build_cube(df, start, end, directory, windows): Full rebuild of a stored cube and its rolling-universe state
+- append_quarter(directory, df_quarter, quarter_types, windows): Adds one new quarter to a stored cube from that
+  quarter's holdings, the state and the re-derived type of every manager-quarter, giving the same tables as a full
+  rebuild. Library-only: the report pipeline (pipeline.py, dodo.py) rebuilds its cubes through clean_cache
+- build_DFs(df, periods, windows, backend, workers, approximate): Returns metrics: AUM, stock counts, investment universe (for one or several
+  look-back windows), and market value
 
 Parameters: df (DataFrame), periods (list of tuples, split according to paper), group (DataFrameGroupBy object, subset of main df)
 Returns: Dictionary where keys are period tuples and values are DataFrames containing aggregated metrics per period
 """
 
 
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from pathlib import Path
 
-def roll_stocks(group):
+import config
+import holdings_matrix
+from atomic_io import atomic_write
+from grouped_quantile import groupby_quantiles
+from holdings_schema import manager_columns
+from instrumentation import profiled, stage
+from rolling_universe import rolling_universe, rolling_universes
+from universe_sketch import approximate_universes, relative_error
+
+def roll_stocks(group, window=12):
     """
-    Aggregates a rolling count of unique 'cusip' identifiers within each group for up to 12 quarters.
+    Aggregates a rolling count of unique 'cusip' identifiers within each group for up to 12 (window) quarters.
     Returns:
         DataFrame: 'Qtr' for quarters and 'universe' for unique 'cusip' counts
     """
     uc_dict = {'Qtr': [], 'universe': []}
     quarters = group['Qtr'].unique()
     for i, q in enumerate(quarters):
-        window_quarters = quarters[max(0, i - 11) : i + 1]
+        window_quarters = quarters[max(0, i - window + 1) : i + 1]
         window_data = group[group['Qtr'].isin(window_quarters)]
         uc_dict['Qtr'].append(q)
         uc_dict['universe'].append(window_data['cusip'].nunique())
     return pd.DataFrame(uc_dict)
 
-def market_val(df):
+@profiled()
+def security_quarters(df):
+    """
+    One row per (Qtr, cusip), from the first holding of each, with its market capitalization
+    (price 'prc' times shares outstanding 'shrout1', in millions)
+    Returns:
+        DataFrame: 'Qtr', 'cusip', 'prc', 'shrout1' and 'mktcap'
+    """
+    securities = df.drop_duplicates(subset=['Qtr', 'cusip'])[['Qtr', 'cusip', 'prc', 'shrout1']]
+    return securities.assign(mktcap=securities['prc'] * securities['shrout1']*1000000).reset_index(drop=True)
+
+@profiled()
+def market_val(securities):
     """
-    Calculates the total market value per cusip by multiplying its price ('prc')
-    with the shares outstanding ('shrout1'), after removing duplicates
+    Calculates the total market value per quarter from the security-quarter table
     Returns:
-        float: The total market value of all unique 'cusip' in the DataFrame
+        DataFrame: 'Qtr' and 'market_val', the market capitalization of all unique 'cusip' held that quarter
     """
-    df = df.drop_duplicates(subset=['cusip'])
-    df['val'] = df['prc'] * df['shrout1']*1000000
-    return df['val'].sum()
+    return securities.groupby('Qtr')['mktcap'].sum().rename('market_val').reset_index()
 
 def percentile(n):
     """
@@ -53,31 +86,269 @@ def percentile(n):
     return percentile_
 
 
-def build_DFs(df, periods):
+def _with_quarters(df):
     """
-    Constructs DataFrames for specified periods containing aggregated metrics
-    Returns:
-        dict: Keys are period tuples, values are DataFrames with aggregated metrics for each period
+    Adds the quarter ('Qtr') and position value ('val') of each holding, sorted by quarter
     """
-    df = df[df['fdate'].between(periods[0][0],periods[-1][1])]
-
-    df['Qtr'] = df['fdate'].dt.to_period('Q')
-    df = df.sort_values(by='Qtr')
+    df = df.assign(Qtr=df['fdate'].dt.to_period('Q')).sort_values(by='Qtr', kind='stable')
+    return df.assign(val=df['shares'] * df['prc'])
 
-    df['val'] = df['shares'] * df['prc']
 
-    managers = df.groupby(['Qtr', 'mgrno', 'mgrname']).agg(
+@profiled("manager_stats")
+def _manager_stats(df):
+    """
+    AUM, number of stocks and type of each manager-quarter of a frame from _with_quarters
+    (managers are grouped on the integer mgr_key when the panel has it)
+    """
+    return df.groupby(['Qtr'] + manager_columns(df), observed=True).agg(
         AUM=('val', 'sum'),
         stocks=('cusip', 'nunique'),
         type=('typecode', 'last')
     ).reset_index()
 
-    grouped = df.groupby(['mgrno', 'mgrname'])
-    universe = grouped.apply(roll_stocks).reset_index(level=2, drop=True).reset_index()
-    managers = managers.merge(universe, on=['Qtr', 'mgrno', 'mgrname'])
 
-    market = df.groupby('Qtr').apply(market_val).reset_index()
-    market.columns = ['Qtr', 'market_val']
+def _universe_windows(windows):
+    """
+    Returns: {column name: look-back in quarters} of the universe columns
+    """
+    return {'universe': 12} if windows is None else {f"universe_{w}": w for w in windows}
+
+
+def _manager_cube(df, windows, approximate=False):
+    """
+    Manager-quarter rows (stats and universe) of a frame from _with_quarters
+    approximate: estimate the universe from HyperLogLog sketches (universe_sketch) instead of counting it
+    """
+    managers = _manager_stats(df)
+    with stage("rolling_universe", rows_in=len(df)) as record:
+        if approximate:
+            universe = approximate_universes(df, list(_universe_windows(windows).values()))
+            universe = universe.rename(columns={f"universe_{w}": column for column, w in _universe_windows(windows).items()})
+        elif windows is None:
+            universe = rolling_universe(df)
+        else:
+            universe = rolling_universes(df, windows)
+        record['rows_out'] = len(universe)
+    return managers.merge(universe, on=['Qtr'] + manager_columns(df))
+
+
+def _write_ipc(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_ipc(path):
+    with pa.memory_map(str(path), 'r') as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _shard_cube(in_path, out_path, windows, approximate=False):
+    """
+    Process pool task: manager-quarter rows of the shard in the Arrow IPC file in_path, written to out_path
+    """
+    _write_ipc(_manager_cube(_with_quarters(_read_ipc(in_path)), windows, approximate), out_path)
+    return out_path
+
+
+def _sharded_manager_cube(df, windows, workers, approximate=False):
+    """
+    _manager_cube over managers hashed into `workers` shards, each handed to a worker process as an Arrow IPC
+    file (memory-mapped on read) instead of a pickled DataFrame; every manager's rows stay in one shard, so
+    the concatenated shards put back in the serial (Qtr, manager) order are the serial result
+    """
+    keys = manager_columns(df)
+    df = df[['fdate'] + keys + ['typecode', 'cusip', 'shares', 'prc']]
+    shard = pd.util.hash_pandas_object(df[keys], index=False).to_numpy() % workers
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for number in range(workers):
+            in_path, out_path = Path(tmp_dir) / f"shard-{number}.arrow", Path(tmp_dir) / f"cube-{number}.arrow"
+            _write_ipc(df[shard == number], in_path)
+            futures.append(executor.submit(_shard_cube, in_path, out_path, windows, approximate))
+        managers = pd.concat([_read_ipc(future.result()) for future in futures], ignore_index=True)
+    return managers.sort_values(['Qtr'] + keys, kind='stable').reset_index(drop=True)
+
+
+@profiled()
+def manager_quarter_cube(df, start, end, windows=None, backend="pandas", workers=config.BUILD_WORKERS, approximate=False):
+    """
+    Manager-quarter fact table and quarter-level market table of the holdings between start and end,
+    from which the D1 table of any periods in that range is rolled up (rollup_periods)
+    The universe look-back only sees quarters from start on, as build_DFs always has
+    backend: "pandas" (groupbys over the holdings) or "sparse" (holdings_matrix, per-quarter CSR matrices)
+    workers: processes for the pandas backend's manager-level work (1 runs it in this process)
+    approximate: estimate the universe with HyperLogLog sketches (pandas backend); the relative standard error
+        of the estimates is kept in managers.attrs['universe_relative_error'] and passed on to the D1 tables
+    Returns:
+        tuple: managers (Qtr, manager columns, AUM, stocks, type, universe columns) and market (Qtr, market_val)
+    """
+    if approximate and backend != "pandas":
+        raise ValueError("approximate universes are only available with the pandas backend")
+    if backend == "sparse":
+        matrices = holdings_matrix.holdings_matrices(df[df['fdate'].between(start, end)])
+        return holdings_matrix.manager_quarter_table(matrices[0], matrices[2], _universe_windows(windows))
+    if backend != "pandas":
+        raise ValueError(f"Unknown backend '{backend}', expected 'pandas' or 'sparse'")
+    df = df[df['fdate'].between(start, end)]
+    if workers > 1:
+        managers = _sharded_manager_cube(df, windows, workers, approximate)
+        df = _with_quarters(df[['fdate', 'cusip', 'shares', 'prc', 'shrout1']])
+    else:
+        df = _with_quarters(df)
+        managers = _manager_cube(df, windows, approximate)
+    if approximate:
+        managers.attrs['universe_relative_error'] = relative_error()
+
+    # Market value deduplicates securities across all managers, so it is not sharded
+    market = market_val(security_quarters(df))
+    return managers, market
+
+
+def _concat(frames):
+    """
+    Concatenates frames, keeping mgrname/cusip categorical over the union of their categories
+    """
+    df = pd.concat(frames, ignore_index=True)
+    for column in ['mgrname', 'cusip']:
+        if column in df.columns and df[column].dtype != 'category':
+            df[column] = df[column].astype('category')
+            df[column] = df[column].cat.set_categories(df[column].cat.categories.sort_values())
+    return df
+
+
+def _mergeable(df):
+    """
+    mgrname (if present) as plain strings, so frames with different categories merge on it
+    """
+    return df.astype({'mgrname': 'object'}) if 'mgrname' in df.columns else df
+
+
+def _latest_quarters(state, keep):
+    """
+    Rows of state in each manager's `keep` most recent observed quarters
+    """
+    keys = manager_columns(state)
+    quarters = state[keys + ['Qtr']].drop_duplicates().sort_values('Qtr', kind='stable')
+    quarters['age'] = quarters.groupby(keys, observed=True).cumcount(ascending=False)
+    quarters = quarters[quarters['age'] < keep]
+    return state.merge(quarters, on=keys + ['Qtr'])
+
+
+def universe_state(df, start, end, windows=None):
+    """
+    What append_quarter needs to carry the rolling universe forward: the distinct (manager columns, Qtr, cusip)
+    of each manager's last (longest window - 1) observed quarters between start and end
+    (a quarter with no known cusip keeps one row with a missing cusip, since it still counts as observed)
+    """
+    keep = max(_universe_windows(windows).values()) - 1
+    df = _with_quarters(df[df['fdate'].between(start, end)])
+    state = df[manager_columns(df) + ['Qtr', 'cusip']].drop_duplicates()
+    return _latest_quarters(state, keep).drop(columns='age').reset_index(drop=True)
+
+
+def _retyped(managers, quarter_types):
+    """
+    managers with the type of every manager-quarter taken from quarter_types (manager columns, fdate, typecode)
+    """
+    keys = manager_columns(managers) + ['Qtr']
+    types = (quarter_types.assign(Qtr=quarter_types['fdate'].dt.to_period('Q'))
+             .groupby(keys, observed=True)['typecode'].last().rename('new_type').reset_index())
+    # A left merge on unique keys keeps the rows of managers in order
+    new_type = _mergeable(managers[keys]).merge(_mergeable(types), on=keys, how='left')['new_type']
+    if new_type.isna().any():
+        raise ValueError(f"append_quarter: {new_type.isna().sum()} manager-quarters of the cube have no type in quarter_types")
+    return managers.assign(type=new_type.to_numpy().astype(managers['type'].dtype))
+
+
+def append_quarter_to_cube(managers, market, state, df_quarter, quarter_types, windows=None):
+    """
+    Adds one new quarter of cleaned holdings to a cube and its universe state without touching older holdings:
+    manager stats and market value come from the new quarter alone, the universe from the new quarter plus
+    the previous (window - 1) observed quarters of each manager kept in state
+    quarter_types: final typecode of every manager-quarter of the newly cleaned panel (the quarters table of its
+        manager dimension, see manager_dim). clean_data reclassifies a manager's past quarters from its most
+        recent typecode, so a new quarter can change the type of quarters already in the cube
+    Returns:
+        tuple: (managers, market, state), the same as rebuilding them from the whole panel
+    """
+    keys = manager_columns(df_quarter)
+    df = _with_quarters(df_quarter)
+    quarters = df['Qtr'].unique()
+    if len(quarters) != 1 or (len(managers) and quarters[0] <= managers['Qtr'].max()):
+        raise ValueError(f"append_quarter needs the holdings of one quarter after the cube's last, got {list(quarters)}")
+    managers = _retyped(managers, quarter_types)
+
+    new_managers = _manager_stats(df)
+    new_state = df[keys + ['Qtr', 'cusip']].drop_duplicates()
+    filers = _mergeable(new_managers[keys])
+    past = _mergeable(state).merge(filers, on=keys)
+    for column, window in _universe_windows(windows).items():
+        rows = _concat([_latest_quarters(past, window - 1).drop(columns='age'), new_state])
+        universe = rows.groupby(keys, observed=True)['cusip'].nunique().rename(column).reset_index()
+        new_managers = _mergeable(new_managers).merge(_mergeable(universe), on=keys)
+
+    managers = _concat([managers, new_managers[list(managers.columns)]])
+    market = pd.concat([market, market_val(security_quarters(df))], ignore_index=True)
+    keep = max(_universe_windows(windows).values()) - 1
+    state = _latest_quarters(_concat([state, new_state]), keep).drop(columns='age').reset_index(drop=True)
+    return managers, market, state
+
+
+def save_cube(managers, market, directory, state=None):
+    """
+    Writes the manager-quarter and market tables to directory/managers.parquet and directory/market.parquet,
+    and the universe state (if given) to directory/state.parquet
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    atomic_write(directory / "managers.parquet", lambda tmp_path: managers.to_parquet(tmp_path, index=False))
+    atomic_write(directory / "market.parquet", lambda tmp_path: market.to_parquet(tmp_path, index=False))
+    if state is not None:
+        atomic_write(directory / "state.parquet", lambda tmp_path: state.to_parquet(tmp_path, index=False))
+
+
+def load_cube(directory):
+    """
+    Returns: (managers, market) written by save_cube
+    """
+    directory = Path(directory)
+    return pd.read_parquet(directory / "managers.parquet"), pd.read_parquet(directory / "market.parquet")
+
+
+@profiled()
+def build_cube(df, start, end, directory, windows=None):
+    """
+    Full rebuild of a stored cube and its universe state from the cleaned panel
+    """
+    managers, market = manager_quarter_cube(df, start, end, windows)
+    save_cube(managers, market, directory, universe_state(df, start, end, windows))
+    return managers, market
+
+
+@profiled()
+def append_quarter(directory, df_quarter, quarter_types, windows=None):
+    """
+    Appends one new quarter of cleaned holdings to the cube stored in directory (see build_cube), re-typing
+    its manager-quarters from quarter_types (see append_quarter_to_cube)
+    Returns:
+        tuple: the updated (managers, market)
+    """
+    managers, market = load_cube(directory)
+    state = pd.read_parquet(Path(directory) / "state.parquet")
+    managers, market, state = append_quarter_to_cube(managers, market, state, df_quarter, quarter_types, windows)
+    save_cube(managers, market, directory, state)
+    return managers, market
+
+
+@profiled()
+def rollup_periods(managers, market, periods, windows=None):
+    """
+    Rolls the manager-quarter and market tables up into the D1 table of each period
+    Returns:
+        dict: Keys are period tuples, values are DataFrames with aggregated metrics for each period
+    """
+    universe_columns = ['universe'] if windows is None else [f"universe_{w}" for w in windows]
 
     df_list = {}
     for period in periods:
@@ -85,18 +356,18 @@ def build_DFs(df, periods):
         managers_sub = managers[managers['Qtr'].between(start, end)]
         market_sub = market[market['Qtr'].between(start, end)]
 
-        managers_sub['id'] = managers_sub['mgrno'].astype(str) + "-" + managers_sub['mgrname'].astype(str)
-
-        by_type_quarter = managers_sub.groupby(['type', 'Qtr']).agg(
-            number=('id', 'nunique'),
-            AUM=('AUM', 'sum'),  
-            AUM_median=('AUM', 'median'),
-            AUM_90=('AUM', lambda x: np.percentile(x, 90)),
-            stocks_median=('stocks', 'median'),
-            stocks_90=('stocks', lambda x: np.percentile(x, 90)),
-            universe_median=('universe', 'median'),
-            universe_90=('universe', lambda x: np.percentile(x, 90))
-            ).reset_index()
+        # managers has one row per (Qtr, manager), so counting rows counts distinct managers
+        grouped = managers_sub.groupby(['type', 'Qtr'])
+        by_type_quarter = grouped.agg(
+            number=('AUM', 'size'),
+            AUM=('AUM', 'sum')
+            )
+        # Medians and 90th percentiles of all groups at once, same values as np.percentile per group
+        for column in ['AUM', 'stocks'] + universe_columns:
+            quantiles = groupby_quantiles(grouped, column, [0.5, 0.9])
+            by_type_quarter[f"{column}_median"] = quantiles[0.5]
+            by_type_quarter[f"{column}_90"] = quantiles[0.9]
+        by_type_quarter = by_type_quarter.reset_index()
         
         by_type_quarter = by_type_quarter.merge(market_sub, on='Qtr', how='left')
         by_type_quarter['market_held'] = by_type_quarter['AUM']/by_type_quarter['market_val']*100
@@ -107,8 +378,7 @@ def build_DFs(df, periods):
             AUM_90=('AUM_90', 'mean'),
             stocks_median=('stocks_median', 'mean'),
             stocks_90=('stocks_90', 'mean'),
-            universe_median=('universe_median', 'mean'),
-            universe_90=('universe_90', 'mean'),
+            **{f"{column}_{stat}": (f"{column}_{stat}", 'mean') for column in universe_columns for stat in ('median', '90')},
             market_held=('market_held', 'mean')
             )
         
@@ -118,9 +388,27 @@ def build_DFs(df, periods):
         by_type['AUM_90'] = np.round(by_type['AUM_90'] /1000000).astype(int)
         by_type['stocks_median'] = np.round(by_type['stocks_median']).astype(int)
         by_type['stocks_90'] = np.round(by_type['stocks_90']).astype(int)
-        by_type['universe_median'] = np.round(by_type['universe_median']).astype(int)  
-        by_type['universe_90'] = np.round(by_type['universe_90']).astype(int)  
+        for column in universe_columns:
+            by_type[f"{column}_median"] = np.round(by_type[f"{column}_median"]).astype(int)
+            by_type[f"{column}_90"] = np.round(by_type[f"{column}_90"]).astype(int)
 
+        by_type.attrs.update(managers.attrs)
         df_list[period] = by_type
 
     return df_list
+
+
+@profiled()
+def build_DFs(df, periods, windows=None, backend="pandas", workers=config.BUILD_WORKERS, approximate=False):
+    """
+    Constructs DataFrames for specified periods containing aggregated metrics
+    windows: list of universe look-backs in quarters, ie. [4, 8, 12, 20], computed in one pass and reported
+        as universe_<w>_median / universe_<w>_90; None gives the 12-quarter universe_median / universe_90
+    backend: "pandas" or "sparse", workers: processes for the manager-level work (see manager_quarter_cube)
+    approximate: fast mode with HyperLogLog universe estimates; each table's attrs['universe_relative_error']
+        gives their relative standard error
+    Returns:
+        dict: Keys are period tuples, values are DataFrames with aggregated metrics for each period
+    """
+    managers, market = manager_quarter_cube(df, periods[0][0], periods[-1][1], windows, backend, workers, approximate)
+    return rollup_periods(managers, market, periods, windows)
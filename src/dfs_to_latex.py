@@ -6,10 +6,12 @@ Produces a .tex file including write-up, tables, and graphs
 import config
 from pathlib import Path
 from construct_stats import plot_stats_data, construct_stats
+from instrumentation import profiled
 
 DATA_DIR = Path(config.DATA_DIR)
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 
+@profiled()
 def generate_latex_string(dfs):
     """
     Inserts the dataframe data into the preconstructed LaTeX table layout
@@ -143,6 +145,7 @@ def gen_bib():
     with open(OUTPUT_DIR / "paper.bib", "w") as file:
         file.write(bib_entry)
 
+@profiled()
 def df_to_latex_with_md_and_plots(df_old, df_new, plot_files, md_path, output):
     """
     Combines the content of a Markdown file, LaTeX tables from multiple DataFrames, and plots into a single .tex file
@@ -0,0 +1,254 @@
+"""
+Sparse manager x security holdings matrices, one per quarter, and the D1 / stats metrics as sparse operations
+
+- Managers (mgr_key, or mgrno and mgrname) and cusips get one integer index each over the whole panel,
+    so row i / column j mean the same manager / security in every quarter
+- Each quarter keeps a CSR matrix of shares held (duplicate filings summed, an explicit entry for every
+    security held even with zero or missing shares), plus dense vectors: holding rows, rows with a position
+    value (shares and price both known) and last typecode per manager, price and shares outstanding per cusip (from its first holding, as security_quarters)
+- The metrics are then row counts and products: stocks held = stored entries per row, AUM = shares @ price,
+    universe = entries per row of the OR of the manager's last `window` observed quarters, ownership share =
+    column sums / shares outstanding
+- Rows without a cusip only count as a filing of their manager (the cleaned panel has none)
+
+Functions:
+- holdings_matrices(df): (managers, cusips, quarters) from a cleaned panel
+- stocks_held(quarter), manager_aum(quarter), ownership_shares(quarter): Per-quarter metrics
+- rolling_universes(quarters, windows): Universe of every manager-quarter for several look-backs at once
+- manager_quarter_table(managers, quarters, windows): The manager-quarter and market tables of
+    df_constructor.manager_quarter_cube
+- stats_by_type(managers, quarters): The three tables of construct_stats
+- save_holdings_matrices / load_holdings_matrices: Persist them as npz (one file per quarter) and Parquet
+"""
+
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from holdings_schema import manager_columns
+
+# Dense per-quarter vectors kept alongside the shares matrix
+VECTORS = ('rows', 'valued', 'typecode', 'price', 'shrout')
+
+
+def _first_positions(codes):
+    """
+    Returns: (distinct codes, position of the first row holding each)
+    """
+    return np.unique(codes, return_index=True)
+
+
+def holdings_matrices(df):
+    """
+    df: cleaned panel (fdate, manager columns, typecode, cusip, shares, prc, shrout1)
+    Returns:
+        tuple: managers (DataFrame of the manager columns, row i = matrix row i), cusips (Index, column j = matrix
+        column j) and quarters ({Qtr: dict of 'shares' (CSR), 'rows', 'valued', 'typecode', 'price', 'shrout'}),
+        by quarter
+    """
+    keys = manager_columns(df)
+    df = df.assign(Qtr=df['fdate'].dt.to_period('Q')).sort_values('Qtr', kind='stable')
+    grouped = df.groupby(keys, observed=True, sort=True)
+    manager = grouped.ngroup().to_numpy()
+    managers = grouped.size().index.to_frame(index=False)
+    if isinstance(df['cusip'].dtype, pd.CategoricalDtype):
+        cusip, cusips = df['cusip'].cat.codes.to_numpy(), df['cusip'].cat.categories
+    else:
+        cusip, cusips = pd.factorize(df['cusip'], sort=True)
+    n_managers, n_cusips = len(managers), len(cusips)
+
+    shares = df['shares'].to_numpy(dtype='float64', na_value=np.nan)
+    prc = df['prc'].to_numpy(dtype='float64', na_value=np.nan)
+    shrout = df['shrout1'].to_numpy(dtype='float64', na_value=np.nan)
+    typecode = df['typecode'].to_numpy()
+    qtr = df['Qtr'].array.asi8
+    bounds = np.flatnonzero(np.diff(qtr)) + 1
+
+    quarters = {}
+    for rows in np.split(np.arange(len(df)), bounds) if len(df) else []:
+        m, c = manager[rows], cusip[rows]
+        filed = rows[m >= 0]
+        held = rows[(m >= 0) & (c >= 0)]
+        valued = filed[~np.isnan(shares[filed] * prc[filed])]
+        matrix = sp.csr_matrix((np.nan_to_num(shares[held]), (manager[held], cusip[held])),
+                               shape=(n_managers, n_cusips))
+
+        last = np.full(n_managers, -1, dtype='int8')
+        reversed_managers, positions = _first_positions(manager[filed][::-1])
+        last[reversed_managers] = typecode[filed][::-1][positions]
+        price, outstanding = np.full(n_cusips, np.nan), np.full(n_cusips, np.nan)
+        securities, positions = _first_positions(cusip[held])
+        price[securities] = prc[held][positions]
+        outstanding[securities] = shrout[held][positions]
+
+        quarters[df['Qtr'].iloc[rows[0]]] = {
+            'shares': matrix,
+            'rows': np.bincount(manager[filed], minlength=n_managers).astype('int32'),
+            'valued': np.bincount(manager[valued], minlength=n_managers).astype('int32'),
+            'typecode': last,
+            'price': price,
+            'shrout': outstanding,
+        }
+    return managers, cusips, quarters
+
+
+def stocks_held(quarter):
+    """
+    Returns: number of distinct securities held by each manager
+    """
+    return np.diff(quarter['shares'].indptr)
+
+
+def manager_aum(quarter):
+    """
+    Returns: assets under management (shares times price) of each manager
+    """
+    return quarter['shares'] @ np.nan_to_num(quarter['price'])
+
+
+def ownership_shares(quarter):
+    """
+    Returns: fraction of each security's shares outstanding (shrout1, in millions) held by all managers,
+    NaN for securities not held that quarter
+    """
+    held = np.asarray(quarter['shares'].sum(axis=0)).ravel()
+    return held / (quarter['shrout'] * 1000000)
+
+
+def rolling_universes(quarters, windows):
+    """
+    Number of distinct securities held over each manager's last `window` observed quarters (its filing
+    quarters, gaps skipped), for every window at once: going back from each quarter, every earlier matrix is
+    added once, its rows assigned to the band of windows they are still in, and the bands are summed up
+    Returns:
+        dict: {Qtr: (n_managers, len(windows)) int64 array}, 0 for managers not filing that quarter
+    """
+    windows = sorted(windows)
+    qtrs = sorted(quarters)
+    filing = np.array([quarters[q]['rows'] > 0 for q in qtrs])
+    rank = np.cumsum(filing, axis=0)
+    pattern = []
+    for q in qtrs:
+        matrix = quarters[q]['shares'].copy()
+        matrix.data = np.ones_like(matrix.data)
+        pattern.append(matrix)
+    edges = np.array([0] + windows)
+
+    result = {}
+    for t, qtr in enumerate(qtrs):
+        bands = [None] * len(windows)
+        for q in range(t, -1, -1):
+            distance = rank[t] - rank[q]
+            current = filing[t] & (distance < windows[-1])
+            if not current.any():
+                break
+            band = np.searchsorted(edges, distance, side='right') - 1
+            for i in range(len(windows)):
+                rows = current & filing[q] & (band == i)
+                if rows.any():
+                    part = pattern[q].multiply(rows[:, None]).tocsr()
+                    bands[i] = part if bands[i] is None else bands[i] + part
+        counts = np.zeros((len(filing[t]), len(windows)), dtype='int64')
+        union = None
+        for i, part in enumerate(bands):
+            if part is not None:
+                union = part if union is None else union + part
+            if union is not None:
+                union.eliminate_zeros()
+                counts[:, i] = np.diff(union.indptr)
+        result[qtr] = counts
+    return result
+
+
+def manager_quarter_table(managers, quarters, windows=None):
+    """
+    windows: {column name: look-back in quarters}, default {'universe': 12}
+    Returns:
+        tuple: managers (Qtr, manager columns, AUM, stocks, type, universe columns) and market (Qtr, market_val),
+        as df_constructor.manager_quarter_cube
+    """
+    windows = windows or {'universe': 12}
+    universes = rolling_universes(quarters, sorted(set(windows.values())))
+    lengths = sorted(set(windows.values()))
+
+    frames, market = [], []
+    for qtr in sorted(quarters):
+        quarter = quarters[qtr]
+        filed = np.flatnonzero(quarter['rows'] > 0)
+        frame = managers.iloc[filed].reset_index(drop=True)
+        frame.insert(0, 'Qtr', pd.PeriodIndex([qtr] * len(filed), freq='Q'))
+        frame['AUM'] = manager_aum(quarter)[filed]
+        frame['stocks'] = stocks_held(quarter)[filed].astype('int64')
+        frame['type'] = quarter['typecode'][filed]
+        for column, window in windows.items():
+            frame[column] = universes[qtr][filed, lengths.index(window)]
+        frames.append(frame)
+        held = ~np.isnan(quarter['price'])
+        market.append((qtr, (quarter['price'][held] * quarter['shrout'][held] * 1000000).sum()))
+
+    columns = ['Qtr'] + list(managers.columns) + ['AUM', 'stocks', 'type'] + list(windows)
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    market = pd.DataFrame({'Qtr': pd.PeriodIndex([q for q, _ in market], freq='Q'),
+                           'market_val': [v for _, v in market]})
+    return table, market
+
+
+def stats_by_type(managers, quarters):
+    """
+    Average position value, total AUM and number of managers by quarter end ('fdate') and typecode, pivoted
+    as construct_stats' create_avg_aum_df / create_aum_df / create_mgrs_df; like their mean, the average only
+    counts the positions with a value (NaN for a manager with none, left out of the sum by type)
+    Returns:
+        tuple: three DataFrames indexed by fdate, one column per typecode
+    """
+    rows = []
+    for qtr in sorted(quarters):
+        quarter = quarters[qtr]
+        filed = np.flatnonzero(quarter['rows'] > 0)
+        aum = manager_aum(quarter)[filed]
+        valued = quarter['valued'][filed]
+        rows.append(pd.DataFrame({
+            'fdate': qtr.end_time.normalize(),
+            'typecode': quarter['typecode'][filed],
+            'avg': np.divide(aum, valued, out=np.full(len(filed), np.nan), where=valued > 0),
+            'AUM': aum,
+        }))
+    long = pd.concat(rows, ignore_index=True).groupby(['fdate', 'typecode'])
+    by_type = long.agg(avg=('avg', 'sum'), AUM=('AUM', 'sum'), managers=('AUM', 'size')).reset_index()
+    return tuple(by_type.pivot_table(index='fdate', columns='typecode', values=column)
+                 for column in ('avg', 'AUM', 'managers'))
+
+
+def save_holdings_matrices(managers, cusips, quarters, directory):
+    """
+    Writes managers.parquet, cusips.parquet and one <Qtr>.npz per quarter (CSR arrays and vectors) to directory
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    managers.to_parquet(directory / "managers.parquet", index=False)
+    pd.DataFrame({'cusip': cusips}).to_parquet(directory / "cusips.parquet", index=False)
+    for qtr, quarter in quarters.items():
+        matrix = quarter['shares']
+        np.savez_compressed(directory / f"{qtr}.npz", data=matrix.data, indices=matrix.indices,
+                            indptr=matrix.indptr, shape=np.array(matrix.shape),
+                            **{name: quarter[name] for name in VECTORS})
+
+
+def load_holdings_matrices(directory):
+    """
+    Returns: (managers, cusips, quarters) written by save_holdings_matrices
+    """
+    directory = Path(directory)
+    managers = pd.read_parquet(directory / "managers.parquet")
+    cusips = pd.Index(pd.read_parquet(directory / "cusips.parquet")['cusip'])
+    quarters = {}
+    for path in sorted(directory.glob("*.npz")):
+        with np.load(path) as arrays:
+            quarter = {name: arrays[name] for name in VECTORS}
+            quarter['shares'] = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                              shape=tuple(arrays['shape']))
+        quarters[pd.Period(path.stem, freq='Q')] = quarter
+    return managers, cusips, quarters
@@ -0,0 +1,113 @@
+"""
+Compact dtypes for the 13F holdings panel, shared by the pulls, load_13f and clean_data
+
+- mgrno as int32, typecode as int8 (nullable Int8 before cleaning, since raw typecodes can be missing)
+- the cleaned panel adds the int32 manager surrogate key mgr_key (see manager_dim)
+- mgrname, cusip, stkcd and exchcd as categoricals (dictionary-encoded in Parquet)
+- shares/prc optionally float32, where the round trip is exact for share counts and within half a cent for
+    prices (FLOAT32_ATOL); a column that would lose precision stays float64, with a warning
+
+Functions:
+- coerce_holdings(df, float32): Casts a holdings frame to the compact dtypes
+- coerce_mutual_fund(df): Casts the mutual fund mapping so it joins on int32 manager numbers
+- canonical_categories(df, columns): Drops unused categories and sorts the rest
+- manager_columns(df): Columns identifying a manager (mgr_key when present, else mgrno and mgrname)
+"""
+
+
+import warnings
+
+import numpy as np
+
+import config
+
+HOLDINGS_DTYPES = {
+    'mgrno': 'int32',
+    'mgrname': 'category',
+    'typecode': 'Int8',
+    'cusip': 'category',
+    'shares': 'float64',
+    'prc': 'float64',
+    'shrout1': 'float64',
+    'stkcd': 'category',
+    'exchcd': 'category',
+}
+
+CLEANED_DTYPES = dict(HOLDINGS_DTYPES, mgr_key='int32', typecode='int8')
+
+FLOAT32_COLUMNS = ['shares', 'prc']
+# Largest change the float32 round trip may make to a value: share counts must stay exact (float32 holds
+# every integer up to 2**24 only), prices may move by less than half a cent
+FLOAT32_ATOL = {'shares': 0.0, 'prc': 0.005}
+
+DICTIONARY_COLUMNS = ['mgrname', 'cusip', 'stkcd', 'exchcd']
+
+PARQUET_OPTIONS = {
+    'compression': 'zstd',
+    'use_dictionary': DICTIONARY_COLUMNS,
+    'write_statistics': True,
+    'row_group_size': 500_000,
+}
+
+
+def float32_error(series):
+    """
+    Returns: largest change storing series as float32 makes to a value, NaNs ignored
+    """
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    rounded = values.astype('float32').astype('float64')
+    return np.nanmax(np.abs(rounded - values), initial=0.0)
+
+
+def coerce_holdings(df, float32=None, dtypes=HOLDINGS_DTYPES):
+    """
+    Casts the columns of a holdings frame that are present to the compact dtypes
+    float32: hold shares/prc as float32, HOLDINGS_FLOAT32 (read when called) by default
+    Returns:
+        DataFrame: cast frame (columns already typed are not copied)
+    """
+    if float32 is None:
+        float32 = config.HOLDINGS_FLOAT32
+    # Columns already held as float32 stay so when float32 is on
+    kept = FLOAT32_COLUMNS if float32 else []
+    casts = {column: dtype for column, dtype in dtypes.items()
+             if column in df.columns and df[column].dtype != dtype
+             and not (column in kept and df[column].dtype == 'float32')}
+    if float32:
+        for column in FLOAT32_COLUMNS:
+            if column in df.columns and df[column].dtype != 'float32':
+                error = float32_error(df[column])
+                if error > FLOAT32_ATOL[column]:
+                    warnings.warn(f"'{column}' kept as float64: a value would move by {error:g} as float32 "
+                                  f"(more than {FLOAT32_ATOL[column]:g})")
+                    continue
+                casts[column] = 'float32'
+    if not casts:
+        return df
+    return df.astype(casts, copy=False)
+
+
+def coerce_mutual_fund(df):
+    """
+    Casts the mutual fund mapping's manager numbers to the holdings' int32
+    """
+    return df.astype({'mgrcocd': 'int32'}, copy=False)
+
+
+def canonical_categories(df, columns=('mgrname', 'cusip')):
+    """
+    Drops unused categories and sorts the remaining ones, so frames holding the same rows
+    compare (and hash) equal no matter which reader built their categoricals
+    """
+    for column in columns:
+        categories = df[column].cat.remove_unused_categories().cat.categories
+        df[column] = df[column].cat.set_categories(categories.sort_values())
+    return df
+
+
+def manager_columns(df):
+    """
+    Returns: columns that identify a manager in df, the int32 surrogate key mgr_key of cleaned panels
+    when present, else the (mgrno, mgrname) pair
+    """
+    return ['mgr_key'] if 'mgr_key' in df.columns else ['mgrno', 'mgrname']
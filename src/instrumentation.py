@@ -0,0 +1,238 @@
+"""
+Per-stage timing and memory instrumentation of the pipeline
+
+- stage(name) (a context manager) and profiled(name) (a decorator) record the wall time, CPU time, peak RSS
+    and rows in / out of a named stage; stages nest, each record keeps the name of its parent
+- Stages are only recorded inside profile_run(name), which the entry points (construct_full_report, the
+    pipeline stages, the pulls) open around a whole run and which writes every record to
+    output/profiles/<run>-<timestamp>.json when the run ends; outside a run both are close to free
+- Peak RSS is per stage on Linux, where the high-water mark is reset when a stage starts
+    (/proc/self/clear_refs); elsewhere it is the process peak so far. The reset is process-wide, so it is
+    skipped for stages on worker threads (the pull shards) and while any of them runs: those records have
+    peak_rss_scope 'process' instead of 'stage'. Where neither /proc nor the resource module exists (Windows)
+    peak RSS is not tracked and recorded as None. CPU time and memory only cover this process, so work done
+    in process pools (BUILD_WORKERS, FIGURE_WORKERS) shows up as wall time only
+- The stage named by PROFILE_STAGE (in .env) also runs under cProfile, dumped next to the JSON as
+    <run>-<timestamp>-<stage>.prof (pstats format: python -m pstats, snakeviz or flameprof for a flame graph)
+
+Functions:
+- profile_run(name, out_dir, profile_stage): Collects the stages of a run and writes its profile
+- stage(name, rows_in): Records one stage; the yielded dict takes rows_out (and anything else worth keeping)
+- profiled(name): Decorator recording a function as a stage, with the rows of its first argument and result
+- load_profile(path): The stage records of a profile as a DataFrame
+- rss_peak_mb(): High-water mark of this process' RSS in MB, None where it cannot be read
+"""
+
+
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Windows: no peak RSS tracking
+    resource = None
+
+import config
+from atomic_io import atomic_write
+
+PROFILE_DIR = Path(config.OUTPUT_DIR) / "profiles"
+PROFILE_RUNS = config.PROFILE_RUNS
+PROFILE_STAGE = config.PROFILE_STAGE
+
+_STATUS = Path("/proc/self/status")
+_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+_run = None
+_run_lock = threading.Lock()
+_local = threading.local()
+# Open stages per thread, so no thread resets the high-water mark while another thread is inside a stage
+_open_stages = {}
+
+
+def rss_peak_mb():
+    """
+    Returns: high-water mark of this process' RSS in MB (VmHWM on Linux, else ru_maxrss, which is in kB on
+    Linux and bytes on macOS), None without either
+    """
+    try:
+        return int(re.search(r"VmHWM:\s+(\d+)", _STATUS.read_text()).group(1)) / 1024
+    except (OSError, AttributeError):
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _max_mb(*values):
+    """
+    Returns: the largest of the peaks that are known, None if none is
+    """
+    known = [value for value in values if value is not None]
+    return max(known) if known else None
+
+
+def _reset_rss_peak():
+    """
+    Resets the RSS high-water mark to the current RSS where the kernel allows it
+    Returns:
+        bool: whether it was reset
+    """
+    try:
+        _CLEAR_REFS.write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rows(value):
+    """
+    Returns: rows of a DataFrame, or summed over a tuple / list / dict of them, None for anything else
+    """
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)) and value and all(isinstance(v, pd.DataFrame) for v in value):
+        return sum(len(v) for v in value)
+    return None
+
+
+@contextmanager
+def profile_run(name, out_dir=PROFILE_DIR, profile_stage=PROFILE_STAGE, enabled=PROFILE_RUNS):
+    """
+    Records the stages run inside the block and writes them to out_dir/<name>-<timestamp>.json at the end
+    (also when the block raises, with the error). A run opened inside another run is part of the outer one
+    Yields:
+        dict: the run, or None when profiling is off or another run is active
+    """
+    global _run
+    with _run_lock:
+        if not enabled or _run is not None:
+            run = None
+        else:
+            started = datetime.now()
+            run = _run = {
+                'run': name,
+                'started': started.isoformat(timespec='seconds'),
+                'pid': os.getpid(),
+                'peak_rss_per_stage': _reset_rss_peak(),
+                'profile_stage': profile_stage or None,
+                'stages': [],
+                'path': Path(out_dir) / f"{name}-{started.strftime('%Y%m%dT%H%M%S')}",
+            }
+    if run is None:
+        yield None
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield run
+    except BaseException as exc:
+        error = repr(exc)
+        raise
+    finally:
+        with _run_lock:
+            _run = None
+        path = run.pop('path')
+        run.update(wall_seconds=time.perf_counter() - wall, cpu_seconds=time.process_time() - cpu,
+                   peak_rss_mb=_max_mb(rss_peak_mb(), *[s['peak_rss_mb'] for s in run['stages']]), error=error)
+        atomic_write(path.with_name(path.name + ".json"), lambda tmp_path: tmp_path.write_text(json.dumps(run, indent=2, default=str)))
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Records a stage of the active run: wall and CPU seconds, peak RSS (MB), rows_in and the rows_out set on
+    the yielded dict; runs it under cProfile if it is the run's profile_stage
+    Yields:
+        dict: the stage record (a throwaway dict outside a run)
+    """
+    run = _run
+    record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+    if run is None:
+        yield record
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    record['parent'] = stack[-1]['name'] if stack else None
+    thread = threading.get_ident()
+    with _run_lock:
+        reset = (run['peak_rss_per_stage'] and threading.current_thread() is threading.main_thread()
+                 and not any(n for t, n in _open_stages.items() if t != thread))
+        _open_stages[thread] = _open_stages.get(thread, 0) + 1
+    record['peak_rss_scope'] = 'stage' if reset else 'process'
+    # Parents keep the peak reached so far before the high-water mark is reset for this stage
+    peak = rss_peak_mb()
+    for parent in stack:
+        parent['peak_rss_mb'] = _max_mb(parent['peak_rss_mb'], peak)
+    if reset:
+        _reset_rss_peak()
+    record['peak_rss_mb'] = None
+    stack.append(record)
+
+    profiler = None
+    if name == run['profile_stage'] and not getattr(_local, 'profiling', False):
+        profiler, _local.profiling = cProfile.Profile(), True
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _local.profiling = False
+            path = run['path']
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path.with_name(f"{path.name}-{name}.prof"))
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        stack.pop()
+        record['peak_rss_mb'] = _max_mb(record['peak_rss_mb'], rss_peak_mb())
+        for parent in stack:
+            parent['peak_rss_mb'] = _max_mb(parent['peak_rss_mb'], record['peak_rss_mb'])
+        with _run_lock:
+            run['stages'].append(record)
+            _open_stages[thread] -= 1
+            if not _open_stages[thread]:
+                del _open_stages[thread]
+
+
+def profiled(name=None):
+    """
+    Decorator recording every call of a function as a stage (named after the function by default), with the
+    rows of its first argument and of its result when those are DataFrames (or tuples / dicts of them)
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _run is None:
+                return func(*args, **kwargs)
+            with stage(stage_name, _rows(args[0]) if args else None) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def load_profile(path):
+    """
+    Returns: the stage records of a profile written by profile_run, one row per stage in the order they ended
+    """
+    return pd.DataFrame(json.loads(Path(path).read_text())['stages'])
@@ -0,0 +1,244 @@
+"""
+Manager dimension table for the typecode reclassification in clean_data
+
+The final typecode of a holding only depends on its manager (mgrno, mgrname) and quarter, so it is
+worked out once per manager and per manager-quarter instead of by merging onto every holding row:
+
+- managers: one row per manager key with its pre-Dec-1998 typecode, most recent typecode and pension fund flag
+- quarters: one row per (manager key, fdate) with the mutual fund flag and the final typecode
+
+Managers are identified by a stable int32 surrogate key (mgr_key) kept in data/derived/manager_keys.parquet;
+new (mgrno, mgrname) pairs get the next free key when they are first cleaned. The table is updated under a
+file lock (manager_keys.parquet.lock), so parallel cleans in other processes or doit workers don't hand out
+the same key twice.
+
+Functions:
+- register_managers(df, data_dir): Adds the managers of df to the key lookup table, returns the table
+- manager_keys(df, managers): mgr_key of every row of df, by integer look-up of (mgrno, mgrname) in a
+    (mgr_key, mgrno, mgrname) table such as the lookup table
+- build_manager_dim(history, holdings, df_mf, pf_names, lookup): Builds both tables from narrow (fdate, mgrno, mgrname, typecode) frames
+- manager_typecodes(df, managers, quarters): Final typecode of every holding row, by integer-key gather
+- save_manager_dim / load_manager_dim: Persist the tables as Parquet
+"""
+
+
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from atomic_io import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only threads of one process are kept apart
+    fcntl = None
+
+TYPECODE_CUTOFF = pd.Timestamp('1998-12-01')
+MF_START = pd.Timestamp('1994-03-31')
+
+_lookup_lock = threading.Lock()
+
+
+def _name_positions(names, vocabulary):
+    """
+    Position of each (categorical) name in vocabulary, -1 for nulls and unknown names
+    """
+    codes = names.cat.codes.to_numpy()
+    positions = pd.Index(vocabulary).get_indexer(names.cat.categories)
+    return np.where(codes >= 0, positions[codes], -1)
+
+
+def _combined(mgrno, name_pos, n_names):
+    return mgrno.astype('int64') * (n_names + 1) + (name_pos + 1)
+
+
+def manager_keys(df, managers):
+    """
+    Manager key of each row of df, -1 where (mgrno, mgrname) is not in managers (ie. null names)
+    """
+    vocabulary = managers['mgrname'].cat.categories
+    lookup = _combined(managers['mgrno'].to_numpy(), _name_positions(managers['mgrname'], vocabulary), len(vocabulary))
+    order = np.argsort(lookup)
+    lookup = lookup[order]
+
+    if not len(lookup):
+        return np.full(len(df), -1, dtype='int32')
+    name_pos = _name_positions(df['mgrname'], vocabulary)
+    combined = _combined(df['mgrno'].to_numpy(), name_pos, len(vocabulary))
+    pos = np.minimum(np.searchsorted(lookup, combined), len(lookup) - 1)
+    found = (name_pos >= 0) & (lookup[pos] == combined)
+    return np.where(found, managers['mgr_key'].to_numpy()[order][pos], -1).astype('int32')
+
+
+def reclassify(typecode, mf, pf):
+    """
+    Final typecode from the manager's most recent 13F typecode and its mutual/pension fund flags:
+    banks (1) and insurers (2) stay, mutual funds become 4, investment advisors (3, 4) become 3,
+    pension funds among 3/4/5 become 5, everything else 6
+    """
+    typecode = pd.array(typecode, dtype='Int8').to_numpy(dtype='float64', na_value=np.nan)
+    new_typecode = np.full(len(typecode), 6, dtype='int8')
+    new_typecode[typecode == 1] = 1
+    new_typecode[typecode == 2] = 2
+    new_typecode[mf] = 4
+    new_typecode[np.isin(typecode, [3, 4])] = 3
+    new_typecode[np.isin(typecode, [3, 4, 5]) & pf] = 5
+    return new_typecode
+
+
+def build_manager_dim(history, holdings, df_mf, pf_names, lookup=None):
+    """
+    history: (fdate, mgrno, mgrname, typecode) rows before TYPECODE_CUTOFF, sorted by fdate
+    holdings: the same columns for the period being cleaned, sorted by fdate
+    df_mf: mutual fund mapping (fdate, mgrcocd) up to the end of the period
+    pf_names: pension fund names
+    lookup: manager key lookup table (see register_managers) holding every manager of holdings;
+        without one the managers are numbered 0, 1, ... in order of appearance
+    Returns:
+        (managers, quarters) DataFrames
+    """
+    keys = ['mgrno', 'mgrname']
+    named = holdings[holdings['mgrname'].notna()]
+    managers = named[keys].drop_duplicates(ignore_index=True)
+    managers['mgrname'] = managers['mgrname'].cat.remove_unused_categories()
+    # Positions in managers are used for the look-ups below, the stable keys only in the output
+    positions = managers.assign(mgr_key=np.arange(len(managers), dtype='int32'))
+    stable_keys = manager_keys(managers, lookup) if lookup is not None else positions['mgr_key'].to_numpy()
+    if (stable_keys < 0).any():
+        raise ValueError("build_manager_dim: some managers are missing from the key lookup table")
+    managers.insert(0, 'mgr_key', stable_keys)
+
+    # Last typecode before Dec 1998, for managers that also file in the period
+    correct = history.groupby(keys, observed=True)['typecode'].last().reset_index()
+    correct_pos = manager_keys(correct, positions)
+    known = correct_pos >= 0
+    typecode_correct = pd.Series(correct['typecode'].array[known], index=correct_pos[known], dtype='Int8') \
+        .reindex(np.arange(len(managers))).array
+    managers['typecode_correct'] = typecode_correct
+
+    # From Dec 1998 on the filed typecode is replaced by the pre-Dec-1998 one where there is one,
+    # then the last non-null typecode of each manager is kept
+    row_pos = manager_keys(holdings, positions)
+    valid = row_pos >= 0
+    typecode = holdings['typecode'].array.astype('Int8', copy=True)
+    row_correct = typecode_correct.take(np.where(valid, row_pos, 0))
+    replace = (holdings['fdate'].to_numpy() >= TYPECODE_CUTOFF) & valid & ~row_correct.isna()
+    typecode[replace] = row_correct[replace]
+    recent = pd.Series(typecode[valid]).groupby(row_pos[valid]).last()
+    managers['typecode_recent'] = recent.reindex(np.arange(len(managers))).array.astype('Int8')
+    managers['pf'] = managers['mgrname'].isin(pf_names).to_numpy()
+
+    quarters = pd.DataFrame({'position': row_pos[valid], 'fdate': holdings['fdate'].to_numpy()[valid]}).drop_duplicates(ignore_index=True)
+    manager_of = quarters.pop('position').to_numpy()
+    quarters.insert(0, 'mgr_key', stable_keys[manager_of])
+    mf_pairs = pd.MultiIndex.from_frame(df_mf[['mgrcocd', 'fdate']].drop_duplicates())
+    fdate_temp = quarters['fdate'].where(quarters['fdate'] >= MF_START, MF_START)
+    mgrno = managers['mgrno'].to_numpy()[manager_of]
+    quarters['mf'] = pd.MultiIndex.from_arrays([mgrno, fdate_temp]).isin(mf_pairs)
+
+    quarters['typecode'] = reclassify(managers['typecode_recent'].array[manager_of], quarters['mf'].to_numpy(),
+                                      managers['pf'].to_numpy()[manager_of])
+    return managers, quarters
+
+
+def manager_typecodes(df, managers, quarters, row_key=None):
+    """
+    Final typecode of every row of df from the dimension tables, -1 for rows whose manager has no key
+    One gather per row: (manager key, fdate index) -> position in a dense manager x fdate array
+    row_key: manager key of each row, if already looked up with manager_keys
+    """
+    fdates = np.sort(quarters['fdate'].unique())
+    n_keys = int(managers['mgr_key'].max()) + 1 if len(managers) else 0
+    dense = np.full(n_keys * len(fdates), -1, dtype='int8')
+    dense[quarters['mgr_key'].to_numpy().astype('int64') * len(fdates)
+          + np.searchsorted(fdates, quarters['fdate'].to_numpy())] = quarters['typecode'].to_numpy()
+
+    if row_key is None:
+        row_key = manager_keys(df, managers)
+    row_fdate = np.minimum(np.searchsorted(fdates, df['fdate'].to_numpy()), max(len(fdates) - 1, 0))
+    typecode = np.full(len(df), -1, dtype='int8')
+    valid = (row_key >= 0) & (fdates[row_fdate] == df['fdate'].to_numpy()) if len(fdates) else np.zeros(len(df), dtype=bool)
+    typecode[valid] = dense[row_key[valid].astype('int64') * len(fdates) + row_fdate[valid]]
+    return typecode
+
+
+def lookup_path(data_dir):
+    """
+    Returns: path of the manager key lookup table
+    """
+    return Path(data_dir) / "derived" / "manager_keys.parquet"
+
+
+def load_lookup(data_dir):
+    """
+    Returns: manager key lookup table (mgr_key, mgrno, mgrname), empty if none was written yet
+    """
+    path = lookup_path(data_dir)
+    if path.exists():
+        return pd.read_parquet(path)
+    return pd.DataFrame({'mgr_key': pd.Series(dtype='int32'), 'mgrno': pd.Series(dtype='int32'),
+                         'mgrname': pd.Series(dtype='category')})
+
+
+@contextmanager
+def _locked_lookup(data_dir):
+    """
+    Holds the lookup table lock of this process and, where fcntl is available, an exclusive file lock
+    shared with other processes
+    """
+    path = lookup_path(data_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _lookup_lock, open(path.with_name(path.name + ".lock"), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def register_managers(df, data_dir):
+    """
+    Gives every named (mgrno, mgrname) pair of df that has no key yet the next free int32 key and
+    saves the lookup table. Keys are never changed or reused, so they stay valid in anything
+    written with them
+    Returns:
+        DataFrame: the updated lookup table
+    """
+    with _locked_lookup(data_dir):
+        lookup = load_lookup(data_dir)
+        pairs = df.loc[df['mgrname'].notna(), ['mgrno', 'mgrname']].drop_duplicates()
+        new = pairs[manager_keys(pairs, lookup) < 0]
+        if new.empty:
+            return lookup
+        new = new.astype({'mgrname': 'object'}).sort_values(['mgrno', 'mgrname'])
+        first = int(lookup['mgr_key'].max()) + 1 if len(lookup) else 0
+        new.insert(0, 'mgr_key', np.arange(first, first + len(new), dtype='int32'))
+        lookup = pd.concat([lookup.astype({'mgrname': 'object'}), new], ignore_index=True)
+        lookup = lookup.astype({'mgr_key': 'int32', 'mgrno': 'int32', 'mgrname': 'category'})
+
+        atomic_write(lookup_path(data_dir), lambda tmp_path: lookup.to_parquet(tmp_path, index=False))
+        return lookup
+
+
+def save_manager_dim(managers, quarters, directory):
+    """
+    Writes the dimension tables to directory/managers.parquet and directory/quarters.parquet
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    managers.to_parquet(directory / "managers.parquet", index=False)
+    quarters.to_parquet(directory / "quarters.parquet", index=False)
+
+
+def load_manager_dim(directory):
+    """
+    Returns: (managers, quarters) written by save_manager_dim
+    """
+    directory = Path(directory)
+    return pd.read_parquet(directory / "managers.parquet"), pd.read_parquet(directory / "quarters.parquet")
@@ -0,0 +1,167 @@
+"""
+Stages of the report, each reading the artifacts of the stages before it from data/derived/report/ and
+writing its own, so dodo.py can skip every stage whose inputs did not change (python src/pipeline.py <stage> [name])
+
+- clean <range>: cleans the range through the content-addressed cache and records the panel's key in
+    clean_<range>.json, which only changes when the cleaned panel does
+- cube <range>: manager-quarter and market tables over the range's periods, in cube_<range>/
+- d1 <range>: Table D1 of each period of the range, d1_<range>.parquet
+- stats: construct_stats tables of the old range, stats_<figure>.parquet
+- plot: output/<figure>.png of every figure from its stats table, through render_figures (only the figures
+    whose stats changed are redrawn, in a process pool)
+- latex: output/full_report.tex from the D1 tables and figures
+
+Heavy modules (plotting, LaTeX) are imported inside the stages, so dodo.py can import this module cheaply.
+Each stage run from the command line writes its profile to output/profiles/ (see instrumentation).
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+import config
+from atomic_io import atomic_write
+from instrumentation import profile_run
+
+DATA_DIR = Path(config.DATA_DIR)
+OUTPUT_DIR = Path(config.OUTPUT_DIR)
+REPORT_DIR = DATA_DIR / "derived" / "report"
+
+periods_old = [('1980-01-01','1984-12-31'),
+               ('1985-01-01','1989-12-31'),
+               ('1990-01-01','1994-12-31'),
+               ('1995-01-01','1999-12-31'),
+               ('2000-01-01','2004-12-31'),
+               ('2005-01-01','2009-12-31'),
+               ('2010-01-01','2014-12-31'),
+               ('2015-01-01','2017-12-31')]
+
+periods_new = [('2018-01-01','2022-12-31'),
+               ('2023-01-01','2023-12-31')]
+
+range_old = ('1980-01-01','2017-12-31')
+range_new = ('2014-01-01','2023-12-31')
+
+# Cleaned range and Table D1 periods of each part of the report
+RANGES = {'old': (range_old, periods_old), 'new': (range_new, periods_new)}
+
+# Figure name: (value name, title, condensed axis labels), in the order of the report
+FIGURES = {
+    'avg_aum': ('Average AUM', 'Average AUM Over Time', False),
+    'aum': ('AUM', 'AUM Over Time', True),
+    'mgrs': ('UniqueMgrCounts', 'Managers Over Time', False),
+}
+
+
+def artifact(name):
+    """
+    Returns: path of an intermediate artifact of the report
+    """
+    return REPORT_DIR / name
+
+
+def _write_parquet(df, path):
+    atomic_write(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+
+def save_d1(dfs, path):
+    """
+    Writes a dict of D1 tables (period tuple -> table indexed by type) as one Parquet file
+    """
+    frames = [df.reset_index().assign(start=start, end=end) for (start, end), df in dfs.items()]
+    _write_parquet(pd.concat(frames, ignore_index=True), path)
+
+
+def load_d1(path):
+    """
+    Returns: the dict of D1 tables written by save_d1, in period order
+    """
+    df = pd.read_parquet(path)
+    return {(start, end): group.drop(columns=['start', 'end']).set_index('type')
+            for (start, end), group in df.groupby(['start', 'end'], sort=False)}
+
+
+def clean_stage(name):
+    """
+    Cleans a range (or finds it in the cache) and records the key of its cleaned panel
+    """
+    import clean_cache
+
+    period = RANGES[name][0]
+    clean_cache.cached_clean_data(period, DATA_DIR)
+    record = json.dumps({'period': list(period), 'key': clean_cache.cache_key(period, DATA_DIR)})
+    atomic_write(artifact(f"clean_{name}.json"), lambda tmp_path: tmp_path.write_text(record))
+
+
+def cube_stage(name):
+    """
+    Writes the manager-quarter cube of a range's periods
+    """
+    import clean_cache
+    import df_constructor
+
+    period, periods = RANGES[name]
+    managers, market = clean_cache.cached_cube(period, DATA_DIR, cube_range=(periods[0][0], periods[-1][1]))
+    df_constructor.save_cube(managers, market, artifact(f"cube_{name}"))
+
+
+def d1_stage(name):
+    """
+    Rolls a range's cube up into its D1 tables
+    """
+    import df_constructor
+
+    managers, market = df_constructor.load_cube(artifact(f"cube_{name}"))
+    save_d1(df_constructor.rollup_periods(managers, market, RANGES[name][1]), artifact(f"d1_{name}.parquet"))
+
+
+def stats_stage():
+    """
+    Writes the three construct_stats tables of the old range
+    """
+    import clean_cache
+    from construct_stats import construct_stats
+
+    stats = construct_stats(clean_cache.cached_clean_data(range_old, DATA_DIR))
+    for figure, df in zip(FIGURES, stats):
+        _write_parquet(df, artifact(f"stats_{figure}.parquet"))
+
+
+def plot_stage():
+    """
+    Draws the figures whose stats tables changed since they were last drawn
+    """
+    from construct_stats import render_figures
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    render_figures([(pd.read_parquet(artifact(f"stats_{figure}.parquet")), value_name, title, f"{figure}.png", condense)
+                    for figure, (value_name, title, condense) in FIGURES.items()],
+                   backend=config.FIGURE_BACKEND, out_dir=OUTPUT_DIR)
+
+
+def latex_stage():
+    """
+    Assembles the LaTeX report from the D1 tables and the figures
+    """
+    from dfs_to_latex import df_to_latex_with_md_and_plots
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    df_to_latex_with_md_and_plots(load_d1(artifact("d1_old.parquet")), load_d1(artifact("d1_new.parquet")),
+                                  [f"{figure}.png" for figure in FIGURES], Path(config.BASE_DIR / "README.md"),
+                                  "full_report.tex")
+
+
+STAGES = {
+    'clean': clean_stage,
+    'cube': cube_stage,
+    'd1': d1_stage,
+    'stats': stats_stage,
+    'plot': plot_stage,
+    'latex': latex_stage,
+}
+
+if __name__ == '__main__':
+    with profile_run("-".join(["pipeline"] + sys.argv[1:])):
+        STAGES[sys.argv[1]](*sys.argv[2:])
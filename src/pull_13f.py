@@ -2,6 +2,12 @@
 Module for fetching and storing data from WRDS
 
 - 13F data retrieval, using docs from https://wrds-www.wharton.upenn.edu/data-dictionary/tr_13f/s34/
+- pull_13f_partitioned streams the pull one quarter at a time into data/pulled/13f/fdate=YYYY-QQ/,
+    so peak memory is bounded by a single quarter rather than the full 1980-2024 panel
+- refresh_13f only pulls quarters after the watermark in data/pulled/manifest.json (plus a look-back)
+- Quarters are pulled in parallel over a bounded pool of connections (see pull_engine)
+- prefiltered=True applies the clean_data row filters (stkcd, exchcd) in SQL and drops those columns;
+    the partitions are tagged with pulled_data.PREFILTERED_SCHEMA_VERSION so clean_data skips re-filtering
 """
 
 
@@ -11,11 +17,42 @@ import numpy as np
 import wrds
 
 import config
+import pulled_data
+from pull_engine import run_sharded_pull
+from instrumentation import profiled, profile_run
 from pathlib import Path
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
+PULL_WORKERS = config.PULL_WORKERS
+PULL_PREFILTERED = config.PULL_PREFILTERED
+
+SQL_13F = """
+    SELECT 
+        a.fdate, a.mgrno, a.mgrname,  a.typecode, a.cusip, a.shares, a.prc, a.shrout1, a.stkcd, a.exchcd
+
+    FROM 
+        tr_13f.s34 AS a
+    WHERE 
+        a.fdate BETWEEN  %(start_date)s AND %(end_date)s
+        AND a.prc IS NOT NULL 
+        AND a.shrout1 IS NOT NULL
+    """
+
+SQL_13F_PREFILTERED = """
+    SELECT 
+        a.fdate, a.mgrno, a.mgrname,  a.typecode, a.cusip, a.shares, a.prc, a.shrout1
+
+    FROM 
+        tr_13f.s34 AS a
+    WHERE 
+        a.fdate BETWEEN  %(start_date)s AND %(end_date)s
+        AND a.prc IS NOT NULL 
+        AND a.shrout1 IS NOT NULL
+        AND (a.stkcd = '0' OR a.stkcd IS NULL)
+        AND (a.exchcd IN ('A', 'B', 'V') OR a.exchcd IS NULL)
+    """
 
 
 def pull_13f(wrds_username=WRDS_USERNAME, start_date = '03/31/1980', end_date = '12/31/2024'):
@@ -27,30 +64,63 @@ def pull_13f(wrds_username=WRDS_USERNAME, start_date = '03/31/1980', end_date =
 
     my_params = {'start_date':start_date, 'end_date': end_date}
 
-    sql_query = """
-        SELECT 
-            a.fdate, a.mgrno, a.mgrname,  a.typecode, a.cusip, a.shares, a.prc, a.shrout1, a.stkcd, a.exchcd
-
-        FROM 
-            tr_13f.s34 AS a
-        WHERE 
-            a.fdate BETWEEN  %(start_date)s AND %(end_date)s
-            AND a.prc IS NOT NULL 
-            AND a.shrout1 IS NOT NULL
-        """
-
     db = wrds.Connection(wrds_username=wrds_username)
-    df_13f = db.raw_sql(sql_query, params = my_params, date_cols=["fdate"])
+    df_13f = db.raw_sql(SQL_13F, params = my_params, date_cols=["fdate"])
     db.close()
 
     return df_13f
 
+def wrds_connection_factory(wrds_username=WRDS_USERNAME):
+    """
+    Returns: function opening a new WRDS connection, for use with pull_engine
+    """
+    def connect():
+        return wrds.Connection(wrds_username=wrds_username)
+    return connect
+
+@profiled()
+def pull_13f_partitioned(wrds_username=WRDS_USERNAME, start_date = '03/31/1980', end_date = '12/31/2024', data_dir=DATA_DIR,
+                         workers=PULL_WORKERS, connection_factory=None, prefiltered=PULL_PREFILTERED):
+    """
+    Pulls the same columns as pull_13f, one quarter per query on `workers` parallel connections,
+    writing each quarter to its own partition as soon as it arrives and recording it in the manifest
+    connection_factory defaults to WRDS; pass another (ie. pull_engine.SQLiteConnection) to pull locally
+    prefiltered applies the clean_data row filters in SQL and leaves out stkcd/exchcd
+    Returns:
+        list: paths of the partitions written
+    """
+    if connection_factory is None:
+        connection_factory = wrds_connection_factory(wrds_username)
+    sql_query, schema = SQL_13F, pulled_data.SCHEMA_13F
+    if prefiltered:
+        sql_query, schema = SQL_13F_PREFILTERED, pulled_data.SCHEMA_13F_PREFILTERED
+
+    def write_quarter(df_13f, label):
+        path = None
+        if not df_13f.empty:
+            path = pulled_data.write_partition(df_13f, data_dir, "13f", label, schema=schema)
+        pulled_data.record_quarters(data_dir, "13f", [label])
+        return path
+
+    shards = pulled_data.quarter_ranges(start_date, end_date)
+    paths = run_sharded_pull(sql_query, shards, write_quarter, connection_factory, workers=workers)
+    return [path for path in paths.values() if path is not None]
+
+def refresh_13f(wrds_username=WRDS_USERNAME, start_date=config.PULL_START_DATE, end_date=config.PULL_END_DATE,
+                lookback=config.PULL_LOOKBACK_QUARTERS, data_dir=DATA_DIR, prefiltered=PULL_PREFILTERED):
+    """
+    Pulls only the quarters after the manifest watermark, re-pulling the last `lookback`
+    quarters for late amendments. Re-pulled quarters replace their partitions.
+    """
+    refresh_from = pulled_data.refresh_start(data_dir, "13f", start_date, lookback)
+    return pull_13f_partitioned(wrds_username=wrds_username, start_date=refresh_from, end_date=end_date, data_dir=data_dir,
+                                prefiltered=prefiltered)
+
 def load_13f(data_dir=DATA_DIR):
     """
-    Loads saved 13F data
+    Loads saved 13F data, from the partitioned dataset if present
     """
-    path = Path(data_dir) / "pulled" / "13f.parquet"
-    df_13f = pd.read_parquet(path)
+    df_13f = pulled_data.read_13f(Path(data_dir))
     return df_13f
 
 def _demo():
@@ -59,5 +129,5 @@ def _demo():
 if __name__ == "__main__":
     Path(DATA_DIR / "pulled").mkdir(parents=True, exist_ok=True)
 
-    comp = pull_13f(wrds_username=WRDS_USERNAME)
-    comp.to_parquet(DATA_DIR / "pulled" / "13f.parquet")
\ No newline at end of file
+    with profile_run("pull_13f"):
+        refresh_13f(wrds_username=WRDS_USERNAME)
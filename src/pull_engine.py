@@ -0,0 +1,129 @@
+"""
+Parallel, quarter-sharded pulls over a bounded pool of database connections
+
+- A connection is anything with raw_sql(sql, params=..., date_cols=...) and close(), ie. wrds.Connection
+- Connections come from a factory (a no-argument callable), so a local SQLite database loaded with
+    synthetic tr_13f.s34 rows can stand in for WRDS (see SQLiteConnection)
+- Each shard is retried with exponential backoff; a connection that raised is closed and replaced
+
+Functions:
+- run_sharded_pull(sql, shards, handle_shard, connection_factory, workers, retries, backoff):
+    Runs sql once per (label, start, end) shard on a thread pool, passing each result to handle_shard
+"""
+
+
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pandas as pd
+
+from instrumentation import profiled, stage
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of connections, opened lazily by connection_factory and reused across shards
+    """
+    def __init__(self, connection_factory, size):
+        self.connection_factory = connection_factory
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+        self._open = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        try:
+            if conn is None:
+                conn = self.connection_factory()
+                with self._lock:
+                    self._open.append(conn)
+            yield conn
+        except Exception:
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def _discard(self, conn):
+        if conn is None:
+            return
+        with self._lock:
+            if conn in self._open:
+                self._open.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            conns, self._open = self._open, []
+        for conn in conns:
+            conn.close()
+
+
+class SQLiteConnection:
+    """
+    Local stand-in for wrds.Connection backed by SQLite
+    databases maps schema names to database files, ie. {'tr_13f': 'synthetic.db'},
+    so queries written against WRDS (tr_13f.s34, %(name)s parameters) run unchanged
+    """
+    def __init__(self, databases):
+        # The pool hands a connection to one thread at a time, so cross-thread use is safe
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        for schema, path in databases.items():
+            self.conn.execute("ATTACH DATABASE ? AS " + schema, (str(path),))
+
+    def raw_sql(self, sql, params=None, date_cols=None):
+        sql = re.sub(r"%\((\w+)\)s", r":\1", sql)
+        return pd.read_sql_query(sql, self.conn, params=params, parse_dates=date_cols)
+
+    def close(self):
+        self.conn.close()
+
+
+def _pull_shard(pool, sql, shard, handle_shard, date_cols, retries, backoff):
+    label, start, end = shard
+    with stage("pull_shard") as record:
+        record['shard'] = label
+        for attempt in range(retries + 1):
+            record['attempts'] = attempt + 1
+            try:
+                with pool.connection() as db:
+                    df = db.raw_sql(sql, params={'start_date': start, 'end_date': end}, date_cols=date_cols)
+                record['rows_out'] = len(df)
+                return handle_shard(df, label)
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
+
+@profiled()
+def run_sharded_pull(sql, shards, handle_shard, connection_factory, workers=4, retries=3, backoff=1.0, date_cols=("fdate",)):
+    """
+    Runs sql (with %(start_date)s / %(end_date)s parameters) once per shard on a pool of
+    `workers` threads sharing `workers` connections
+    handle_shard(df, label) is called from the worker thread as each shard arrives
+    Returns:
+        dict: shard label -> return value of handle_shard
+    """
+    pool = ConnectionPool(connection_factory, workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                shard[0]: executor.submit(_pull_shard, pool, sql, shard, handle_shard, list(date_cols), retries, backoff)
+                for shard in shards
+            }
+            return {label: future.result() for label, future in futures.items()}
+    finally:
+        pool.close()
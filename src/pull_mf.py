@@ -2,43 +2,83 @@
 Module for fetching and storing data from WRDS
 
 - mutual fund mappings for 300 mutual funds, not described under categories in 13F.
+- refresh_mf_mapping only pulls quarters after the watermark in data/pulled/manifest.json (plus a look-back)
+    and merges them into Mutual_Fund.parquet
+- Quarters are pulled in parallel over a bounded pool of connections (see pull_engine)
 """
 
 
 import pandas as pd
 
 import numpy as np
-import wrds
 
 import config
+import pulled_data
+from atomic_io import atomic_write
+from holdings_schema import PARQUET_OPTIONS
+from pull_13f import wrds_connection_factory
+from pull_engine import run_sharded_pull
+from instrumentation import profiled, profile_run
 from pathlib import Path
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
+PULL_WORKERS = config.PULL_WORKERS
 
 
-def pull_mf_mapping(wrds_username=WRDS_USERNAME, start_date = '03/31/1980', end_date = '12/31/2024'):
-    """
-    Pulls a list of mutual funds (via WRDS) to check against (13F does not hold this distinction)
+SQL_MF = """
+    SELECT a.fdate, a.mgrcocd
+    FROM 
+        tr_mutualfunds.S12TYPE5 AS a
+    WHERE 
+        a.fdate BETWEEN %(start_date)s AND %(end_date)s
     """
 
-    my_params = {'start_date':start_date, 'end_date': end_date}
 
-    sql_query = """
-        SELECT a.fdate, a.mgrcocd
-        FROM 
-            tr_mutualfunds.S12TYPE5 AS a
-        WHERE 
-            a.fdate BETWEEN %(start_date)s AND %(end_date)s
-        """
+@profiled()
+def pull_mf_mapping(wrds_username=WRDS_USERNAME, start_date = '03/31/1980', end_date = '12/31/2024',
+                    workers=PULL_WORKERS, connection_factory=None):
+    """
+    Pulls a list of mutual funds (via WRDS) to check against (13F does not hold this distinction)
+    One query per quarter on `workers` parallel connections; the mapping is small, so quarters are concatenated
+    (an empty mapping when start_date is after end_date)
+    """
+    shards = pulled_data.quarter_ranges(start_date, end_date)
+    if not shards:
+        return pd.DataFrame({'fdate': pd.Series(dtype='datetime64[ns]'), 'mgrcocd': pd.Series(dtype='float64')})
+    if connection_factory is None:
+        connection_factory = wrds_connection_factory(wrds_username)
 
-    db = wrds.Connection(wrds_username=wrds_username)
-    df_mf = db.raw_sql(sql_query, params = my_params, date_cols=["fdate"])
-    db.close()
+    quarters = run_sharded_pull(SQL_MF, shards, lambda df, label: df, connection_factory, workers=workers)
+    df_mf = pd.concat(list(quarters.values()), ignore_index=True)
 
     return df_mf
 
+def refresh_mf_mapping(wrds_username=WRDS_USERNAME, start_date=config.PULL_START_DATE, end_date=config.PULL_END_DATE,
+                       lookback=config.PULL_LOOKBACK_QUARTERS, data_dir=DATA_DIR, connection_factory=None):
+    """
+    Pulls the mapping for quarters after the manifest watermark (less `lookback` quarters)
+    and replaces those quarters in Mutual_Fund.parquet; leaves it untouched when there is nothing new to pull
+    """
+    path = Path(data_dir) / "pulled" / "Mutual_Fund.parquet"
+    refresh_from = pulled_data.refresh_start(data_dir, "Mutual_Fund", start_date, lookback)
+    if not path.exists():
+        refresh_from = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    elif not pulled_data.quarter_ranges(refresh_from, end_date):
+        return pd.read_parquet(path)
+
+    df_new = pull_mf_mapping(wrds_username=wrds_username, start_date=refresh_from, end_date=end_date,
+                             connection_factory=connection_factory)
+    if refresh_from > pd.Timestamp(start_date).strftime('%Y-%m-%d'):
+        df_old = pd.read_parquet(path)
+        df_new = pd.concat([df_old[df_old['fdate'] < refresh_from], df_new], ignore_index=True)
+
+    df_new = df_new.sort_values('fdate', kind='stable', ignore_index=True)
+    atomic_write(path, lambda tmp_path: df_new.to_parquet(tmp_path, row_group_size=PARQUET_OPTIONS['row_group_size']))
+    pulled_data.record_quarters(data_dir, "Mutual_Fund", [label for label, _, _ in pulled_data.quarter_ranges(refresh_from, end_date)])
+    return df_new
+
 def load_Mutual_Fund(data_dir=DATA_DIR):
     """
     Loads saved MF data
@@ -53,5 +93,5 @@ def _demo():
 if __name__ == "__main__":
     Path(DATA_DIR / "pulled").mkdir(parents=True, exist_ok=True)
 
-    crsp = pull_mf_mapping(wrds_username=WRDS_USERNAME)
-    crsp.to_parquet(DATA_DIR / "pulled" / "Mutual_Fund.parquet")
+    with profile_run("pull_mf"):
+        crsp = refresh_mf_mapping(wrds_username=WRDS_USERNAME)
@@ -0,0 +1,309 @@
+"""
+On-disk layout for data pulled from WRDS
+
+- 13F holdings are stored as a Hive-style dataset with one partition per quarter,
+    ie. data/pulled/13f/fdate=1980-Q1/part-0.parquet
+- The older single-file layout (data/pulled/13f.parquet) is still read if no partitioned dataset exists
+- Columns use the compact dtypes of holdings_schema (int32 mgrno, int8 typecode, dictionary-encoded strings)
+- Each partition carries a schema_version in its Parquet metadata: '13f-raw-1' for the raw pull, or
+    '13f-prefiltered-1' when the clean_data row filters were applied in SQL and stkcd/exchcd dropped
+- data/pulled/manifest.json records which quarters of each dataset ('13f', 'Mutual_Fund') have been pulled,
+    so refreshes only fetch quarters after the high-water mark (plus a look-back for late amendments)
+
+Functions:
+- quarter_ranges(start_date, end_date): Splits a date range into calendar quarters
+- write_partition(df, data_dir, dataset, label): Writes one quarter of a dataset
+- read_13f(data_dir, columns, filter): Reads the 13F holdings from whichever layout is on disk, pushing the
+    column projection and row filter down to the Parquet reader
+- iter_13f_batches(data_dir, columns, filter, batch_size): Same as read_13f, streamed in bounded record batches
+- fdate_filter(start, end, before): Row filter on fdate, pruned against row-group statistics
+- holdings_filter(): The clean_data price / stock code / exchange code filters as a row filter
+- schema_version(data_dir): Schema version shared by every pulled 13F file
+- input_files(data_dir): The files clean_data reads
+- record_quarters(data_dir, dataset, labels): Adds pulled quarters to the manifest
+- refresh_start(data_dir, dataset, start_date, lookback): First date a refresh needs to pull
+"""
+
+
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from atomic_io import atomic_write
+from holdings_schema import coerce_holdings, PARQUET_OPTIONS
+
+SCHEMA_VERSION_KEY = b'schema_version'
+RAW_SCHEMA_VERSION = '13f-raw-1'
+PREFILTERED_SCHEMA_VERSION = '13f-prefiltered-1'
+
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Arrow counterpart of holdings_schema.HOLDINGS_DTYPES
+SCHEMA_13F = pa.schema([
+    ('fdate', pa.timestamp('ns')),
+    ('mgrno', pa.int32()),
+    ('mgrname', _CATEGORY),
+    ('typecode', pa.int8()),
+    ('cusip', _CATEGORY),
+    ('shares', pa.float64()),
+    ('prc', pa.float64()),
+    ('shrout1', pa.float64()),
+    # Plain strings (still dictionary-encoded pages): pyarrow's statistics pruning drops rows when
+    # filtering an all-null dictionary column, and these two are only ever filtered on
+    ('stkcd', pa.string()),
+    ('exchcd', pa.string()),
+], metadata={SCHEMA_VERSION_KEY: RAW_SCHEMA_VERSION.encode()})
+
+SCHEMA_13F_PREFILTERED = pa.schema(
+    [field for field in SCHEMA_13F if field.name not in ('stkcd', 'exchcd')],
+    metadata={SCHEMA_VERSION_KEY: PREFILTERED_SCHEMA_VERSION.encode()})
+
+# Cleaned panel written by clean_data's out-of-core mode: no stkcd/exchcd, manager key added,
+# typecode reclassified (never null)
+SCHEMA_13F_CLEANED = pa.schema(
+    [field for field in SCHEMA_13F if field.name in ('fdate', 'mgrno', 'mgrname')]
+    + [pa.field('mgr_key', pa.int32(), nullable=False), pa.field('typecode', pa.int8(), nullable=False)]
+    + [field for field in SCHEMA_13F if field.name in ('cusip', 'shares', 'prc', 'shrout1')])
+
+_manifest_lock = threading.Lock()
+
+
+def quarter_label(date):
+    """
+    Returns: partition label of the quarter containing date, ie. '1980-Q1'
+    """
+    qtr = pd.Period(date, freq='Q')
+    return f"{qtr.year}-Q{qtr.quarter}"
+
+
+def quarter_ranges(start_date, end_date):
+    """
+    Splits [start_date, end_date] into calendar quarters, clipped to the range
+    Returns:
+        list of (label, start, end) tuples, dates as ISO strings
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    ranges = []
+    for qtr in pd.period_range(start, end, freq='Q'):
+        q_start = max(qtr.start_time.normalize(), start)
+        q_end = min(qtr.end_time.normalize(), end)
+        ranges.append((quarter_label(qtr.start_time), q_start.strftime('%Y-%m-%d'), q_end.strftime('%Y-%m-%d')))
+    return ranges
+
+
+def dataset_dir(data_dir, dataset):
+    """
+    Returns: directory of a partitioned dataset, ie. data/pulled/13f
+    """
+    return Path(data_dir) / "pulled" / dataset
+
+
+def partition_path(data_dir, dataset, label):
+    """
+    Returns: path of the Parquet file holding one quarter of a dataset
+    """
+    return dataset_dir(data_dir, dataset) / f"fdate={label}" / "part-0.parquet"
+
+
+def write_partition(df, data_dir, dataset, label, schema=SCHEMA_13F):
+    """
+    Writes one quarter of a dataset, replacing whatever was stored for that quarter
+    Rows are sorted by fdate so the row-group statistics can prune reads filtered on fdate
+    The file is written under a temporary name and renamed, so readers never see a partial partition
+    """
+    path = partition_path(data_dir, dataset, label)
+    df = coerce_holdings(df, float32=False).sort_values('fdate', kind='stable')
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    return atomic_write(path, lambda tmp_path: pq.write_table(table, tmp_path, **PARQUET_OPTIONS))
+
+
+def partition_files(data_dir, dataset):
+    """
+    Returns: sorted list of the Parquet files in a partitioned dataset
+    """
+    return sorted(dataset_dir(data_dir, dataset).glob("fdate=*/*.parquet"))
+
+
+def input_files(data_dir):
+    """
+    Returns: the files clean_data reads (13F holdings, Mutual_Fund.parquet, PF_names.csv), in a fixed order
+    """
+    data_dir = Path(data_dir)
+    files_13f = partition_files(data_dir, "13f") or [data_dir / "pulled" / "13f.parquet"]
+    return files_13f + [data_dir / "pulled" / "Mutual_Fund.parquet", data_dir / "manual" / "PF_names.csv"]
+
+
+def _file_schema_version(path):
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(SCHEMA_VERSION_KEY, RAW_SCHEMA_VERSION.encode()).decode()
+
+
+def schema_version(data_dir):
+    """
+    Returns: PREFILTERED_SCHEMA_VERSION if every pulled 13F file was pre-filtered, else RAW_SCHEMA_VERSION
+    """
+    files = partition_files(data_dir, "13f")
+    if files and all(_file_schema_version(f) == PREFILTERED_SCHEMA_VERSION for f in files):
+        return PREFILTERED_SCHEMA_VERSION
+    return RAW_SCHEMA_VERSION
+
+
+def fdate_filter(start=None, end=None, before=None):
+    """
+    Returns: row filter start <= fdate <= end and fdate < before (each bound optional), or None
+    """
+    bounds = []
+    if start is not None:
+        bounds.append(pc.field('fdate') >= pd.Timestamp(start))
+    if end is not None:
+        bounds.append(pc.field('fdate') <= pd.Timestamp(end))
+    if before is not None:
+        bounds.append(pc.field('fdate') < pd.Timestamp(before))
+    return and_filters(bounds)
+
+
+def holdings_filter():
+    """
+    Returns: row filter keeping rows with prc and shrout1, stkcd '0' or null, exchcd A/B/V or null
+    """
+    return (pc.field('prc').is_valid() & pc.field('shrout1').is_valid()
+            & ((pc.field('stkcd') == '0') | pc.field('stkcd').is_null())
+            & (pc.field('exchcd').isin(['A', 'B', 'V']) | pc.field('exchcd').is_null()))
+
+
+def and_filters(filters):
+    filters = [f for f in filters if f is not None]
+    if not filters:
+        return None
+    combined = filters[0]
+    for f in filters[1:]:
+        combined = combined & f
+    return combined
+
+
+def dataset_13f(data_dir):
+    """
+    Returns: pyarrow dataset over the pulled 13F holdings, partitioned layout first, else 13f.parquet
+    """
+    files = partition_files(data_dir, "13f")
+    if files:
+        schema = SCHEMA_13F_PREFILTERED if schema_version(data_dir) == PREFILTERED_SCHEMA_VERSION else SCHEMA_13F
+        # fdate is stored in the files themselves, the directory names only split the quarters
+        return ds.dataset([str(f) for f in files], schema=schema, format='parquet')
+    return ds.dataset(str(Path(data_dir) / "pulled" / "13f.parquet"), format='parquet')
+
+
+def read_13f(data_dir, columns=None, filter=None):
+    """
+    Reads the pulled 13F holdings, preferring the partitioned layout over 13f.parquet
+    columns and filter (a pyarrow.compute expression) are applied while scanning, so only the
+    requested columns of row groups whose statistics can match are read
+    If raw and pre-filtered partitions are mixed, pre-filtered rows come back with null
+    stkcd/exchcd, which pass the clean_data filters as they should
+    """
+    table = dataset_13f(data_dir).to_table(columns=columns, filter=filter)
+    return coerce_holdings(table.to_pandas(types_mapper={pa.int8(): pd.Int8Dtype()}.get))
+
+
+def iter_13f_batches(data_dir, columns=None, filter=None, batch_size=1_000_000):
+    """
+    Streams the pulled 13F holdings as DataFrames of at most batch_size rows, in file order
+    (quarter partitions in date order), with the same dtypes as read_13f
+    """
+    dataset = dataset_13f(data_dir)
+    for fragment in dataset.get_fragments():
+        for batch in fragment.to_batches(schema=dataset.schema, columns=columns, filter=filter, batch_size=batch_size):
+            if batch.num_rows:
+                yield coerce_holdings(batch.to_pandas(types_mapper={pa.int8(): pd.Int8Dtype()}.get))
+
+
+def manifest_path(data_dir):
+    """
+    Returns: path of the manifest of pulled quarters
+    """
+    return Path(data_dir) / "pulled" / "manifest.json"
+
+
+def load_manifest(data_dir):
+    """
+    Returns: dict of dataset name -> {'quarters': [...], 'watermark': label, 'updated': timestamp}
+    """
+    path = manifest_path(data_dir)
+    if not path.exists():
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def record_quarters(data_dir, dataset, labels):
+    """
+    Adds the quarter labels pulled for a dataset to the manifest and moves its watermark
+    The watermark is the end of the gap-free run of quarters, so a shard that failed during a
+    parallel pull is fetched again on the next refresh
+    """
+    with _manifest_lock:
+        manifest = load_manifest(data_dir)
+        entry = manifest.get(dataset, {'quarters': []})
+        quarters = sorted(set(entry['quarters']) | set(labels))
+        manifest[dataset] = {
+            'quarters': quarters,
+            'watermark': _contiguous_end(quarters),
+            'updated': datetime.now().isoformat(timespec='seconds'),
+        }
+        atomic_write(manifest_path(data_dir), lambda tmp_path: tmp_path.write_text(json.dumps(manifest, indent=2)))
+    return manifest[dataset]
+
+
+def watermark(data_dir, dataset):
+    """
+    Returns: label of the latest quarter pulled for a dataset, None if it was never pulled
+    """
+    return load_manifest(data_dir).get(dataset, {}).get('watermark')
+
+
+def _label_to_period(label):
+    year, qtr = label.split('-Q')
+    return pd.Period(year=int(year), quarter=int(qtr), freq='Q')
+
+
+def _contiguous_end(labels):
+    if not labels:
+        return None
+    periods = [_label_to_period(label) for label in labels]
+    end = periods[0]
+    for qtr in periods[1:]:
+        if qtr != end + 1:
+            break
+        end = qtr
+    return quarter_label(end.start_time)
+
+
+def refresh_start(data_dir, dataset, start_date, lookback=0):
+    """
+    First date an incremental pull has to fetch: the quarter after the watermark, moved back
+    by lookback quarters so late amendments are picked up. Falls back to start_date for a
+    dataset that has no manifest entry.
+    Returns:
+        str: ISO date
+    """
+    mark = watermark(data_dir, dataset)
+    start = pd.Timestamp(start_date)
+    if mark is None:
+        return start.strftime('%Y-%m-%d')
+    first = (_label_to_period(mark) + 1 - lookback).start_time
+    return max(first, start).strftime('%Y-%m-%d')
+
+
+def is_current(data_dir, dataset, end_date):
+    """
+    Returns: True if the manifest shows the dataset pulled through the quarter of end_date
+    """
+    mark = watermark(data_dir, dataset)
+    return mark is not None and mark >= quarter_label(end_date)
@@ -0,0 +1,114 @@
+"""
+Vectorized rolling count of distinct cusips per manager (the 'universe' metric of build_DFs)
+
+Same result as grouping by manager and applying df_constructor.roll_stocks, without a Python loop:
+
+- Managers, quarters and cusips are factorized to integers; quarters are ranked within each manager
+    in the order they are observed, so the window is the manager's last `window` observed quarters
+- A cusip held at rank r is in the windows ending at ranks r .. r + window - 1. Each (manager, cusip)
+    adds +1 to a difference array when it enters the window and -1 when it leaves (at its next holding,
+    the window length, or the manager's last quarter, whichever comes first), so a cumulative sum over
+    the manager's ranks gives the size of the sliding multiset of cusips
+
+Functions:
+- rolling_universe(df, window): DataFrame of the manager columns (mgr_key, or mgrno and mgrname), Qtr and universe
+- rolling_universes(df, windows): The same for several window lengths in one pass, as universe_<w> columns
+"""
+
+
+import numpy as np
+import pandas as pd
+
+from holdings_schema import manager_columns
+
+WINDOW = 12
+
+
+def rolling_universe(df, window=WINDOW):
+    """
+    df needs mgr_key (or mgrno and mgrname), Qtr (quarterly Period) and cusip
+    Returns:
+        DataFrame: the manager columns, Qtr and the number of distinct cusips held over the manager's last
+        `window` observed quarters up to Qtr, one row per manager-quarter
+    """
+    result = rolling_universes(df, [window])
+    return result.rename(columns={f"universe_{window}": 'universe'})
+
+
+def _no_universes(df, windows):
+    """
+    Result of rolling_universes (or universe_sketch.approximate_universes) for a frame without any manager
+    """
+    result = df[manager_columns(df) + ['Qtr']][:0].reset_index(drop=True)
+    for window in windows:
+        result[f"universe_{window}"] = np.zeros(0, dtype='int64')
+    return result
+
+
+def _manager_quarters(df):
+    """
+    Manager-quarters of df in (manager, quarter) order and where every holding falls among them, shared by
+    rolling_universes and universe_sketch.approximate_universes
+    Returns:
+        tuple: (result, manager, mq_manager, rank, held, position): the manager columns and Qtr of each
+        manager-quarter, the manager number of every row of df, the manager number and rank (within its
+        manager) of each manager-quarter, the rows with a manager and a cusip, and the manager-quarter of each
+        of those; None if df has no manager
+    """
+    keys = manager_columns(df)
+    manager = df.groupby(keys, observed=True, sort=False).ngroup().to_numpy()
+    if not (manager >= 0).any():
+        return None
+    quarter = df['Qtr'].array.asi8 - df['Qtr'].array.asi8.min()
+
+    # Manager-quarters in (manager, quarter) order, with each one's rank within its manager
+    rows = pd.DataFrame({'manager': manager, 'quarter': quarter})
+    rows = rows[manager >= 0].drop_duplicates().sort_values(['manager', 'quarter'], kind='stable')
+    mq_manager = rows['manager'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, mq_manager[1:] != mq_manager[:-1]])
+    rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+
+    # Manager-quarter of every holding through a lookup of (manager, quarter) in the sorted manager-quarters
+    span = quarter.max() + 1
+    lookup = mq_manager.astype('int64') * span + rows['quarter'].to_numpy()
+    held = (manager >= 0) & df['cusip'].notna().to_numpy()
+    position = np.searchsorted(lookup, manager[held].astype('int64') * span + quarter[held])
+
+    result = df.iloc[rows.index.to_numpy()][keys + ['Qtr']].reset_index(drop=True)
+    return result, manager, mq_manager, rank, held, position
+
+
+def rolling_universes(df, windows):
+    """
+    rolling_universe for several window lengths at once: the factorizing, ranking and sorting of the
+    holdings is shared, only the difference array is rebuilt per window
+    Returns:
+        DataFrame: the manager columns, Qtr and a universe_<w> column per window w
+    """
+    quarters = _manager_quarters(df)
+    if quarters is None:
+        return _no_universes(df, windows)
+    result, manager, mq_manager, rank, held, position = quarters
+    n_quarters = np.bincount(mq_manager, minlength=manager.max() + 1)
+    offset = np.concatenate([[0], np.cumsum(n_quarters)])
+    cusip = pd.factorize(df['cusip'])[0]
+
+    # Distinct (manager, cusip, rank), ordered so consecutive holdings of a cusip are adjacent
+    holdings = pd.DataFrame({'manager': manager[held], 'cusip': cusip[held], 'rank': rank[position]}).drop_duplicates()
+    h_manager, h_cusip, h_rank = (holdings[c].to_numpy() for c in ('manager', 'cusip', 'rank'))
+    order = np.lexsort((h_rank, h_cusip, h_manager))
+    h_manager, h_cusip, h_rank = h_manager[order], h_cusip[order], h_rank[order]
+
+    same_next = (h_manager[1:] == h_manager[:-1]) & (h_cusip[1:] == h_cusip[:-1])
+    next_rank = np.full(len(h_rank), np.iinfo('int64').max)
+    next_rank[:-1][same_next] = h_rank[1:][same_next]
+    # Leaving after the manager's last quarter lands on the next manager's first slot, which cancels it there
+    last = np.minimum(next_rank, n_quarters[h_manager])
+
+    total = len(result)
+    enter = offset[h_manager] + h_rank
+    entries = np.bincount(enter, minlength=total + 1)
+    for window in windows:
+        leave = enter + np.minimum(last - h_rank, window)
+        result[f"universe_{window}"] = np.cumsum(entries - np.bincount(leave, minlength=total + 1))[:total]
+    return result
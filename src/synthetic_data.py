@@ -0,0 +1,190 @@
+"""
+Synthetic stand-in for the WRDS pulls, so the pipeline can be tested and benchmarked without the real data
+(python src/synthetic_data.py <data_dir> [n_managers n_securities n_quarters])
+
+- Writes data_dir/pulled/13f.parquet (SCHEMA_13F, or the quarter-partitioned layout with partitioned=True),
+    data_dir/pulled/Mutual_Fund.parquet (fdate, mgrcocd) and data_dir/manual/PF_names.csv (PF_name)
+- Holdings per manager are lognormal (a few managers hold hundreds of securities, most a few dozen), and the
+    securities they pick follow a Zipf-like popularity, so large caps are held by many managers
+- Portfolios persist between quarters: each quarter a `turnover` share of every manager's positions is
+    redrawn, which keeps the rolling universes realistic
+- Managers enter and leave the panel, switch typecode now and then, and file typecode 5 (or nothing) from
+    Dec 1998 on like the real 13F; some are mutual funds (listed in Mutual_Fund.parquet) and, optionally,
+    pension funds (listed in PF_names.csv)
+- Some rows fail the clean_data filters (missing price, stkcd, exchcd) or have no manager name
+- The output only depends on the sizes and the seed; quarters are generated and written one at a time
+
+Functions:
+- generate_quarters(...): Yields (fdate, holdings frame) for each quarter, plus the manager table
+- write_synthetic_data(data_dir, ...): Writes the three input files, returns the number of holdings rows
+"""
+
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import pulled_data
+from holdings_schema import PARQUET_OPTIONS
+from manager_dim import TYPECODE_CUTOFF, MF_START
+
+START_DATE = '1996-03-31'
+TYPECODES = [1, 2, 3, 4, 5]
+# Share of managers of each 13F typecode (banks, insurers, investment companies, advisors, other)
+TYPECODE_WEIGHTS = [0.10, 0.05, 0.15, 0.60, 0.10]
+
+
+def _managers(n_managers, n_quarters, holdings_median, holdings_sigma, n_securities, pension_share, rng):
+    """
+    One row per manager: mgrno, mgrname, typecode, first and last quarter, number of positions, size
+    and pension / mutual fund flags
+    """
+    first = rng.integers(0, max(n_quarters // 2, 1), n_managers)
+    # Half of the managers are still filing at the end of the panel
+    last = np.where(rng.random(n_managers) < 0.5, n_quarters - 1,
+                    first + rng.integers(0, n_quarters, n_managers))
+    typecode = rng.choice(TYPECODES, n_managers, p=TYPECODE_WEIGHTS)
+    pension = (rng.random(n_managers) < pension_share) & np.isin(typecode, [3, 4, 5])
+    mgrno = np.arange(10000, 10000 + n_managers, dtype='int32')
+    names = np.where(pension, [f"SYNTHETIC PENSION FUND {i:06d}" for i in range(n_managers)],
+                     [f"SYNTHETIC MANAGER {i:06d}" for i in range(n_managers)])
+    positions = np.rint(np.exp(rng.normal(np.log(holdings_median), holdings_sigma, n_managers)))
+    return pd.DataFrame({
+        'mgrno': mgrno,
+        'mgrname': names,
+        'typecode': typecode.astype('int8'),
+        'first': first,
+        'last': np.minimum(last, n_quarters - 1),
+        'positions': np.clip(positions, 1, n_securities).astype('int64'),
+        'size': np.exp(rng.normal(0, 1.5, n_managers)),
+        'pension': pension,
+        'mutual_fund': rng.random(n_managers) < 0.2,
+        # Managers filing 5 or nothing (instead of their typecode) from TYPECODE_CUTOFF on
+        'misfiled': rng.random(n_managers) < 0.5,
+    })
+
+
+def generate_quarters(n_managers=200, n_securities=2000, n_quarters=24, start=START_DATE, seed=0,
+                      holdings_median=40, holdings_sigma=1.0, popularity=0.8, turnover=0.15, pension_share=0.0):
+    """
+    holdings_median / holdings_sigma: lognormal distribution of the number of positions of each manager
+    popularity: exponent of the Zipf-like weights securities are drawn with (0 draws them uniformly)
+    turnover: share of each manager's positions replaced every quarter
+    pension_share: share of the typecode 3-5 managers named in PF_names.csv; none by default, as in the
+        WRDS data (construct_stats expects its five types, without pension funds)
+    Returns:
+        tuple: the manager table and a generator of (fdate, holdings frame with the SCHEMA_13F columns)
+    """
+    rng = np.random.default_rng(seed)
+    fdates = pd.date_range(start, periods=n_quarters, freq='Q')
+    managers = _managers(n_managers, n_quarters, holdings_median, holdings_sigma, n_securities, pension_share, rng)
+
+    weights = 1.0 / np.arange(1, n_securities + 1) ** popularity
+    weights /= weights.sum()
+    cusips = np.array([f"{j:06d}10" for j in range(n_securities)])
+    log_price = rng.normal(3, 1, n_securities)
+    shrout = np.exp(rng.normal(np.log(50), 1.5, n_securities))
+    stkcd = rng.choice(np.array(['0', None, '1'], dtype=object), n_securities, p=[0.85, 0.10, 0.05])
+    exchcd = rng.choice(np.array(['A', 'B', 'V', None, 'X'], dtype=object), n_securities,
+                        p=[0.30, 0.30, 0.25, 0.10, 0.05])
+
+    owner = np.repeat(np.arange(n_managers), managers['positions'].to_numpy())
+    security = rng.choice(n_securities, len(owner), p=weights)
+
+    def quarters():
+        nonlocal log_price, security
+        for q, fdate in enumerate(fdates):
+            if q > 0:
+                log_price = log_price + rng.normal(0.02, 0.15, n_securities)
+                moved = rng.random(len(owner)) < turnover
+                security[moved] = rng.choice(n_securities, moved.sum(), p=weights)
+
+            active = ((managers['first'].to_numpy() <= q) & (managers['last'].to_numpy() >= q))[owner]
+            rows = pd.DataFrame({'manager': owner[active], 'security': security[active]}).drop_duplicates()
+            m, s = rows['manager'].to_numpy(), rows['security'].to_numpy()
+            n = len(rows)
+
+            typecode = pd.array(managers['typecode'].to_numpy()[m], dtype='Int8')
+            switched = rng.random(n) < 0.01
+            typecode[switched] = rng.choice(TYPECODES, switched.sum())
+            if fdate >= TYPECODE_CUTOFF:
+                misfiled = managers['misfiled'].to_numpy()[m]
+                typecode[misfiled] = 5
+                typecode[misfiled & (rng.random(n) < 0.3)] = pd.NA
+            mgrname = managers['mgrname'].to_numpy()[m].astype(object)
+            mgrname[rng.random(n) < 0.001] = None
+            prc = np.exp(log_price[s])
+            prc[rng.random(n) < 0.01] = np.nan
+            ownership = managers['size'].to_numpy()[m] * np.exp(rng.normal(np.log(1e-4), 1.0, n))
+
+            yield fdate, pd.DataFrame({
+                'fdate': np.full(n, fdate.to_datetime64()),
+                'mgrno': managers['mgrno'].to_numpy()[m],
+                'mgrname': mgrname,
+                'typecode': typecode,
+                'cusip': cusips[s],
+                'shares': np.maximum(np.rint(shrout[s] * 1000000 * np.minimum(ownership, 0.05)), 1.0),
+                'prc': prc,
+                'shrout1': shrout[s],
+                'stkcd': stkcd[s],
+                'exchcd': exchcd[s],
+            })
+
+    return managers, quarters()
+
+
+def write_synthetic_data(data_dir, n_managers=200, n_securities=2000, n_quarters=24, start=START_DATE, seed=0,
+                         partitioned=False, **shape):
+    """
+    Writes the synthetic 13F holdings, mutual fund mapping and pension fund names under data_dir
+    (see generate_quarters for the shape parameters)
+    partitioned: write the 13F holdings as the quarter-partitioned dataset (and its manifest) instead of
+        the single 13f.parquet
+    Returns:
+        int: number of holdings rows written
+    """
+    data_dir = Path(data_dir)
+    (data_dir / "pulled").mkdir(parents=True, exist_ok=True)
+    (data_dir / "manual").mkdir(parents=True, exist_ok=True)
+    managers, quarters = generate_quarters(n_managers, n_securities, n_quarters, start, seed, **shape)
+
+    rows, mf, labels = 0, [], []
+    writer = None
+    path = data_dir / "pulled" / "13f.parquet"
+    try:
+        for q, (fdate, df) in enumerate(quarters):
+            rows += len(df)
+            if partitioned:
+                labels.append(pulled_data.quarter_label(fdate))
+                pulled_data.write_partition(df, data_dir, "13f", labels[-1])
+            else:
+                if writer is None:
+                    writer_options = {k: v for k, v in PARQUET_OPTIONS.items() if k != 'row_group_size'}
+                    writer = pq.ParquetWriter(path, pulled_data.SCHEMA_13F, **writer_options)
+                writer.write_table(pa.Table.from_pandas(df, schema=pulled_data.SCHEMA_13F, preserve_index=False),
+                                   row_group_size=PARQUET_OPTIONS['row_group_size'])
+            funds = managers[managers['mutual_fund'] & (managers['first'] <= q) & (managers['last'] >= q)]
+            if fdate >= MF_START:
+                mf.append(pd.DataFrame({'fdate': fdate, 'mgrcocd': funds['mgrno'].astype('float64')}))
+    finally:
+        if writer is not None:
+            writer.close()
+    if partitioned:
+        pulled_data.record_quarters(data_dir, "13f", labels)
+
+    df_mf = pd.concat(mf, ignore_index=True) if mf else pd.DataFrame({'fdate': pd.Series(dtype='datetime64[ns]'),
+                                                                      'mgrcocd': pd.Series(dtype='float64')})
+    df_mf.to_parquet(data_dir / "pulled" / "Mutual_Fund.parquet", index=False)
+    # Plus a few pension funds that never file a 13F, like most of the hand-collected list
+    pf_names = list(managers.loc[managers['pension'], 'mgrname']) + [f"SYNTHETIC PENSION PLAN {i}" for i in range(5)]
+    pd.DataFrame({'PF_name': pf_names}).to_csv(data_dir / "manual" / "PF_names.csv", index=False)
+    return rows
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[2:5]]
+    print(write_synthetic_data(sys.argv[1], *sizes))
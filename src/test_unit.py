@@ -1,11 +1,32 @@
 import os
+import json
 import re
+import sqlite3
+import pytest
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from pathlib import Path
-from clean_data import clean_data  
-from df_constructor import build_DFs
+from clean_data import clean_data, read_cleaned
+import clean_data as clean_data_module
+from clean_cache import cached_clean_data, cached_cube, cached_holdings_matrices
+from df_constructor import build_DFs, roll_stocks, security_quarters, market_val, rollup_periods
+from rolling_universe import rolling_universe, rolling_universes
+from grouped_quantile import grouped_quantiles
+from manager_dim import register_managers, manager_keys, load_lookup, load_manager_dim, TYPECODE_CUTOFF
+import holdings_matrix
 import config
 import numpy as np
+import pulled_data
+import df_constructor
+import clean_cache
+import pipeline
+import benchmark
+import instrumentation
+from synthetic_data import write_synthetic_data
+from atomic_io import atomic_write
+from holdings_schema import canonical_categories, coerce_holdings, DICTIONARY_COLUMNS
+from pull_13f import pull_13f_partitioned
+from pull_engine import SQLiteConnection, run_sharded_pull
 
 #tex_file_path = os.path.join(os.path.dirname(__file__), '..', 'output', 'full_report.tex')
 tex_file_path = config.OUTPUT_DIR / 'full_report.tex'
@@ -53,7 +74,7 @@ def test_clean_data_no_nulls():
     """
     Checks if cleaned data has any null values
     """
-    df_cleaned = clean_data(test_period, data_dir)
+    df_cleaned = cached_clean_data(test_period, data_dir)
     assert not df_cleaned['prc'].isnull().any(), "'prc' column contains null values"
     assert not df_cleaned['shrout1'].isnull().any(), "'shrout1' column contains null values"
 
@@ -61,12 +82,13 @@ def test_clean_data_types():
     """
     Checks the expected data types of the cleaned data
     """
-    df_cleaned = clean_data(test_period, data_dir)
+    df_cleaned = cached_clean_data(test_period, data_dir)
     expected_dtypes = {
-        'mgrno': 'float64',
-        'mgrname': 'object',
-        'typecode': 'float64',
-        'cusip': 'object',
+        'mgrno': 'int32',
+        'mgrname': 'category',
+        'mgr_key': 'int32',
+        'typecode': 'int8',
+        'cusip': 'category',
         'shares': 'float64',
         'prc': 'float64',
         'shrout1': 'float64'
@@ -80,29 +102,44 @@ def test_typecodes_filtered_correctly():
     """
     Checks if the institution typecodes are correctly filtered in the cleanded data
     """
-    df_cleaned = clean_data(test_period, data_dir)
+    df_cleaned = cached_clean_data(test_period, data_dir)
     allowed_typecodes = [1, 2, 3, 4, 5, 6]
     assert df_cleaned['typecode'].isin(allowed_typecodes).all(), "Typecodes not filtered correctly"
 
-def test_clean_data_num_rows():
+@pytest.mark.parametrize("backend", ["pandas", "polars"])
+def test_clean_data_num_rows(backend):
     """
-    Checks the number of rows in the cleaned data
+    Checks the number of rows in the cleaned data (the typecode tie-break of clean_data's sort only picks
+    a typecode, it never drops a row, so the count does not depend on it)
     """
-    df_cleaned = clean_data(test_period, data_dir)
+    df_cleaned = clean_data(test_period, data_dir, backend=backend)
     assert df_cleaned.shape[0] == 5909454
 
 def test_clean_data_num_cols():
     """
     Checks the number of rows in the cleaned data
     """
-    df_cleaned = clean_data(test_period, data_dir)
-    assert df_cleaned.shape[1] == 8
+    df_cleaned = cached_clean_data(test_period, data_dir)
+    assert df_cleaned.shape[1] == 9
 
-def test_built_data():
+def _assert_no_typecode_ties(period):
+    """
+    The expected values below were derived when clean_data sorted on fdate with an unstable sort, which left
+    the order of a manager-quarter's rows arbitrary; its stable sort can only pick another "last" typecode
+    for a manager-quarter filing two different ones. Checks the pull has none, so the values still hold
+    """
+    raw = pulled_data.read_13f(data_dir, columns=['fdate', 'mgrno', 'mgrname', 'typecode'],
+                               filter=pulled_data.fdate_filter(end=period[1]))
+    typecodes = raw.groupby(['mgrno', 'mgrname', 'fdate'], observed=True)['typecode'].nunique()
+    assert (typecodes <= 1).all(), "Some manager-quarters file two typecodes; re-derive the expected values"
+
+@pytest.mark.parametrize("backend", ["pandas", "polars"])
+def test_built_data(backend):
     """
     Checks the values of the built data
     """
-    df_cleaned = clean_data(test_period, data_dir)
+    _assert_no_typecode_ties(test_period)
+    df_cleaned = clean_data(test_period, data_dir, backend=backend)
     df_built = build_DFs(df_cleaned, [test_period])
     assert (df_built[test_period].values == np.array(
     [[  120,   268,  3206,   163,   564,   227,   805,     1],
@@ -110,3 +147,591 @@ def test_built_data():
     [  238,   282,  4946,    68,   656,   125,  1116,     8],
     [  375,  2324, 27162,   228,  1548,   415,  2371,    38],
     [ 1305,   256,  2209,    76,   275,   125,   484,    11]])).all()
+
+
+def _synthetic_s34_db(db_path):
+    """
+    Writes a SQLite stand-in for tr_13f.s34 with two managers over three quarters
+    """
+    rows = pd.DataFrame({
+        'fdate': ['2001-03-31', '2001-03-31', '2001-06-30', '2001-06-30', '2001-09-30', '2001-09-30'],
+        'mgrno': [1.0, 2.0, 1.0, 2.0, 1.0, 2.0],
+        'mgrname': ['A', 'B', 'A', 'B', 'A', 'B'],
+        'typecode': [1.0, 3.0, 1.0, 3.0, 1.0, 3.0],
+        'cusip': ['00000001', '00000002', '00000001', '00000003', '00000002', None],
+        'shares': [100.0, 200.0, 150.0, 250.0, 300.0, 50.0],
+        'prc': [10.0, 20.0, 11.0, 30.0, 21.0, None],
+        'shrout1': [1.0, 2.0, 1.0, 3.0, 2.0, 4.0],
+        'stkcd': [None, '0', '0', '1', '0', '0'],
+        'exchcd': ['A', 'X', 'A', 'V', None, 'A'],
+    })
+    with sqlite3.connect(db_path) as conn:
+        rows.to_sql('s34', conn, index=False)
+    return rows
+
+def test_parallel_pull_from_local_stand_in(tmp_path):
+    """
+    Checks the sharded pull against a local SQLite s34: one partition per quarter, manifest updated
+    """
+    rows = _synthetic_s34_db(tmp_path / "tr_13f.db")
+    factory = lambda: SQLiteConnection({'tr_13f': tmp_path / "tr_13f.db"})
+    paths = pull_13f_partitioned(start_date='2001-01-01', end_date='2001-12-31', data_dir=tmp_path,
+                                 workers=2, connection_factory=factory)
+
+    assert len(paths) == 3
+    assert pulled_data.watermark(tmp_path, "13f") == "2001-Q4"
+    pulled = pulled_data.read_13f(tmp_path)
+    assert pulled.shape[0] == rows['prc'].notnull().sum()
+    assert set(pulled['fdate'].dt.strftime('%Y-%m-%d')) == {'2001-03-31', '2001-06-30', '2001-09-30'}
+
+def test_mf_refresh_with_nothing_new_to_pull(tmp_path):
+    """
+    Checks a refresh of a mapping already pulled through end_date leaves Mutual_Fund.parquet alone
+    without connecting
+    """
+    pull_mf = pytest.importorskip("pull_mf")
+    (tmp_path / "pulled").mkdir()
+    path = tmp_path / "pulled" / "Mutual_Fund.parquet"
+    df_mf = pd.DataFrame({'fdate': pd.to_datetime(['2001-03-31', '2001-12-31']), 'mgrcocd': [1.0, 2.0]})
+    df_mf.to_parquet(path, index=False)
+    pulled_data.record_quarters(tmp_path, "Mutual_Fund", ['2001-Q1', '2001-Q2', '2001-Q3', '2001-Q4'])
+    written = path.stat().st_mtime_ns
+
+    def no_connection():
+        raise AssertionError("nothing to pull, no connection expected")
+
+    refreshed = pull_mf.refresh_mf_mapping(start_date='2001-01-01', end_date='2001-12-31', lookback=0,
+                                           data_dir=tmp_path, connection_factory=no_connection)
+    pd.testing.assert_frame_equal(refreshed, df_mf)
+    assert path.stat().st_mtime_ns == written
+    assert pull_mf.pull_mf_mapping(start_date='2002-01-01', end_date='2001-12-31',
+                                   connection_factory=no_connection).empty
+
+def test_pull_retries_failed_shard(tmp_path):
+    """
+    Checks that a shard whose connection fails is retried on a fresh connection
+    """
+    _synthetic_s34_db(tmp_path / "tr_13f.db")
+    attempts = []
+
+    class FlakyConnection(SQLiteConnection):
+        def raw_sql(self, sql, params=None, date_cols=None):
+            attempts.append(params['start_date'])
+            if len(attempts) == 1:
+                raise ConnectionError("dropped")
+            return super().raw_sql(sql, params=params, date_cols=date_cols)
+
+    shards = pulled_data.quarter_ranges('2001-01-01', '2001-03-31')
+    result = run_sharded_pull("SELECT * FROM tr_13f.s34 WHERE fdate BETWEEN %(start_date)s AND %(end_date)s",
+                              shards, lambda df, label: len(df),
+                              lambda: FlakyConnection({'tr_13f': tmp_path / "tr_13f.db"}), workers=1, backoff=0)
+    assert result == {'2001-Q1': 2}
+    assert len(attempts) == 2
+
+def _synthetic_data_dir(tmp_path, data_dir, prefiltered=False):
+    """
+    Pulls the synthetic s34 rows into data_dir, alongside a mutual fund mapping and pension fund list
+    """
+    (data_dir / "manual").mkdir(parents=True)
+    (data_dir / "pulled").mkdir(parents=True)
+    pd.DataFrame({'PF_name': ['B']}).to_csv(data_dir / "manual" / "PF_names.csv", index=False)
+    pd.DataFrame({'fdate': pd.to_datetime(['2001-06-30']), 'mgrcocd': [1.0]}).to_parquet(data_dir / "pulled" / "Mutual_Fund.parquet")
+    if not (tmp_path / "tr_13f.db").exists():
+        _synthetic_s34_db(tmp_path / "tr_13f.db")
+    factory = lambda: SQLiteConnection({'tr_13f': tmp_path / "tr_13f.db"})
+    pull_13f_partitioned(start_date='2001-01-01', end_date='2001-12-31', data_dir=data_dir,
+                         workers=2, connection_factory=factory, prefiltered=prefiltered)
+    return data_dir
+
+def test_prefiltered_pull_matches_clean_data(tmp_path):
+    """
+    Checks that a pre-filtered pull cleans to the same panel as a raw pull
+    """
+    cleaned = []
+    for prefiltered in [False, True]:
+        synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / str(prefiltered), prefiltered)
+        cleaned.append(clean_data(('2001-01-01', '2001-12-31'), synthetic_dir))
+
+    assert pulled_data.schema_version(tmp_path / "True") == pulled_data.PREFILTERED_SCHEMA_VERSION
+    assert 'stkcd' not in pulled_data.read_13f(tmp_path / "True").columns
+    pd.testing.assert_frame_equal(cleaned[0], cleaned[1])
+
+def test_polars_backend_matches_pandas(tmp_path):
+    """
+    Checks that the polars backend returns the pandas output row for row
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    df_pandas = clean_data(('2001-01-01', '2001-12-31'), synthetic_dir)
+    df_polars = clean_data(('2001-01-01', '2001-12-31'), synthetic_dir, backend="polars")
+    pd.testing.assert_frame_equal(df_pandas, df_polars)
+
+def test_clean_cache_invalidates_and_evicts(tmp_path):
+    """
+    Checks that cached panels match clean_data, are reused, and are replaced when an input changes
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    first = cached_clean_data(period, synthetic_dir)
+    pd.testing.assert_frame_equal(first, clean_data(period, synthetic_dir))
+    key = clean_cache.cache_key(period, synthetic_dir)
+    assert cached_clean_data(period, synthetic_dir).equals(first)
+    assert [f.stem for f in clean_cache.cache_dir(synthetic_dir).glob("*.parquet")] == [key]
+
+    cached_cube(period, synthetic_dir)
+    assert len(list((synthetic_dir / "derived" / "cube").iterdir())) == 1
+
+    pd.DataFrame({'PF_name': ['A']}).to_csv(synthetic_dir / "manual" / "PF_names.csv", index=False)
+    assert clean_cache.cache_key(period, synthetic_dir) != key
+    cached_clean_data(period, synthetic_dir, max_bytes=0)
+    assert list(clean_cache.cache_dir(synthetic_dir).glob("*.parquet")) == []
+    assert list((synthetic_dir / "derived" / "cube").iterdir()) == []
+    assert list((synthetic_dir / "derived" / "manager_dim").iterdir()) == []
+
+
+def test_atomic_write_leaves_destination_on_failure(tmp_path):
+    """
+    Checks that atomic_write replaces a file (or directory) only once it is fully written, and leaves
+    neither the destination changed nor a temporary behind when writing fails
+    """
+    path = atomic_write(tmp_path / "out" / "data.json", lambda tmp: tmp.write_text("old"))
+
+    def failing(tmp):
+        tmp.write_text("partial")
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        atomic_write(path, failing)
+    assert path.read_text() == "old"
+    directory = atomic_write(tmp_path / "out" / "cube", lambda tmp: (tmp.mkdir(), (tmp / "a.parquet").write_text("x")))
+    assert (directory / "a.parquet").exists()
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["cube", "data.json"]
+
+def test_clean_cache_memory_is_capped(tmp_path):
+    """
+    Checks that panels are only kept in memory within the byte budget, and copied only on request
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    first = cached_clean_data(period, synthetic_dir)
+    assert cached_clean_data(period, synthetic_dir) is not first
+
+    shared = cached_clean_data(period, synthetic_dir, memory_bytes=1024**2)
+    assert cached_clean_data(period, synthetic_dir, memory_bytes=1024**2) is shared
+    copied = cached_clean_data(period, synthetic_dir, memory_bytes=1024**2, copy=True)
+    assert copied is not shared and copied.equals(shared)
+
+    other = ('2001-01-01', '2001-06-30')
+    cached_clean_data(other, synthetic_dir, memory_bytes=shared.memory_usage(deep=True).sum())
+    assert cached_clean_data(period, synthetic_dir) is not shared
+
+
+def test_float32_keeps_columns_that_would_lose_precision():
+    """
+    Checks that a column a float32 round trip would change (share counts above 2**24, large prices) stays
+    float64 with its exact values and a warning, while the other column still becomes float32
+    """
+    df = pd.DataFrame({'shares': [100.0, 2.0**24, np.nan], 'prc': [12.34, 0.015625, 40000.01]})
+    assert (coerce_holdings(df, float32=True).dtypes == 'float32').all()
+    large = df.assign(shares=[100.0, 33554433.0, 2.0**24 + 1])
+    with pytest.warns(UserWarning, match="shares"):
+        coerced = coerce_holdings(large, float32=True)
+    assert coerced['shares'].dtype == 'float64' and coerced['prc'].dtype == 'float32'
+    pd.testing.assert_series_equal(coerced['shares'], large['shares'])
+    with pytest.warns(UserWarning, match="prc"):
+        assert coerce_holdings(df.assign(prc=[12.34, 0.015625, 1234567.89]), float32=True)['prc'].dtype == 'float64'
+
+
+def test_float32_holdings_survive_coercion_and_cleaning(tmp_path, monkeypatch):
+    """
+    Checks that float32 shares/prc are not cast back to float64, by a second coerce_holdings or by clean_data
+    """
+    df = coerce_holdings(pd.DataFrame({'shares': [100.0, 200.0], 'prc': [12.5, 7.25]}), float32=True)
+    assert (coerce_holdings(df, float32=True).dtypes == 'float32').all()
+    assert (coerce_holdings(df, float32=False).dtypes == 'float64').all()
+
+    monkeypatch.setattr(config, 'HOLDINGS_FLOAT32', True)
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    cleaned = clean_data(('2001-01-01', '2001-12-31'), synthetic_dir)
+    assert (cleaned[['shares', 'prc']].dtypes == 'float32').all()
+
+
+def test_persisted_manager_dim_matches_fresh_clean(tmp_path):
+    """
+    Checks that cleaning from saved manager dimension tables gives the same panel as building them
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    dim_dir = tmp_path / "manager_dim"
+    fresh = clean_data(period, synthetic_dir, manager_dim_dir=dim_dir)
+    assert (dim_dir / "managers.parquet").exists() and (dim_dir / "quarters.parquet").exists()
+    pd.testing.assert_frame_equal(clean_data(period, synthetic_dir, manager_dim_dir=dim_dir), fresh)
+    pd.testing.assert_frame_equal(clean_data(period, synthetic_dir), fresh)
+
+
+def test_out_of_core_clean_matches_in_memory(tmp_path):
+    """
+    Checks that cleaning in small batches to a partitioned dataset gives the in-memory panel back
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    out_dir = tmp_path / "13f_clean"
+    paths = clean_data(period, synthetic_dir, out_dir=out_dir, memory_budget=clean_data_module.CLEAN_BYTES_PER_ROW)
+    assert sorted(p.parent.name for p in paths) == ['fdate=2001-Q1', 'fdate=2001-Q2', 'fdate=2001-Q3']
+    pd.testing.assert_frame_equal(read_cleaned(out_dir), clean_data(period, synthetic_dir))
+
+
+def test_manager_keys_are_stable_across_cleans(tmp_path):
+    """
+    Checks that managers keep their mgr_key when cleaned again and new managers get the next free keys
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    first = clean_data(period, synthetic_dir)
+    assert first.groupby(['mgrno', 'mgrname'], observed=True)['mgr_key'].nunique().eq(1).all()
+
+    newcomers = pd.DataFrame({'mgrno': pd.array([7, 1], dtype='int32'), 'mgrname': pd.Categorical(['Z', 'A'])})
+    lookup = register_managers(newcomers, synthetic_dir)
+    assert manager_keys(newcomers, lookup).tolist() == [first['mgr_key'].max() + 1, first.loc[first['mgrname'] == 'A', 'mgr_key'].iloc[0]]
+    pd.testing.assert_frame_equal(clean_data(period, synthetic_dir, backend="polars"), first)
+    assert len(load_lookup(synthetic_dir)) == len(lookup)
+
+
+def test_manager_keys_are_unique_across_processes(tmp_path):
+    """
+    Checks that managers registered from several processes at once all get a key, and no key is handed out twice
+    """
+    batches = [pd.DataFrame({'mgrno': pd.array(np.arange(i * 50, (i + 1) * 50), dtype='int32'),
+                             'mgrname': pd.Categorical([f"M{i}"] * 50)}) for i in range(8)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(register_managers, batches, [tmp_path] * len(batches)))
+
+    lookup = load_lookup(tmp_path)
+    assert len(lookup) == 400 and lookup['mgr_key'].is_unique
+    assert (manager_keys(pd.concat(batches, ignore_index=True).astype({'mgrname': 'category'}), lookup) >= 0).all()
+
+
+def _random_holdings(n=2000, seed=0, n_cusips=40):
+    rng = np.random.default_rng(seed)
+    quarters = pd.period_range('1990Q1', '1999Q4', freq='Q')
+    return pd.DataFrame({
+        'mgrno': rng.integers(0, 10, n).astype('int32'),
+        'mgrname': pd.Categorical(rng.choice(['A', 'B'], n)),
+        'Qtr': quarters[rng.integers(0, len(quarters), n)],
+        'cusip': pd.Categorical(rng.choice([f"C{i}" for i in range(n_cusips)] + [None], n)),
+    }).sort_values('Qtr')
+
+
+def _random_cleaned_holdings(n=2000, seed=0, n_cusips=40):
+    """
+    _random_holdings with the columns of clean_data: quarter-end fdate, a typecode per manager, shares and prices
+    """
+    df = _random_holdings(n, seed, n_cusips).rename(columns={'Qtr': 'fdate'})
+    df['fdate'] = df['fdate'].dt.end_time.dt.normalize()
+    rng = np.random.default_rng(seed)
+    df['typecode'] = (df['mgrno'] % 5 + 1).astype('int8')
+    df['shares'] = rng.integers(1, 1000, len(df)).astype(float)
+    df['prc'] = rng.uniform(1, 100, len(df))
+    df['shrout1'] = rng.uniform(1, 50, len(df))
+    return df
+
+
+def _roll_stocks_by_manager(df, window=12):
+    return (df.groupby(['mgrno', 'mgrname'], observed=True).apply(roll_stocks, window=window)
+            .reset_index(level=2, drop=True).reset_index())
+
+
+def test_rolling_universe_matches_roll_stocks():
+    """
+    Checks the vectorized rolling distinct-cusip count against roll_stocks, with gaps between a
+    manager's quarters, repeated holdings and missing cusips
+    """
+    df = _random_holdings()
+    keys = ['mgrno', 'mgrname', 'Qtr']
+    expected = _roll_stocks_by_manager(df)
+    result = rolling_universe(df)
+    pd.testing.assert_frame_equal(result.sort_values(keys).reset_index(drop=True),
+                                  expected.sort_values(keys).reset_index(drop=True))
+
+
+def test_rolling_universes_match_each_window():
+    """
+    Checks that the one-pass multi-window universe matches roll_stocks run once per window
+    """
+    df = _random_holdings(seed=1)
+    keys = ['mgrno', 'mgrname', 'Qtr']
+    result = rolling_universes(df, [4, 8, 12, 20]).sort_values(keys).reset_index(drop=True)
+    for window in [4, 8, 12, 20]:
+        expected = _roll_stocks_by_manager(df, window).sort_values(keys).reset_index(drop=True)
+        assert result[f"universe_{window}"].tolist() == expected['universe'].tolist()
+
+
+def test_market_val_counts_each_security_once_per_quarter():
+    """
+    Checks that the security-quarter table keeps the first holding of each (Qtr, cusip)
+    and that market_val sums its market capitalization per quarter
+    """
+    df = pd.DataFrame({
+        'Qtr': pd.PeriodIndex(['2001Q1', '2001Q1', '2001Q1', '2001Q2'], freq='Q'),
+        'cusip': ['X', 'X', 'Y', 'X'],
+        'prc': [10.0, 99.0, 2.0, 11.0],
+        'shrout1': [1.0, 1.0, 3.0, 1.0],
+    })
+    securities = security_quarters(df)
+    assert securities[['Qtr', 'cusip']].astype(str).values.tolist() == [['2001Q1', 'X'], ['2001Q1', 'Y'], ['2001Q2', 'X']]
+    assert market_val(securities)['market_val'].tolist() == [16e6, 11e6]
+
+
+def test_grouped_quantiles_match_np_percentile():
+    """
+    Checks the grouped quantile kernel bit-for-bit against np.percentile per group,
+    including single-value groups and a group holding a NaN
+    """
+    rng = np.random.default_rng(2)
+    values = rng.lognormal(15, 3, 500)
+    groups = rng.integers(0, 25, 500)
+    groups[-1] = 25
+    values[0] = np.nan
+    result = grouped_quantiles(values, groups, [0.5, 0.9, 0.25])
+    for group in range(26):
+        expected = np.percentile(values[groups == group], [50, 90, 25])
+        assert np.array_equal(result[group], expected, equal_nan=True)
+
+
+def test_cube_rollup_matches_build_dfs(tmp_path):
+    """
+    Checks that D1 rolled up from the persisted manager-quarter cube equals build_DFs
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    periods = [('2001-01-01', '2001-06-30'), ('2001-07-01', '2001-12-31')]
+    expected = build_DFs(clean_data(period, synthetic_dir), periods)
+    for _ in range(2):
+        result = rollup_periods(*cached_cube(period, synthetic_dir), periods)
+        for p in periods:
+            pd.testing.assert_frame_equal(result[p], expected[p])
+    assert len(list((synthetic_dir / "derived" / "cube").iterdir())) == 1
+
+
+def test_append_quarter_matches_full_rebuild(tmp_path):
+    """
+    Checks that appending a newly cleaned quarter to a cube built from the panel cleaned before it gives the same
+    manager-quarter and market tables, and the same D1, as rebuilding from the newly cleaned panel, when a
+    manager's new typecode reclassifies the quarters already in the cube
+    """
+    data_dir = tmp_path / "data"
+    write_synthetic_data(data_dir, n_managers=80, n_securities=400)
+    path = data_dir / "pulled" / "13f.parquet"
+    raw = pd.read_parquet(path)
+    last = raw['fdate'].max()
+    previous_end = (pd.Period(last, freq='Q') - 1).end_time.normalize()
+    # A bank that turns insurer in the new quarter: no pre-Dec-1998 typecode, not a mutual fund, filing in both quarters
+    first_filed = raw.groupby('mgrno')['fdate'].min()
+    funds = pd.read_parquet(data_dir / "pulled" / "Mutual_Fund.parquet")['mgrcocd']
+    both = set(raw.loc[raw['fdate'] == last, 'mgrno']) & set(raw.loc[raw['fdate'] == previous_end, 'mgrno'])
+    mgrno = sorted(set(first_filed[first_filed >= TYPECODE_CUTOFF].index) & both - set(funds))[0]
+    raw.loc[raw['mgrno'] == mgrno, 'typecode'] = 1
+    raw.loc[(raw['mgrno'] == mgrno) & (raw['fdate'] == last), 'typecode'] = 2
+    raw.to_parquet(path, schema=pulled_data.SCHEMA_13F, index=False)
+
+    start, end = '1996-01-01', str(last.date())
+    before = clean_data((start, str(previous_end.date())), data_dir)
+    cube, _ = df_constructor.build_cube(before, start, str(previous_end.date()), tmp_path / "cube")
+    after = clean_data((start, end), data_dir, manager_dim_dir=tmp_path / "manager_dim")
+    _, quarter_types = load_manager_dim(tmp_path / "manager_dim")
+    managers, market = df_constructor.append_quarter(tmp_path / "cube", after[after['fdate'] > previous_end], quarter_types)
+
+    key = after.loc[after['mgrno'] == mgrno, 'mgr_key'].iloc[0]
+    assert set(cube.loc[cube['mgr_key'] == key, 'type']) == {1}
+    assert set(managers.loc[managers['mgr_key'] == key, 'type']) == {2}
+    full_managers, full_market = df_constructor.manager_quarter_cube(after, start, end)
+    keys = ['Qtr', 'mgr_key']
+    pd.testing.assert_frame_equal(managers.sort_values(keys).reset_index(drop=True),
+                                  full_managers.sort_values(keys).reset_index(drop=True))
+    pd.testing.assert_frame_equal(market, full_market)
+    periods = [(start, '1998-12-31'), ('1999-01-01', end)]
+    incremental, full = rollup_periods(managers, market, periods), build_DFs(after, periods)
+    for p in periods:
+        pd.testing.assert_frame_equal(incremental[p], full[p])
+
+
+def test_sparse_backend_matches_pandas(tmp_path):
+    """
+    Checks that D1 built from the cached sparse holdings matrices equals the pandas build_DFs, and that
+    the matrix metrics agree with the holdings they come from
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    period = ('2001-01-01', '2001-12-31')
+    periods = [('2001-01-01', '2001-06-30'), ('2001-07-01', '2001-12-31')]
+    df = clean_data(period, synthetic_dir)
+    for windows in [None, [2, 3]]:
+        expected, result = build_DFs(df, periods, windows), build_DFs(df, periods, windows, backend="sparse")
+        for p in periods:
+            pd.testing.assert_frame_equal(result[p], expected[p])
+
+    managers, cusips, quarters = cached_holdings_matrices(period, synthetic_dir)
+    assert len(list((synthetic_dir / "derived" / "matrices").iterdir())) == 1
+    loaded = cached_holdings_matrices(period, synthetic_dir)
+    for qtr, quarter in quarters.items():
+        assert (loaded[2][qtr]['shares'] != quarter['shares']).nnz == 0
+        rows = df[df['fdate'].dt.to_period('Q') == qtr]
+        held = rows.groupby('cusip', observed=True)['shares'].sum() / (rows.groupby('cusip', observed=True)['shrout1'].first() * 1e6)
+        shares = holdings_matrix.ownership_shares(quarter)
+        assert np.allclose(shares[cusips.get_indexer(held.index)], held.to_numpy())
+
+    clean_cache.evict(synthetic_dir, max_bytes=0)
+    assert list((synthetic_dir / "derived" / "matrices").iterdir()) == []
+
+
+def test_sparse_stats_match_pandas(tmp_path):
+    """
+    Checks that construct_stats from the holdings matrices equals the pandas tables, with missing shares
+    (left out of the average position value, like mean() does) and a manager-quarter without any
+    """
+    construct_stats = pytest.importorskip("construct_stats")
+    write_synthetic_data(tmp_path, n_managers=40, n_securities=300, n_quarters=16)
+    df = clean_data(benchmark.synthetic_periods(16)[0], tmp_path)
+    missing = np.random.default_rng(0).random(len(df)) < 0.05
+    missing |= ((df['fdate'] == df['fdate'].iloc[0]) & (df['mgr_key'] == df['mgr_key'].iloc[0])).to_numpy()
+    df.loc[missing, 'shares'] = np.nan
+
+    for expected, result in zip(construct_stats.construct_stats(df), construct_stats.construct_stats(df, backend="sparse")):
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_sharded_build_dfs_matches_serial():
+    """
+    Checks that build_DFs over manager shards in a process pool (some of them empty) equals the serial path
+    """
+    df = _random_cleaned_holdings(n=3000, seed=4)
+    periods = [('1990-01-01', '1994-12-31'), ('1995-01-01', '1999-12-31')]
+    for windows in [None, [4, 12]]:
+        serial = df_constructor.manager_quarter_cube(df, periods[0][0], periods[-1][1], windows, workers=1)
+        sharded = df_constructor.manager_quarter_cube(df, periods[0][0], periods[-1][1], windows, workers=3)
+        pd.testing.assert_frame_equal(sharded[0], serial[0])
+        expected, result = build_DFs(df, periods, windows, workers=1), build_DFs(df, periods, windows, workers=8)
+        for p in periods:
+            pd.testing.assert_frame_equal(result[p], expected[p])
+
+
+def test_approximate_universe_within_error_bound():
+    """
+    Checks that the HyperLogLog fast mode reports its error bound and that the D1 universe medians and
+    90th percentiles land within three relative standard errors of the exact ones, the rest unchanged
+    """
+    df = _random_cleaned_holdings(n=60000, seed=5, n_cusips=5000)
+    periods = [('1990-01-01', '1994-12-31'), ('1995-01-01', '1999-12-31')]
+    for windows in [None, [4, 12]]:
+        exact, approximate = build_DFs(df, periods, windows), build_DFs(df, periods, windows, approximate=True)
+        for p in periods:
+            bound = approximate[p].attrs['universe_relative_error']
+            assert 0 < bound < 0.05
+            universe = [c for c in exact[p].columns if c.startswith('universe')]
+            error = (approximate[p][universe] - exact[p][universe]).abs()
+            assert (error <= 3 * bound * exact[p][universe] + 1).all().all()
+            pd.testing.assert_frame_equal(approximate[p].drop(columns=universe), exact[p].drop(columns=universe))
+
+
+def test_construct_stats_leaves_input_unchanged(tmp_path):
+    """
+    Checks that the single-pass stats do not add columns to the cleaned panel and count each manager once
+    """
+    construct_stats = pytest.importorskip("construct_stats")
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    df = clean_data(('2001-01-01', '2001-12-31'), synthetic_dir)
+    columns = list(df.columns)
+    manager_quarters = construct_stats.manager_quarter_aum(df)
+    assert list(df.columns) == columns
+    expected = df.groupby(['fdate', 'typecode'])[['mgrno', 'mgrname']].apply(lambda x: len(x.drop_duplicates()))
+    counts = construct_stats.create_mgrs_df(df, manager_quarters)
+    assert (counts.stack() == expected.astype(float)).all()
+
+
+def test_render_figures_skips_up_to_date(tmp_path):
+    """
+    Checks that figures are only redrawn when their stats frame or plot spec changes
+    """
+    construct_stats = pytest.importorskip("construct_stats")
+    pytest.importorskip("matplotlib")
+    stats = pd.DataFrame({'fdate': pd.to_datetime(['2001-03-31', '2001-06-30']), 'Bank': [1.0, 2.0], 'Other': [3.0, 1.0]})
+    figures = [(stats, 'AUM', 'AUM Over Time', 'aum.png', True), (stats, 'Count', 'Managers', 'mgrs.png')]
+    paths = construct_stats.render_figures(figures, workers=2, backend="matplotlib", out_dir=tmp_path)
+    stamps = {name: path.stat().st_mtime_ns for name, path in paths.items()}
+    construct_stats.render_figures(figures, workers=2, backend="matplotlib", out_dir=tmp_path)
+    assert {name: path.stat().st_mtime_ns for name, path in paths.items()} == stamps
+
+    figures[0] = (stats.assign(Bank=[1.0, 5.0]),) + figures[0][1:]
+    construct_stats.render_figures(figures, workers=2, backend="matplotlib", out_dir=tmp_path)
+    assert paths['aum.png'].stat().st_mtime_ns != stamps['aum.png']
+    assert paths['mgrs.png'].stat().st_mtime_ns == stamps['mgrs.png']
+
+
+def test_pipeline_d1_artifact_round_trip(tmp_path):
+    """
+    Checks that the D1 tables persisted between pipeline stages load back as the same dict, in period order
+    """
+    synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+    periods = [('2001-07-01', '2001-12-31'), ('2001-01-01', '2001-06-30')]
+    expected = build_DFs(clean_data(('2001-01-01', '2001-12-31'), synthetic_dir), sorted(periods))
+    expected = {p: expected[p] for p in periods}
+    pipeline.save_d1(expected, tmp_path / "d1.parquet")
+    loaded = pipeline.load_d1(tmp_path / "d1.parquet")
+    assert list(loaded) == periods
+    for p in periods:
+        pd.testing.assert_frame_equal(loaded[p], expected[p], check_index_type=False)
+
+
+def test_synthetic_data_cleans(tmp_path):
+    """
+    Checks that the synthetic panel is reproducible, reads the same from both layouts and cleans into all types
+    """
+    rows = write_synthetic_data(tmp_path / "file", n_managers=40, n_securities=300, n_quarters=16)
+    assert write_synthetic_data(tmp_path / "parts", n_managers=40, n_securities=300, n_quarters=16, partitioned=True) == rows
+    raw, parts = (canonical_categories(pulled_data.read_13f(tmp_path / layout), DICTIONARY_COLUMNS)
+                  for layout in ("file", "parts"))
+    pd.testing.assert_frame_equal(raw, parts)
+    assert len(raw) == rows
+
+    period = benchmark.synthetic_periods(16)[0]
+    cleaned = clean_data(period, tmp_path / "file")
+    assert 0 < len(cleaned) < rows
+    assert set(cleaned['typecode']) == {1, 2, 3, 4, 6}
+    assert cleaned.groupby('mgr_key').size().max() > 4 * cleaned.groupby('mgr_key').size().median()
+
+
+def test_benchmark_writes_results(tmp_path):
+    """
+    Checks that a small benchmark run times each stage and writes its results as JSON
+    """
+    results = benchmark.run_benchmarks(scales=(1,), sizes={'n_managers': 20, 'n_securities': 100, 'n_quarters': 8},
+                                       stages=('clean_data', 'build_DFs'), out_dir=tmp_path)
+    stages = results['runs'][0]['stages']
+    assert stages['clean_data']['seconds'] > 0 and stages['build_DFs']['peak_rss_mb'] > 0
+    written = [json.loads(path.read_text()) for path in tmp_path.glob("*.json")]
+    assert written == [results]
+    assert benchmark.compare_results(results, results).empty
+
+
+def test_profile_run_records_stages(tmp_path):
+    """
+    Checks that a run writes the nested stages of the pull and clean_data, with rows, and a cProfile dump of
+    the chosen stage; stages outside a run are not recorded
+    """
+    with instrumentation.profile_run("test", out_dir=tmp_path / "profiles", profile_stage="clean_data.reclassify", enabled=True):
+        with instrumentation.profile_run("inner", out_dir=tmp_path / "profiles", enabled=True) as inner:
+            assert inner is None
+        synthetic_dir = _synthetic_data_dir(tmp_path, tmp_path / "data")
+        df = clean_data(('2001-01-01', '2001-12-31'), synthetic_dir)
+    clean_data(('2001-01-01', '2001-12-31'), synthetic_dir)
+
+    [path] = (tmp_path / "profiles").glob("*.json")
+    stages = instrumentation.load_profile(path).set_index('name')
+    # One shard per quarter of 2001, the rows with a price
+    assert len(stages.loc['pull_shard']) == 4 and stages.loc['pull_shard', 'rows_out'].sum() == 5
+    # Shards run on worker threads, where resetting the process-wide high-water mark would clear the others'
+    assert (stages.loc['pull_shard', 'peak_rss_scope'] == 'process').all()
+    per_stage = json.loads(path.read_text())['peak_rss_per_stage']
+    assert stages.loc['clean_data', 'peak_rss_scope'] == ('stage' if per_stage else 'process')
+    assert stages.loc['clean_data', 'rows_out'] == len(df)
+    assert stages.loc['clean_data.reclassify', 'parent'] == 'clean_data'
+    assert (stages[['wall_seconds', 'cpu_seconds', 'peak_rss_mb']].to_numpy() >= 0).all()
+    assert len(list((tmp_path / "profiles").glob("test-*-clean_data.reclassify.prof"))) == 1
@@ -0,0 +1,119 @@
+"""
+Approximate rolling universe (distinct cusips per manager over its last `window` observed quarters) from
+HyperLogLog sketches, for exploratory runs of build_DFs(..., approximate=True)
+
+- Every manager-quarter gets a sketch of 2**precision one-byte registers, built from a 64-bit hash of each
+    cusip it holds (first `precision` bits pick the register, the register keeps the longest run of
+    leading zeros seen in the rest)
+- Sketches merge by element-wise max, so the sketch of a window is the max of the manager's last `window`
+    quarter sketches; the windows of several lengths share the same running merge
+- Counts come from the HyperLogLog estimate (linear counting for small ones); their relative standard
+    error is about 1.04 / sqrt(2**precision), ie. 3.3% at the default precision of 10
+- Managers are processed in chunks so the register arrays stay within about CHUNK_BYTES
+
+Functions:
+- relative_error(precision): Relative standard error of the estimates
+- estimate(registers): Distinct-count estimate of each row of a register array
+- approximate_universes(df, windows, precision): Same frame as rolling_universe.rolling_universes, estimated
+"""
+
+
+import numpy as np
+import pandas as pd
+
+from rolling_universe import _manager_quarters, _no_universes
+
+PRECISION = 10
+CHUNK_BYTES = 32 * 1024**2
+
+
+def relative_error(precision=PRECISION):
+    """
+    Returns: relative standard error of a HyperLogLog estimate with 2**precision registers
+    """
+    return 1.04 / np.sqrt(2 ** precision)
+
+
+def _leading_zeros(values):
+    """
+    Leading zero bits of each uint64 value (64 for 0), exact through two 32-bit halves
+    """
+    high, low = (values >> np.uint64(32)).astype('float64'), (values & np.uint64(0xFFFFFFFF)).astype('float64')
+    zeros = np.full(len(values), 64, dtype='int64')
+    zeros[high > 0] = 32 - np.frexp(high[high > 0])[1]
+    only_low = (high == 0) & (low > 0)
+    zeros[only_low] = 64 - np.frexp(low[only_low])[1]
+    return zeros
+
+
+def _registers_of(cusip, precision):
+    """
+    Register index and value of each holding's cusip (a categorical Series)
+    """
+    hashes = pd.util.hash_array(np.asarray(cusip.cat.categories, dtype=object))
+    codes = cusip.cat.codes.to_numpy()
+    hashes = hashes[np.maximum(codes, 0)]
+    register = (hashes >> np.uint64(64 - precision)).astype('int64')
+    rest = hashes << np.uint64(precision)
+    value = np.minimum(_leading_zeros(rest), 64 - precision) + 1
+    return register, value.astype('uint8')
+
+
+def estimate(registers):
+    """
+    registers: (n, 2**precision) uint8 sketches
+    Returns:
+        ndarray: HyperLogLog estimate of each row, linear counting where it is small and registers are empty
+    """
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    powers = np.ldexp(1.0, -np.arange(65))
+    raw = alpha * m * m / powers[registers].sum(axis=1)
+    empty = (registers == 0).sum(axis=1)
+    small = (raw <= 2.5 * m) & (empty > 0)
+    raw[small] = m * np.log(m / empty[small])
+    return raw
+
+
+def approximate_universes(df, windows, precision=PRECISION, chunk_bytes=CHUNK_BYTES):
+    """
+    df needs mgr_key (or mgrno and mgrname), Qtr (quarterly Period) and a categorical cusip
+    Returns:
+        DataFrame: the manager columns, Qtr and a universe_<w> column (estimate rounded to an integer) per window w
+    """
+    windows = sorted(windows)
+    quarters = _manager_quarters(df)
+    if quarters is None:
+        return _no_universes(df, windows)
+    result, _, mq_manager, rank, held, position = quarters
+    n_rows = len(result)
+    starts = np.flatnonzero(np.r_[True, mq_manager[1:] != mq_manager[:-1]])
+
+    # Manager-quarter row, register and value of every holding with a cusip, ordered by row
+    register, value = _registers_of(df['cusip'], precision)
+    order = np.argsort(position, kind='stable')
+    position, register, value = position[order], register[held][order], value[held][order]
+
+    m = 2 ** precision
+    counts = {window: np.zeros(n_rows, dtype='int64') for window in windows}
+    chunk_rows = max(chunk_bytes // m, 1)
+    # Chunks of about chunk_rows manager-quarters, cut at a manager's first quarter so windows stay inside
+    targets = np.arange(chunk_rows, n_rows, chunk_rows)
+    bounds = np.unique(np.r_[0, starts[np.searchsorted(starts, targets, side='right') - 1], n_rows])
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        first, last = np.searchsorted(position, [a, b])
+        sketches = np.zeros((b - a, m), dtype='uint8')
+        np.maximum.at(sketches.reshape(-1), (position[first:last] - a) * m + register[first:last], value[first:last])
+
+        merged = sketches.copy()
+        chunk_rank = rank[a:b]
+        for back in range(windows[-1]):
+            if back > 0:
+                later = np.flatnonzero(chunk_rank >= back)
+                merged[later] = np.maximum(merged[later], sketches[later - back])
+            if back + 1 in counts:
+                counts[back + 1][a:b] = np.rint(estimate(merged))
+
+    for window in windows:
+        result[f"universe_{window}"] = counts[window]
+    return result